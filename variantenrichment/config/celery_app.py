@@ -1,6 +1,7 @@
 import os
 
 from celery import Celery
+from celery.signals import celeryd_init
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings.local")
@@ -18,6 +19,24 @@ app.autodiscover_tasks()
 app.conf.broker_url = 'redis://localhost:6377/0'
 
 
+@celeryd_init.connect
+def start_metrics_server(**kwargs):
+    from django.conf import settings
+    from variantenrichment.tool.instrumentation import start_metrics_server
+
+    if settings.PROMETHEUS_METRICS_PORT:
+        start_metrics_server(settings.PROMETHEUS_METRICS_PORT)
+
+
+@celeryd_init.connect
+def warm_references(**kwargs):
+    """ prepares the default reference bundle once per worker, before the pool processes start """
+    from django.conf import settings
+    from variantenrichment.tool.references import get_resources
+
+    get_resources().get(settings.DEFAULT_REFERENCE)
+
+
 @app.task(bind=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
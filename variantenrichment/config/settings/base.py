@@ -1,6 +1,7 @@
 """
 Base settings to build other settings files upon.
 """
+import os
 from pathlib import Path
 
 import environ
@@ -294,3 +295,73 @@ SOCIALACCOUNT_ADAPTER = "variantenrichment.users.adapters.SocialAccountAdapter"
 
 # Your stuff...
 # ------------------------------------------------------------------------------
+# redis instance for publishing pipeline progress to the project pages
+PROGRESS_REDIS_URL = env.str("PROGRESS_REDIS_URL", CELERY_BROKER_URL)
+# CADD server scoring the filtered variants, a local fake one is started by the load_test command
+CADD_URL = env.str("CADD_URL", "https://cadd.gs.washington.edu/")
+# seconds between checks of a posted file, doubled after every check up to the maximum
+CADD_POLL_INTERVAL = env.int("CADD_POLL_INTERVAL", 30)
+CADD_POLL_MAX_INTERVAL = env.int("CADD_POLL_MAX_INTERVAL", 30 * 60)
+# seconds after which a project still waiting for CADD scores fails
+CADD_TIMEOUT = env.int("CADD_TIMEOUT", 2 * 24 * 60 * 60)
+# what happens to the intermediate files of a project once its statistics are done: keep, compress or delete
+ARTIFACT_POLICY = env.str("ARTIFACT_POLICY", "compress")
+# bytes of files per project and of all projects, above these the oldest intermediates and then the files
+# of the least recently processed projects are deleted
+ARTIFACT_PROJECT_QUOTA = env.int("ARTIFACT_PROJECT_QUOTA", 5 * 1024 ** 3)
+ARTIFACT_GLOBAL_QUOTA = env.int("ARTIFACT_GLOBAL_QUOTA", 500 * 1024 ** 3)
+ARTIFACT_GC_INTERVAL = env.int("ARTIFACT_GC_INTERVAL", 60 * 60)
+# http://docs.celeryproject.org/en/latest/userguide/configuration.html#beat-schedule
+CELERY_BEAT_SCHEDULE = {
+    "poll-cadd": {
+        "task": "variantenrichment.tool.tasks.poll_cadd_task",
+        "schedule": CADD_POLL_INTERVAL,
+    },
+    "artifact-gc": {
+        "task": "variantenrichment.tool.tasks.artifact_gc_task",
+        "schedule": ARTIFACT_GC_INTERVAL,
+    },
+}
+# annotation databases and CADD versions of the genome builds projects can choose from;
+# annotation_version names the content of the three files and has to be changed whenever one of them is replaced,
+# background sets and cached annotations of another version are not used
+REFERENCE_BUNDLES = {
+    "GRCh37": {
+        "db_file": "variantenrichment/data/refseq_105_hg19.ser",
+        "fasta_file": "variantenrichment/data/hs37d5.fa",
+        "gnomad_exomes_file": "variantenrichment/data/gnomad.exomes.r2.0.2.sites.vcf.gz",
+        "cadd_version": "GRCh37-v1.6",
+        "annotation_version": "refseq-105:gnomad-exomes-2.0.2:hs37d5",
+    },
+    "GRCh38": {
+        "db_file": "variantenrichment/data/refseq_curated_109_hg38.ser",
+        "fasta_file": "variantenrichment/data/GRCh38_no_alt_analysis_set.fa",
+        "gnomad_exomes_file": "variantenrichment/data/gnomad.exomes.r2.1.1.sites.liftover_grch38.vcf.gz",
+        "cadd_version": "GRCh38-v1.6",
+        "annotation_version": "refseq-curated-109:gnomad-exomes-2.1.1-liftover:GRCh38-no-alt",
+    },
+}
+DEFAULT_REFERENCE = env.str("DEFAULT_REFERENCE", "GRCh37")
+# local directory the workers copy the reference files to, the shared files are used in place if empty
+REFERENCE_CACHE_DIR = env.str("REFERENCE_CACHE_DIR", "")
+# unix socket of the annotation daemon batching the jannovar runs of the workers on a host,
+# see the annotation_daemon command; jobs run jannovar themselves if empty, the daemon is not running
+# or it doesn't answer within ANNOTATION_DAEMON_TIMEOUT seconds plus ANNOTATION_DAEMON_TIMEOUT_PER_MB
+# for every megabyte of the sites file. Batching only raises the throughput when several jobs annotate
+# at the same time: every batch starts a new jannovar process loading its database, which is not kept
+# loaded between batches; with one job at a time leave it empty
+ANNOTATION_DAEMON_SOCKET = env.str("ANNOTATION_DAEMON_SOCKET", "")
+ANNOTATION_DAEMON_TIMEOUT = env.float("ANNOTATION_DAEMON_TIMEOUT", 300)
+ANNOTATION_DAEMON_TIMEOUT_PER_MB = env.float("ANNOTATION_DAEMON_TIMEOUT_PER_MB", 10)
+# SQLite file caching the jannovar annotations of variants for all projects, disabled if empty
+ANNOTATION_CACHE_FILE = env.str("ANNOTATION_CACHE_FILE", "variantenrichment/data/annotation_cache.sqlite")
+# least recently used variants are removed above this number
+ANNOTATION_CACHE_MAX_ENTRIES = env.int("ANNOTATION_CACHE_MAX_ENTRIES", 5000000)
+# bgzip and bcftools threads compressing and decompressing variant files: the host threads are divided
+# among the jobs running on the host, a job gets at most IO_JOB_THREADS; the jobs register in IO_JOBS_DIR
+IO_HOST_THREADS = env.int("IO_HOST_THREADS", os.cpu_count() or 1)
+IO_JOB_THREADS = env.int("IO_JOB_THREADS", 8)
+IO_JOBS_DIR = env.str("IO_JOBS_DIR", "/tmp/variantenrichment_io_jobs")
+# port on which celery workers export prometheus metrics, not exported if unset;
+# set PROMETHEUS_MULTIPROC_DIR as well to include the metrics of the worker child processes
+PROMETHEUS_METRICS_PORT = env.int("PROMETHEUS_METRICS_PORT", default=None)
@@ -15,6 +15,11 @@ from variantenrichment.tool.views import (
     CheckCaddView,
     RunStatsView,
     ProjectResultsView,
+    ProjectScoresView,
+    ProjectArtifactView,
+    ProjectProgressView,
+    JobProfileView,
+    JobReportView,
     SearchView
 )
 
@@ -35,9 +40,14 @@ urlpatterns = [
     path("project/upload-file/<uuid:pk>/", FileUploadView.as_view(), name="file-upload"),
     path("project/delete-files/<uuid:pk>/", FilesDeleteView.as_view(), name="files-delete"),
     path("project/start-processing/<uuid:pk>/", ConfirmProcessingView.as_view(), name="confirm-processing"),
+    path("project/progress/<uuid:pk>/", ProjectProgressView.as_view(), name="project-progress"),
     path("project/check-cadd/<uuid:pk>", CheckCaddView.as_view(), name="check-cadd"),
     path("project/run-statistics/<uuid:pk>", RunStatsView.as_view(), name="run-statistics"),
     path("project/results/<uuid:pk>/", ProjectResultsView.as_view(), name="project-results"),
+    path("project/results/<uuid:pk>/scores.json", ProjectScoresView.as_view(), name="project-scores"),
+    path("project/artifacts/<uuid:pk>/<str:name>", ProjectArtifactView.as_view(), name="project-artifact"),
+    path("project/profiles/<uuid:pk>/<int:job>", JobProfileView.as_view(), name="job-profile"),
+    path("jobs/report/", JobReportView.as_view(), name="job-report"),
     path("search/", SearchView.as_view(), name="search"),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
@@ -2,6 +2,8 @@
 document.addEventListener('DOMContentLoaded', () => {
    initFileNames();
    initResultTable();
+   initQQPlots();
+   initProgress();
 });
 
 function initFileNames() {
@@ -37,26 +39,187 @@ function initResultTable() {
       }
    })
 
-   const pValueInput = document.querySelector(".do-displayRelevant");
-   const tableRows = [].slice.call(document.querySelectorAll(".results-table tbody tr"));
+   const columns = [].slice.call(resultTable.querySelectorAll("thead th"));
+   const tableBody = resultTable.querySelector("tbody");
+   const searchInput = document.querySelector(".do-search");
+   const pValueInput = document.querySelector(".do-filterP");
+   const qValueInput = document.querySelector(".do-filterQ");
+   const previousButton = document.querySelector(".do-previousPage");
+   const nextButton = document.querySelector(".do-nextPage");
+   const pageInfo = document.querySelector(".results-pagination__info");
 
-   pValueInput.addEventListener("keyup", () => {
-      const pVal = parseFloat(pValueInput.value) || 1;
+   const query = {sort: "p", order: "asc", page: 1, pages: 1};
+   let request = 0;
 
-      tableRows.forEach(tr => {
-         tr.classList.remove("is-hidden");
+   const loadScores = () => {
+      const params = new URLSearchParams({
+         sort: query.sort,
+         order: query.order,
+         page: query.page,
+         search: searchInput.value.trim(),
+         p_max: parseFloat(pValueInput.value) || 1,
+         q_max: parseFloat(qValueInput.value) || 1
+      });
+      const currentRequest = ++request;
+
+      fetch(resultTable.dataset.url + "?" + params)
+         .then(response => response.json())
+         .then(data => {
+            // ignore answers to outdated requests
+            if (currentRequest !== request || data.error) return;
+
+            query.pages = data.pages;
+            tableBody.innerHTML = "";
+
+            data.rows.forEach(row => {
+               const tr = document.createElement("tr");
+
+               columns.forEach(column => {
+                  const td = document.createElement(column.dataset.sort === "gene" ? "th" : "td");
+                  const value = row[column.dataset.sort];
+                  td.innerText = value === null || value === undefined ? "" : value;
+                  td.className = column.classList.contains("is-additional") ? "is-additional" : "";
+                  tr.appendChild(td);
+               });
 
-         const pValCell = tr.querySelector(".results-table__p");
-         if (!pValCell) {
-            if (tr.previousElementSibling.classList.contains("is-hidden")){
-               tr.classList.add("is-hidden");
-            }
-            return;
+               tableBody.appendChild(tr);
+            });
+
+            pageInfo.innerText = `${data.count} genes, page ${data.page} of ${data.pages}`;
+            previousButton.disabled = data.page <= 1;
+            nextButton.disabled = data.page >= data.pages;
+         });
+   };
+
+   columns.forEach(column => {
+      column.addEventListener("click", () => {
+         if (query.sort === column.dataset.sort) {
+            query.order = query.order === "asc" ? "desc" : "asc";
+         } else {
+            query.sort = column.dataset.sort;
+            query.order = "asc";
          }
 
-         if (parseFloat(pValCell.innerText) <= pVal) return;
+         columns.forEach(c => c.classList.remove("is-sorted"));
+         column.classList.add("is-sorted");
+         query.page = 1;
+         loadScores();
+      });
+   });
 
-         tr.classList.add("is-hidden");
+   [searchInput, pValueInput, qValueInput].forEach(input => {
+      input.addEventListener("keyup", () => {
+         query.page = 1;
+         loadScores();
       });
    });
+
+   previousButton.addEventListener("click", () => {
+      query.page = Math.max(query.page - 1, 1);
+      loadScores();
+   });
+
+   nextButton.addEventListener("click", () => {
+      query.page = Math.min(query.page + 1, query.pages);
+      loadScores();
+   });
+
+   loadScores();
+}
+
+function initQQPlots() {
+   const figures = [].slice.call(document.querySelectorAll(".project-image[data-points]"));
+   const svgNS = "http://www.w3.org/2000/svg";
+   const size = 400;
+   const margin = 40;
+
+   const createElement = (name, attributes) => {
+      const element = document.createElementNS(svgNS, name);
+      Object.keys(attributes).forEach(key => element.setAttribute(key, attributes[key]));
+      return element;
+   };
+
+   figures.forEach(figure => {
+      fetch(figure.dataset.points)
+         .then(response => response.json())
+         .then(points => {
+            const upper = Math.ceil(Math.max(0, ...points.expected, ...points.observed) + 0.5);
+            const scale = value => margin + value / upper * (size - 2 * margin);
+            const svg = createElement("svg", {viewBox: `0 0 ${size} ${size}`, class: "qq-plot"});
+
+            svg.appendChild(createElement("line", {
+               x1: scale(0), y1: size - scale(0), x2: scale(upper), y2: size - scale(upper), stroke: "dimgrey"
+            }));
+
+            points.expected.forEach((expected, i) => {
+               const circle = createElement("circle", {
+                  cx: scale(expected), cy: size - scale(points.observed[i]), r: 3, fill: "royalblue"
+               });
+               const title = createElement("title", {});
+               const gene = points.genes[i] ? points.genes[i] + ": " : "";
+               title.textContent = `${gene}expected ${expected}, observed ${points.observed[i]}`;
+               circle.appendChild(title);
+               svg.appendChild(circle);
+            });
+
+            const xLabel = createElement("text", {x: size / 2, y: size - 8, "text-anchor": "middle"});
+            xLabel.textContent = "-log10(p_exp)";
+            const yLabel = createElement("text", {
+               x: 12, y: size / 2, "text-anchor": "middle", transform: `rotate(-90 12 ${size / 2})`
+            });
+            yLabel.textContent = "-log10(p_obs)";
+            svg.appendChild(xLabel);
+            svg.appendChild(yLabel);
+
+            // keep the png image if the points can't be drawn
+            figure.replaceChild(svg, figure.querySelector("img"));
+         });
+   });
+}
+
+// poll the progress every 2 s, waiting up to a minute while the server can't answer
+const PROGRESS_INTERVAL = 2000;
+const PROGRESS_MAX_INTERVAL = 60000;
+
+function initProgress() {
+   const progress = document.querySelector(".project-header__progress");
+   if (!progress) return;
+
+   let interval = PROGRESS_INTERVAL;
+
+   const show = data => {
+      const isNew = data.updated > parseFloat(progress.dataset.rendered);
+
+      // show the new state and actions once the project state changed or a job finished
+      if (isNew && ((data.state && data.state !== progress.dataset.state) || data.job_state === "done")) {
+         window.location.reload();
+         return false;
+      }
+
+      if (data.stage) {
+         let text = data.stage;
+         if (data.percent !== undefined && data.percent !== null) text += `: ${Math.round(data.percent)}%`;
+         if (data.records) text += ` (${data.records} records)`;
+         progress.innerText = text;
+      }
+      return true;
+   };
+
+   const poll = () => {
+      fetch(progress.dataset.url, {cache: "no-store"})
+         .then(response => {
+            if (!response.ok) throw new Error(response.statusText);
+            return response.json();
+         })
+         .then(data => {
+            interval = PROGRESS_INTERVAL;
+            if (show(data)) setTimeout(poll, interval);
+         })
+         .catch(() => {
+            interval = Math.min(interval * 2, PROGRESS_MAX_INTERVAL);
+            setTimeout(poll, interval);
+         });
+   };
+
+   poll();
 }
@@ -1,5 +1,37 @@
 from django.contrib import admin
-from .models import BackgroundSet
+from .models import Artifact, BackgroundSet, BackgroundJob, JobMetrics
 
 
-admin.site.register(BackgroundSet)
+class JobMetricsInline(admin.StackedInline):
+    model = JobMetrics
+    can_delete = False
+    readonly_fields = [field.name for field in JobMetrics._meta.fields]
+
+
+@admin.register(BackgroundJob)
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ["name", "project", "state", "created"]
+    list_filter = ["name", "state"]
+    inlines = [JobMetricsInline]
+
+
+@admin.register(JobMetrics)
+class JobMetricsAdmin(admin.ModelAdmin):
+    list_display = ["job", "started", "queue_latency", "wall_time", "cpu_time", "subprocess_time", "peak_rss",
+                    "bytes_read", "bytes_written"]
+    list_filter = ["job__name", "job__project__background"]
+    list_select_related = ["job"]
+
+
+@admin.register(BackgroundSet)
+class BackgroundSetAdmin(admin.ModelAdmin):
+    list_display = ["name", "reference", "variants", "built"]
+    # the annotation version and reference can be set for sets registered before they were recorded
+    readonly_fields = ["sidecar_file", "variants", "built"]
+
+
+@admin.register(Artifact)
+class ArtifactAdmin(admin.ModelAdmin):
+    list_display = ["path", "project", "stage", "size", "compressed", "created"]
+    list_filter = ["stage", "compressed"]
+    readonly_fields = [field.name for field in Artifact._meta.fields]
@@ -0,0 +1,171 @@
+import os
+import sqlite3
+import sys
+import time
+
+from .functions import get_sites, join_annotations, read_sites, write_keys, annotate_sites, read_annotations, \
+    write_annotated_sites
+from .instrumentation import prometheus_client
+
+if prometheus_client:
+    CACHE_LOOKUPS = prometheus_client.Counter(
+        "variantenrichment_annotation_cache_lookups", "Variants looked up in the annotation cache", ["result"])
+
+# number of variants stored with one query
+BATCH_SIZE = 500
+
+
+def get_annotation_version(*files):
+    """ identifies the files of the annotation databases, so copies can be refreshed when they change
+        :param files: jannovar database, gnomad vcf, ...
+        :return: string with names, sizes and modification times of the files (only names of missing files)
+    """
+    versions = []
+    for file in files:
+        if not os.path.exists(file):
+            versions.append(os.path.basename(file))
+            continue
+        stat = os.stat(file)
+        versions.append("%s:%d:%d" % (os.path.basename(file), stat.st_size, int(stat.st_mtime)))
+    return "|".join(versions)
+
+
+class AnnotationCache:
+    """ Annotations of variants shared between projects, stored in a SQLite file:
+        the INFO fields jannovar adds (ANN, GNOMAD_EXOMES_*) by variant and version of the annotation databases.
+        The least recently used variants are removed when the cache holds more than max_entries variants.
+        :param cache_file: SQLite file, created if missing
+        :param version: version of the annotation databases, see references.get_annotation_db_version
+        :param max_entries: maximal number of cached variants of all versions
+    """
+    def __init__(self, cache_file, version, max_entries=5000000):
+        self.version = version
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # several workers use the cache at the same time
+        self.connection = sqlite3.connect(cache_file, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS annotation (
+                    chrom TEXT, pos INTEGER, ref TEXT, alt TEXT, version TEXT, info TEXT, used INTEGER,
+                    PRIMARY KEY (chrom, pos, ref, alt, version)
+                )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS annotation_used ON annotation (used)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS header (version TEXT PRIMARY KEY, lines TEXT)")
+            # keys looked up by get, only seen by this connection
+            self.connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS lookup (chrom TEXT, pos INTEGER, ref TEXT, alt TEXT)")
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, keys):
+        """ looks up variants and marks the found ones as used
+            :param keys: list of (chrom, pos, ref, alt)
+            :return: dictionary {(chrom, pos, ref, alt): annotation INFO fields} of the cached variants
+        """
+        found = {}
+        now = int(time.time())
+
+        with self.connection:
+            # joined with the looked up keys, a query with parameters for all keys would exceed the
+            # limit of 999 variables of SQLite before 3.32
+            self.connection.execute("DELETE FROM lookup")
+            self.connection.executemany("INSERT INTO lookup VALUES (?, ?, ?, ?)", keys)
+            rows = self.connection.execute(
+                "SELECT DISTINCT annotation.rowid, annotation.chrom, annotation.pos, annotation.ref, annotation.alt, "
+                "annotation.info FROM lookup JOIN annotation ON annotation.chrom = lookup.chrom "
+                "AND annotation.pos = lookup.pos AND annotation.ref = lookup.ref AND annotation.alt = lookup.alt "
+                "AND annotation.version = ?", (self.version,)).fetchall()
+            self.connection.execute("DELETE FROM lookup")
+
+            self.connection.executemany("UPDATE annotation SET used = ? WHERE rowid = ?",
+                                        [(now, row[0]) for row in rows])
+            found.update({tuple(row[1:5]): row[5] for row in rows})
+
+        hits = len(found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        if prometheus_client:
+            CACHE_LOOKUPS.labels("hit").inc(hits)
+            CACHE_LOOKUPS.labels("miss").inc(len(keys) - hits)
+
+        return found
+
+    def put(self, annotations):
+        """ stores annotations and evicts the least recently used variants above max_entries
+            :param annotations: dictionary {(chrom, pos, ref, alt): annotation INFO fields}
+        """
+        now = int(time.time())
+        rows = [key + (self.version, info, now) for key, info in annotations.items()]
+
+        with self.connection:
+            for start in range(0, len(rows), BATCH_SIZE):
+                self.connection.executemany("INSERT OR REPLACE INTO annotation VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                            rows[start:start + BATCH_SIZE])
+            self.evict()
+
+    def evict(self):
+        excess = self.connection.execute("SELECT COUNT(*) FROM annotation").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.connection.execute("DELETE FROM annotation WHERE rowid IN "
+                                    "(SELECT rowid FROM annotation ORDER BY used LIMIT ?)", (excess,))
+
+    def get_header(self):
+        """ :return: list of the header lines jannovar adds or None if nothing was annotated with this version """
+        row = self.connection.execute("SELECT lines FROM header WHERE version = ?", (self.version,)).fetchone()
+        return row[0].splitlines(keepends=True) if row else None
+
+    def put_header(self, lines):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO header VALUES (?, ?)", (self.version, "".join(lines)))
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def annotate_sample_cached(vcf_file, fasta_file, gnomad_file, db_file, output_file, cache):
+    """ annotates the variant file like annotate_sample, but only the sites missing in the cache
+        are annotated by jannovar
+        :param vcf_file: variant file
+        :param fasta_file: reference fasta file for annotating
+        :param gnomad_file: vcf with gnomad exomes
+        :param db_file: reference database
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :param cache: AnnotationCache
+        :return: output file name with the right extension
+    """
+    sites_file = get_sites(vcf_file, output_file + ".sites")
+    header, keys = read_sites(sites_file)
+
+    annotations = cache.get(keys)
+    missing = list(dict.fromkeys(key for key in keys if key not in annotations))
+    added_header = cache.get_header()
+
+    if missing or added_header is None:
+        missing_file = write_keys(missing, header, output_file + ".missing")
+        annotated_missing = annotate_sites(missing_file, fasta_file, gnomad_file, db_file,
+                                           output_file + ".missing.annotated")
+
+        new_annotations, added_header = read_annotations(annotated_missing, header)
+        cache.put_header(added_header)
+        cache.put(new_annotations)
+        annotations.update(new_annotations)
+
+        os.remove(missing_file)
+        os.remove(annotated_missing)
+
+    print("Annotation cache: %d of %d variants cached" % (len(keys) - len(missing), len(keys)), file=sys.stderr)
+
+    annotated_file = write_annotated_sites(sites_file, annotations, added_header, output_file + ".sites.annotated")
+    joined = join_annotations(vcf_file=vcf_file, sites_file=annotated_file, output_file=output_file)
+
+    os.remove(sites_file)
+    os.remove(annotated_file)
+
+    return joined
@@ -0,0 +1,180 @@
+import json
+import os
+import queue
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .functions import read_sites, write_keys, run_jannovar, read_annotations, write_annotated_sites
+from .instrumentation import prometheus_client
+
+if prometheus_client:
+    BATCH_SIZE = prometheus_client.Histogram(
+        "variantenrichment_annotation_batch_requests", "Requests annotated by one jannovar run",
+        buckets=(1, 2, 5, 10, 20, 50))
+
+# message fields naming the annotation files, requests with the same files can share a jannovar run
+FILE_FIELDS = ["fasta_file", "gnomad_file", "db_file"]
+
+
+class AnnotationRequest:
+    """ request of one connection, answered when its batch is annotated """
+    def __init__(self, message):
+        self.input = message["input"]
+        self.output = message["output"]
+        self.files = tuple(message[field] for field in FILE_FIELDS)
+        self.answer = None
+        self.done = threading.Event()
+
+    def finish(self, answer):
+        self.answer = answer
+        self.done.set()
+
+
+def annotate_batch(requests, files, directory):
+    """ annotates the sites of several requests with one jannovar run, every variant once,
+        and writes the annotated sites file of every request
+        :param requests: list of AnnotationRequest with the same files
+        :param files: (fasta file, gnomad file, jannovar database)
+        :param directory: directory for the temporary files
+    """
+    header, keys = None, {}
+    for request in requests:
+        request_header, request_keys = read_sites(request.input)
+        header = header or request_header
+        keys.update(dict.fromkeys(request_keys))
+
+    batch_dir = tempfile.mkdtemp(dir=directory)
+    try:
+        batch_file = write_keys(sorted(keys, key=lambda key: key[:2]), header, os.path.join(batch_dir, "batch"))
+        annotated = run_jannovar(batch_file, *files, output_file=os.path.join(batch_dir, "batch.annotated"))
+        # the INFO fields of the first request are not annotations
+        annotations, added_header = read_annotations(annotated, header)
+    finally:
+        shutil.rmtree(batch_dir)
+
+    for request in requests:
+        request.finish({
+            "ok": True,
+            "output": write_annotated_sites(request.input, annotations, added_header, request.output)
+        })
+
+
+class AnnotationHandler(socketserver.StreamRequestHandler):
+    """ reads one json request per connection:
+        {"input": sites file, "output": output file WITHOUT SUFFICES, "fasta_file", "gnomad_file", "db_file"}
+        and answers {"ok": true, "output": annotated file} or {"ok": false, "error": message}
+    """
+    def handle(self):
+        try:
+            request = AnnotationRequest(json.loads(self.rfile.readline()))
+        except (ValueError, KeyError) as e:
+            return self.send({"ok": False, "error": "invalid request: %s" % e})
+
+        if not self.server.submit(request):
+            return self.send({"ok": False, "error": "too many pending requests"})
+
+        # the batch is still annotated, but the job runs jannovar itself
+        if not request.done.wait(self.server.request_timeout):
+            return self.send({"ok": False, "error": "not annotated within %d s" % self.server.request_timeout})
+        self.send(request.answer)
+
+    def send(self, answer):
+        self.wfile.write(json.dumps(answer).encode() + b"\n")
+
+
+class AnnotationDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Annotates the sites files of many jobs with few jannovar runs: requests arriving while all jannovar
+        processes are busy are annotated together, so they share the startup of one jannovar process and
+        the loading of its database. Every batch still starts a new jannovar process, the database is not
+        kept loaded between batches; a request arriving while a process is free starts at once.
+        :param socket_path: unix socket to listen on
+        :param concurrency: maximal number of jannovar processes at the same time
+        :param batch_window: seconds to wait for more requests once a process is free, none by default
+        :param max_batch: maximal number of requests of a batch
+        :param max_pending: requests waiting beyond this number are refused, their jobs run jannovar themselves
+        :param request_timeout: seconds a connection waits for its batch before it is answered with an error
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, concurrency=2, batch_window=0.0, max_batch=20, max_pending=100,
+                 request_timeout=3600):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, AnnotationHandler)
+
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.request_timeout = request_timeout
+        # requests not answered yet, waiting or being annotated
+        self.unanswered = 0
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        # free jannovar processes, taken by dispatch and given back when a batch is annotated
+        self.free = threading.Semaphore(concurrency)
+        self.directory = tempfile.mkdtemp(prefix="annotation_daemon_")
+        threading.Thread(target=self.dispatch, daemon=True).start()
+
+    def submit(self, request):
+        with self.lock:
+            if self.unanswered >= self.max_pending:
+                return False
+            self.unanswered += 1
+
+        self.pending.put(request)
+        return True
+
+    def dispatch(self):
+        """ collects the pending requests into batches and hands them to the jannovar processes """
+        while True:
+            batch = [self.pending.get()]
+            # the requests arriving until a process is free join the batch
+            self.free.acquire()
+            deadline = time.monotonic() + self.batch_window
+
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.pending.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.files, []).append(request)
+
+            for i, (files, requests) in enumerate(groups.items()):
+                if i > 0:
+                    self.free.acquire()
+                self.executor.submit(self.annotate, requests, files)
+
+    def annotate(self, requests, files):
+        start = time.monotonic()
+        try:
+            annotate_batch(requests, files, self.directory)
+            if prometheus_client:
+                BATCH_SIZE.observe(len(requests))
+            print("annotated %d requests in %.1f s" % (len(requests), time.monotonic() - start), file=sys.stderr)
+
+        except Exception as e:
+            print("annotation of %d requests failed: %s" % (len(requests), e), file=sys.stderr)
+            for request in requests:
+                if not request.done.is_set():
+                    request.finish({"ok": False, "error": str(e)})
+
+        finally:
+            self.free.release()
+            with self.lock:
+                self.unanswered -= len(requests)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
@@ -0,0 +1,200 @@
+import hashlib
+import os
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Max, Sum
+from django.utils import timezone
+
+from .context import set_project_state
+from .instrumentation import run_command
+from .io_threads import bgzip_threads
+from .models import Artifact, Project, ProjectFiles, JobMetrics
+from .processes import FILES_DIR
+
+# fields of ProjectFiles naming files the project pages and later stages use, the other files are intermediates
+KEPT_FIELDS = ["case_annotated", "case_filtered", "control_filtered", "cadd_case", "cadd_control", "case_csv",
+               "control_csv", "scores_csv", "scores_table", "qq_plot", "qq_plot_syn", "qq_plot_points",
+               "qq_plot_syn_points"]
+INDEX_SUFFIXES = [".tbi", ".csi"]
+# text files worth compressing, the others are deleted or kept as they are
+COMPRESSIBLE_SUFFIXES = [".vcf", ".csv", ".tsv", ".txt"]
+
+
+def get_project_directory(project: Project):
+    return FILES_DIR + str(project.pk)
+
+
+def file_checksum(file):
+    """ :return: sha256 hex digest of the file, read in chunks """
+    checksum = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def get_modified(file):
+    return datetime.fromtimestamp(os.stat(file).st_mtime, tz=timezone.utc)
+
+
+def list_project_files(project: Project):
+    """ :return: all files in the project directory, with paths in the form stored in ProjectFiles """
+    files = []
+    for directory, _, names in os.walk(get_project_directory(project)):
+        files += [os.path.join(directory, name) for name in names]
+    return files
+
+
+def get_kept_files(project: Project):
+    """ :return: set of the files which are no intermediates: the files in ProjectFiles with their indexes
+        and the profiles of the jobs
+    """
+    kept = set()
+    project_files = ProjectFiles.objects.filter(project=project).values(*KEPT_FIELDS).first() or {}
+    for file in project_files.values():
+        if file:
+            kept.update(os.path.normpath(file + suffix) for suffix in [""] + INDEX_SUFFIXES)
+
+    kept.update(os.path.normpath(profile) for profile in JobMetrics.objects.filter(
+        job__project=project, profile__gt="").values_list("profile", flat=True))
+    return kept
+
+
+def register_artifacts(project: Project, stage):
+    """ records the files of the project directory which are new or changed since the last registration
+        as produced by the stage, and forgets the files which are gone
+    :param stage: name of the background job which ran last
+    :return: list of the new or changed Artifact objects
+    """
+    artifacts = {artifact.path: artifact for artifact in Artifact.objects.filter(project=project)}
+    changed = []
+
+    for file in list_project_files(project):
+        path = os.path.normpath(file)
+        modified = get_modified(file)
+        artifact = artifacts.pop(path, None)
+        if artifact and artifact.modified == modified and artifact.size == os.path.getsize(file):
+            continue
+
+        artifact = artifact or Artifact(project=project, path=path)
+        artifact.stage, artifact.modified = stage, modified
+        artifact.size, artifact.checksum = os.path.getsize(file), file_checksum(file)
+        artifact.compressed = path.endswith(".gz")
+        artifact.save()
+        changed.append(artifact)
+
+    Artifact.objects.filter(pk__in=[artifact.pk for artifact in artifacts.values()]).delete()
+    return changed
+
+
+def delete_artifact(artifact: Artifact):
+    """ removes the file of the artifact and the artifact
+    :return: number of bytes freed
+    """
+    if os.path.exists(artifact.path):
+        os.remove(artifact.path)
+    artifact.delete()
+    return artifact.size
+
+
+def compress_artifact(artifact: Artifact):
+    """ replaces the file of the artifact with its bgzip compressed version, readable with gzip and tabix
+    :return: number of bytes freed
+    """
+    if artifact.compressed or os.path.splitext(artifact.path)[1] not in COMPRESSIBLE_SUFFIXES:
+        return 0
+
+    run_command([
+        "bgzip", "-f", *bgzip_threads(), artifact.path
+    ], check=True)
+
+    size = artifact.size
+    artifact.path = artifact.path + ".gz"
+    artifact.size, artifact.checksum = os.path.getsize(artifact.path), file_checksum(artifact.path)
+    artifact.modified, artifact.compressed = get_modified(artifact.path), True
+    artifact.save()
+    return size - artifact.size
+
+
+def get_intermediates(project: Project):
+    """ :return: artifacts of the project which are not kept, oldest first """
+    kept = get_kept_files(project)
+    return [artifact for artifact in Artifact.objects.filter(project=project).order_by("created", "pk")
+            if artifact.path not in kept]
+
+
+def apply_artifact_policy(project: Project, policy=None):
+    """ compresses or deletes the intermediates of a project after its pipeline finished
+    :param policy: "keep", "compress" or "delete", settings.ARTIFACT_POLICY by default
+    :return: number of bytes freed
+    """
+    policy = policy or settings.ARTIFACT_POLICY
+    if policy == "keep":
+        return 0
+
+    handle = delete_artifact if policy == "delete" else compress_artifact
+    return sum(handle(artifact) for artifact in get_intermediates(project))
+
+
+def remove_intermediate_files(project: Project):
+    """ deletes all files of the project directory which are no longer kept, registered or not """
+    kept = get_kept_files(project)
+    for file in list_project_files(project):
+        if os.path.normpath(file) not in kept:
+            os.remove(file)
+    Artifact.objects.filter(project=project).exclude(path__in=kept).delete()
+
+
+def is_idle(project: Project):
+    return project.state not in Project.PROCESSING_STATES and \
+        not project.backgroundjob_set.filter(state__in=["new", "running"]).exists()
+
+
+def evict_project(project: Project):
+    """ deletes all files of a project, it has to be processed again from the start
+    :return: number of bytes freed
+    """
+    freed = sum(delete_artifact(artifact) for artifact in Artifact.objects.filter(project=project))
+    ProjectFiles.objects.filter(project=project).update(**{field: "" for field in KEPT_FIELDS})
+    remove_intermediate_files(project)
+    set_project_state(project, "initial")
+    return freed
+
+
+def collect_garbage(project_quota=None, global_quota=None):
+    """ keeps the disk use of idle projects within the quotas: deletes the oldest intermediates of projects
+        above the project quota, then above the global quota the intermediates and at last all files
+        of the projects which were not worked on for the longest time
+    :param project_quota: bytes per project, settings.ARTIFACT_PROJECT_QUOTA by default
+    :param global_quota: bytes of all projects, settings.ARTIFACT_GLOBAL_QUOTA by default
+    :return: number of bytes freed
+    """
+    project_quota = project_quota or settings.ARTIFACT_PROJECT_QUOTA
+    global_quota = global_quota or settings.ARTIFACT_GLOBAL_QUOTA
+    freed = 0
+
+    # least recently worked on first
+    projects = [project for project in Project.objects.filter(artifact__isnull=False).annotate(
+        used=Sum("artifact__size"), last_artifact=Max("artifact__created")).order_by("last_artifact")
+        if is_idle(project)]
+
+    for project in projects:
+        used = project.used
+        for artifact in get_intermediates(project):
+            if used <= project_quota:
+                break
+            used -= delete_artifact(artifact)
+        freed += project.used - used
+
+    used = Artifact.objects.aggregate(used=Sum("size"))["used"] or 0
+    for evict in [lambda project: sum(delete_artifact(artifact) for artifact in get_intermediates(project)),
+                  evict_project]:
+        for project in projects:
+            if used <= global_quota:
+                return freed
+            evicted = evict(project)
+            used -= evicted
+            freed += evicted
+
+    return freed
@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+
+from .functions import open_vcf, get_annotated_genes
+from .instrumentation import RecordMeter, run_command
+from .io_threads import get_io_threads
+
+# INFO fields the filters need in a background set
+REQUIRED_INFO = ["ANN", "GNOMAD_EXOMES_AF_ALL"]
+
+
+class BackgroundError(Exception):
+    pass
+
+
+def normalize_background(vcf_file, output_file, threads=None):
+    """ sorts and normalizes a background vcf file without changing it, like normalize_sample does for case files
+        :param vcf_file: variant file
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :param threads: compression threads of bcftools, the I/O thread share of the job by default
+        :return: output file name with the right extension
+    """
+    run_command([
+        "bcftools", "sort", "-Oz", "-o", output_file + ".sorted.vcf.gz", vcf_file
+    ], check=True)
+
+    run_command([
+        "bcftools", "norm", "-d", "none", "--threads", str(threads or get_io_threads()), "-Oz",
+        "-o", output_file + ".vcf.gz", output_file + ".sorted.vcf.gz"
+    ], check=True)
+
+    run_command([
+        "rm", output_file + ".sorted.vcf.gz"
+    ])
+
+    return output_file + ".vcf.gz"
+
+
+def get_carriers(genotypes):
+    """ :param genotypes: list of the sample columns of a vcf record with GT as the first format field
+        :return: numpy bool array, True for the samples carrying an alternative allele
+    """
+    alleles = [sample.split(":", 1)[0].replace("|", "/").split("/") for sample in genotypes]
+    return np.array([any(allele not in ("0", ".") for allele in sample) for sample in alleles], dtype=bool)
+
+
+def write_background_sidecar(vcf_file, samples_file, output_file, meter=None):
+    """ validates an annotated background vcf file in one pass and stores its variants as a compressed
+        columnar numpy archive, with the carriers of every variant as a bitset of the samples
+        :param vcf_file: jannovar annotated background vcf file
+        :param samples_file: tab delimited file with "Sample name" and "Superpopulation code" columns
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :param meter: RecordMeter to report progress to
+        :return: tuple (output file name with the right extension, number of variants)
+    """
+    samples_df = pd.read_csv(samples_file, delimiter="\t", header=0, index_col=None)
+    for column in ("Sample name", "Superpopulation code"):
+        if column not in samples_df.columns:
+            raise BackgroundError("%s has no %s column" % (samples_file, column))
+
+    columns = {name: [] for name in ("chrom", "pos", "ref", "alt", "af", "genes")}
+    carriers = []
+    info_ids = set()
+    samples = []
+    meter = meter or RecordMeter("write_background_sidecar")
+
+    with open_vcf(vcf_file) as vcf:
+        meter.attach(vcf_file, vcf)
+
+        for line in vcf:
+            if line.startswith("##INFO=<ID="):
+                info_ids.add(line[len("##INFO=<ID="):].split(",", 1)[0])
+                continue
+            if line.startswith("#CHROM"):
+                samples = line.rstrip("\n").split("\t")[9:]
+                missing = [info for info in REQUIRED_INFO if info not in info_ids]
+                if missing:
+                    raise BackgroundError("%s is not annotated, %s missing in the header" % (vcf_file, missing))
+                continue
+            if line.startswith("#"):
+                continue
+
+            fields = line.rstrip("\n").split("\t")
+            info = dict(field.split("=", 1) for field in fields[7].split(";") if "=" in field)
+            if not fields[8].startswith("GT"):
+                raise BackgroundError("%s:%s has no GT as first format field" % (fields[0], fields[1]))
+
+            columns["chrom"].append(fields[0])
+            columns["pos"].append(int(fields[1]))
+            columns["ref"].append(fields[3])
+            columns["alt"].append(fields[4])
+            af = info.get("GNOMAD_EXOMES_AF_ALL", ".").split(",")[0]
+            columns["af"].append(float(af) if af != "." else np.nan)
+            annotations = info["ANN"].split(",") if "ANN" in info else []
+            columns["genes"].append(",".join(sorted(get_annotated_genes(annotations))))
+            carriers.append(np.packbits(get_carriers(fields[9:])))
+
+            meter.update()
+
+    meter.finish()
+
+    unknown = set(samples) - set(samples_df["Sample name"])
+    if unknown:
+        raise BackgroundError("%d samples of %s are missing in %s, e.g. %s" % (
+            len(unknown), vcf_file, samples_file, sorted(unknown)[0]))
+    if not columns["pos"]:
+        raise BackgroundError("%s has no variants" % vcf_file)
+
+    np.savez_compressed(output_file + ".npz",
+                        samples=np.array(samples, dtype=str),
+                        chrom=np.array(columns["chrom"], dtype=str),
+                        pos=np.array(columns["pos"], dtype=np.int64),
+                        ref=np.array(columns["ref"], dtype=str),
+                        alt=np.array(columns["alt"], dtype=str),
+                        af=np.array(columns["af"], dtype=np.float32),
+                        genes=np.array(columns["genes"], dtype=str),
+                        carriers=np.vstack(carriers))
+
+    return output_file + ".npz", len(columns["pos"])
+
+
+def load_carriers(sidecar_file, samples=None):
+    """ :param sidecar_file: archive written by write_background_sidecar
+        :param samples: names of the samples to include, all by default
+        :return: tuple (dictionary {column name: numpy array} of the variants,
+                 numpy bool matrix variants x samples with True for carriers, list of sample names)
+    """
+    with np.load(sidecar_file, allow_pickle=False) as archive:
+        variants = {column: archive[column] for column in ("chrom", "pos", "ref", "alt", "af", "genes")}
+        names = list(archive["samples"])
+        carriers = np.unpackbits(archive["carriers"], axis=1, count=len(names)).astype(bool)
+
+    if samples is not None:
+        index = [names.index(sample) for sample in samples]
+        carriers, names = carriers[:, index], list(samples)
+
+    return variants, carriers, names
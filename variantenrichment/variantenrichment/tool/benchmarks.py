@@ -0,0 +1,231 @@
+""" Benchmarks of the pipeline stages and of the whole processing chain on synthetic data,
+    they are not collected with the tests, run them with:
+
+        pytest variantenrichment/tool/benchmarks.py --benchmark-json=benchmarks/<version>.json
+
+    and compare two versions with:
+
+        pytest-benchmark compare benchmarks/<old>.json benchmarks/<new>.json
+
+    The size of the synthetic cohort is set with the environment variables
+    BENCHMARK_SAMPLES, BENCHMARK_GENES and BENCHMARK_VARIANTS_PER_GENE.
+    Jannovar is replaced by a stand-in copying its input and CADD by locally generated scores,
+    stages calling bcftools/tabix/bgzip are skipped if those are not installed.
+"""
+import os
+import shutil
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from variantenrichment.tool import context, processes
+from variantenrichment.tool.burden import find_burden_scores
+from variantenrichment.tool.context import JobContext
+from variantenrichment.tool.functions import normalize_sample, annotate_sample, filter_by_frequency, \
+    filter_by_impact, filter_file, count_variants, add_cadd_annotations, filter_by_cadd, find_fisher_scores, \
+    correct_p_values, find_permutation_scores, visualize_p_values
+from variantenrichment.tool.models import BackgroundSet, Project, VariantFile, ProjectStatistics
+from variantenrichment.tool.references import get_annotation_db_version, get_bundle
+from variantenrichment.tool.results import save_scores_table
+from variantenrichment.tool.synthetic import make_gene_names, make_gene_model, generate_variants, write_vcf, \
+    write_inheritance_file, write_cadd_file, install_tool_stubs, has_tools
+
+SAMPLES = int(os.environ.get("BENCHMARK_SAMPLES", 200))
+GENES = int(os.environ.get("BENCHMARK_GENES", 500))
+VARIANTS_PER_GENE = int(os.environ.get("BENCHMARK_VARIANTS_PER_GENE", 10))
+# the background set is usually larger than the case cohort
+CONTROL_FACTOR = 5
+
+requires_tools = pytest.mark.skipif(not has_tools("bcftools", "bgzip", "tabix"),
+                                    reason="bcftools, bgzip and tabix are needed")
+
+
+@pytest.fixture(scope="module")
+def cohort(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("cohort")
+    genes = make_gene_names(GENES, seed=0)
+    gene_model = make_gene_model(genes)
+    enriched_genes = list(genes)[:max(GENES // 50, 1)]
+
+    # case and control share the variants (same seed) but not the genotypes
+    case = write_vcf(str(directory / "case"), generate_variants(gene_model, VARIANTS_PER_GENE, seed=1),
+                     SAMPLES, "case", seed=2, enriched_genes=enriched_genes, effect_size=5.0)
+    control = write_vcf(str(directory / "control"), generate_variants(gene_model, VARIANTS_PER_GENE, seed=1),
+                        SAMPLES * CONTROL_FACTOR, "control", seed=3)
+
+    return SimpleNamespace(
+        directory=directory,
+        genes=genes,
+        inheritance=write_inheritance_file(genes, str(directory / "inheritance")),
+        case=case,
+        control=control,
+        case_cadd=write_cadd_file(case, str(directory / "case.cadd"), seed=4),
+        control_cadd=write_cadd_file(control, str(directory / "control.cadd"), seed=5)
+    )
+
+
+@pytest.fixture(scope="module")
+def counts(cohort):
+    output = str(cohort.directory / "counts")
+    os.makedirs(output, exist_ok=True)
+    case_csv = count_variants(cohort.case, cohort.genes, output + "/case")
+    control_csv = count_variants(cohort.control, cohort.genes, output + "/control")
+    scores = find_fisher_scores(case_csv, control_csv, output + "/scores")
+    correct_p_values(scores)
+
+    return SimpleNamespace(case_csv=case_csv, control_csv=control_csv, scores=scores)
+
+
+@pytest.fixture
+def output(tmp_path):
+    return str(tmp_path / "output")
+
+
+@requires_tools
+def test_normalize_sample(benchmark, cohort, tmp_path, output):
+    def setup():
+        vcf_file = str(tmp_path / "input.vcf")
+        shutil.copy(cohort.case, vcf_file)
+        return (vcf_file, output), {}
+
+    benchmark.pedantic(normalize_sample, setup=setup, rounds=5)
+
+
+@requires_tools
+def test_annotate_sample(benchmark, cohort, tmp_path, monkeypatch, output):
+    monkeypatch.setenv("PATH", install_tool_stubs(str(tmp_path / "bin")) + os.pathsep + os.environ["PATH"])
+
+    rounds = iter(range(1000))
+
+    def setup():
+        # tabix refuses to overwrite the index of the previous round
+        return (cohort.case, "", "", "", "%s.%d" % (output, next(rounds))), {}
+
+    benchmark.pedantic(annotate_sample, setup=setup, rounds=5)
+
+
+@requires_tools
+def test_filter_by_frequency(benchmark, cohort, output):
+    benchmark(filter_by_frequency, cohort.control, frequency=0.001, output_file=output)
+
+
+@requires_tools
+def test_filter_by_impact(benchmark, cohort, output):
+    benchmark(filter_by_impact, cohort.control, impact="MODERATE", impact_mod="", genes_mod="", output_file=output)
+
+
+def test_filter_file(benchmark, cohort, output):
+    benchmark(filter_file, cohort.control, genes_names=cohort.genes.keys(), impact="MODERATE", impact_mod="",
+              output_file=output)
+
+
+def test_count_variants(benchmark, cohort, output):
+    benchmark(count_variants, cohort.control, genes=cohort.genes, output_file=output)
+
+
+def test_add_cadd_annotations(benchmark, cohort, output):
+    benchmark(add_cadd_annotations, cohort.control, cadd_file=cohort.control_cadd, output_file=output)
+
+
+@requires_tools
+def test_filter_by_cadd(benchmark, cohort, tmp_path, output):
+    annotated = add_cadd_annotations(cohort.control, cohort.control_cadd, str(tmp_path / "annotated"))
+
+    benchmark(filter_by_cadd, annotated, cadd_score=15, output_file=output)
+
+
+def test_find_fisher_scores(benchmark, counts, output):
+    benchmark(find_fisher_scores, counts.case_csv, counts.control_csv, output_file=output)
+
+
+def test_correct_p_values(benchmark, counts, tmp_path):
+    scores = str(tmp_path / "scores.csv")
+    shutil.copy(counts.scores, scores)
+
+    benchmark(correct_p_values, scores)
+
+
+def test_find_permutation_scores(benchmark, counts, tmp_path):
+    scores = str(tmp_path / "scores.csv")
+    shutil.copy(counts.scores, scores)
+
+    benchmark.pedantic(find_permutation_scores, args=(counts.case_csv, counts.control_csv, scores),
+                       kwargs={"permutations": 1000, "seed": 0}, rounds=3)
+
+
+@pytest.mark.parametrize("test_name", ["cmc", "skat"])
+def test_find_burden_scores(benchmark, cohort, counts, output, test_name):
+    benchmark.pedantic(find_burden_scores,
+                       args=(cohort.case, cohort.control, cohort.genes, counts.case_csv, counts.control_csv),
+                       kwargs={"test_name": test_name, "output_file": output}, rounds=3)
+
+
+def test_save_scores_table(benchmark, counts, output):
+    benchmark(save_scores_table, counts.scores, output_file=output)
+
+
+def test_visualize_p_values(benchmark, counts, output):
+    benchmark(visualize_p_values, counts.scores, output_file=output, lambda_gc=1.0)
+
+
+def run_pipeline(project: Project):
+    """ runs all stages the celery tasks run for a project, without the queue """
+    ctx = JobContext(project)
+    processes.assemble_case_sample(ctx)
+    processes.filter_samples_initial(ctx)
+    processes.check_quality(ctx)
+    processes.filter_samples_final(ctx)
+
+    if project.cadd_score:
+        processes.check_cadd(ctx)
+        processes.cadd_filter_samples(ctx)
+
+    processes.count_statistics(ctx)
+
+
+@requires_tools
+@pytest.mark.django_db
+@pytest.mark.parametrize("cadd_score", [None, 15])
+def test_pipeline(benchmark, cohort, tmp_path, monkeypatch, cadd_score):
+    # all pipeline paths are relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PATH", install_tool_stubs(str(tmp_path / "bin")) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setattr(processes, "publish_progress", lambda *args, **kwargs: None)
+    monkeypatch.setattr(context, "publish_progress", lambda *args, **kwargs: None)
+    # the CADD "id" of a posted file is its path, the scores are generated when they are fetched
+    monkeypatch.setattr(processes, "post_file_cadd", lambda vcf_file, cadd_version: vcf_file)
+    monkeypatch.setattr(processes, "save_cadd_file", lambda cadd_id, output_file: write_cadd_file(cadd_id,
+                                                                                                  output_file))
+
+    control = write_vcf(str(tmp_path / "control"), generate_variants(make_gene_model(cohort.genes),
+                                                                     VARIANTS_PER_GENE, seed=1),
+                        SAMPLES * CONTROL_FACTOR, "control", seed=3, compress=True)
+    background = BackgroundSet.objects.create(name="benchmark", file=control, samples_file="",
+                                              annotation_version=get_annotation_db_version(get_bundle("GRCh37")),
+                                              reference="GRCh37")
+
+    def setup():
+        project_uuid = uuid.uuid4()
+        media_dir = "variantenrichment/media/projects/%s" % project_uuid
+        os.makedirs(media_dir + "/vcf")
+        shutil.copy(cohort.inheritance, media_dir + "/inheritance.txt")
+
+        project = Project.objects.create(uuid=project_uuid,
+                                         title="benchmark",
+                                         background=background,
+                                         cadd_score=cadd_score,
+                                         inheritance="projects/%s/inheritance.txt" % project_uuid)
+
+        case = write_vcf(media_dir + "/vcf/case", generate_variants(make_gene_model(cohort.genes),
+                                                                    VARIANTS_PER_GENE, seed=1),
+                         SAMPLES, "case", seed=2, enriched_genes=list(cohort.genes)[:max(GENES // 50, 1)],
+                         effect_size=5.0, compress=True)
+        VariantFile.objects.create(project=project,
+                                   individual_name="case",
+                                   uploaded_file=os.path.relpath(case, "variantenrichment/media"))
+        return (project,), {}
+
+    benchmark.pedantic(run_pipeline, setup=setup, rounds=3)
+
+    assert ProjectStatistics.objects.filter(project__background=background).count() == 3
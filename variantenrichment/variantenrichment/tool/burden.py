@@ -0,0 +1,276 @@
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count
+import numpy as np
+import pandas as pd
+import vcfpy as vp
+import scipy.sparse as sparse
+import scipy.stats as stats
+
+# hom alt calls are counted twice, het calls once
+DOSAGES = {vp.HOM_REF: 0, vp.HET: 1, vp.HOM_ALT: 2}
+
+
+def get_dosages(record):
+    """ :return: int8 numpy array with the dosages of all samples of the record """
+    return np.fromiter((DOSAGES.get(call.gt_type, 0) for call in record.calls), dtype=np.int8,
+                       count=len(record.calls))
+
+
+def get_genotype_blocks(vcf_files, genes, cadd_weights=False):
+    """ reads per-variant genotype matrices for every gene from case and control files,
+        a variant shared between multiple genes is added to each of them,
+        variants missing in one of the files get wild genotypes for its samples;
+        the matrices are sparse, only the carriers of the rare variants are stored
+        :param vcf_files: list of jannovar annotated vcf files, e.g. [case, control]
+        :param genes: dictionary {gene name: gene inheritance info} with genes on which to look for variants
+        :param cadd_weights: use CADD PHRED scores from INFO/CADDPHRED as variant weights
+        :return: tuple (dictionary {gene name: (variants x samples int8 csr dosage matrix, variant weights)},
+            list with number of samples in every file)
+    """
+    # gene name: {variant key: row}, and the rows, columns and dosages of the carriers
+    variants = {gene: {} for gene in genes}
+    entries = {gene: ([], [], []) for gene in genes}
+    weights = {}
+    samples_num = []
+
+    for file_num, vcf_file in enumerate(vcf_files):
+        reader = vp.Reader.from_path(vcf_file)
+        offset = sum(samples_num)
+        samples_num.append(len(reader.header.samples.names))
+
+        for record in reader:
+            key = (record.CHROM, record.POS, record.REF, str(record.ALT[0].value))
+
+            if cadd_weights and key not in weights:
+                weights[key] = record.INFO.get("CADDPHRED")
+
+            record_genes = {ann.split('|')[3] for ann in record.INFO['ANN']}.intersection(genes)
+            if not record_genes:
+                continue
+
+            # read once for all genes of the record
+            dosages = get_dosages(record)
+            carriers = np.flatnonzero(dosages)
+            carrier_dosages = dosages[carriers]
+            homozygous = carrier_dosages == 2
+
+            for gene_name in record_genes:
+                row = variants[gene_name].setdefault(key, len(variants[gene_name]))
+                columns, values = carriers, carrier_dosages
+
+                # don't count heterozygous variants if they're inherited recessively
+                if genes[gene_name] != 'Autosomal dominant':
+                    columns, values = carriers[homozygous], carrier_dosages[homozygous]
+
+                rows, gene_columns, gene_values = entries[gene_name]
+                rows.append(np.full(len(columns), row, dtype=np.int32))
+                gene_columns.append(columns + offset)
+                gene_values.append(values)
+
+    cadd_scores = np.array([w for w in weights.values() if isinstance(w, (int, float))])
+    default_weight = np.median(cadd_scores) if len(cadd_scores) else 1.0
+
+    blocks = {}
+    for gene_name, gene_variants in variants.items():
+        rows, columns, values = (np.concatenate(parts) if parts else np.zeros(0, dtype=np.int8)
+                                 for parts in entries[gene_name])
+        matrix = sparse.csr_matrix((values.astype(np.int8), (rows, columns)),
+                                   shape=(len(gene_variants), sum(samples_num)), dtype=np.int8)
+        gene_weights = np.ones(len(gene_variants))
+
+        if cadd_weights:
+            for key, i in gene_variants.items():
+                weight = weights.get(key)
+                gene_weights[i] = weight if isinstance(weight, (int, float)) else default_weight
+
+        blocks[gene_name] = (matrix, gene_weights)
+
+    return blocks, samples_num
+
+
+def stack_blocks(blocks):
+    """ stacks genotype blocks of genes into a 3d array, padding them with wild type variants of zero weight
+        :param blocks: list of tuples (variants x samples dosage matrix, dense or sparse, variant weights)
+        :return: tuple (genes x samples x variants array, genes x variants weights)
+    """
+    max_variants = max(max(matrix.shape[0] for matrix, _ in blocks), 1)
+    samples_num = blocks[0][0].shape[1]
+
+    genotypes = np.zeros((len(blocks), samples_num, max_variants))
+    weights = np.zeros((len(blocks), max_variants))
+
+    for i, (matrix, gene_weights) in enumerate(blocks):
+        variants_num = matrix.shape[0]
+        genotypes[i, :, :variants_num] = (matrix.toarray() if sparse.issparse(matrix) else matrix).T
+        weights[i, :variants_num] = gene_weights
+
+    return genotypes, weights
+
+
+def cmc_test(genotypes, weights, phenotypes):
+    """ CMC burden test: collapses all rare variants of a gene into one carrier indicator
+        (or a weighted burden score if variant weights are not all equal)
+        and runs a score test for association with the phenotype
+        :param genotypes: genes x samples x variants dosage array
+        :param weights: genes x variants array of variant weights
+        :param phenotypes: numpy array with 1 for case and 0 for control samples
+        :return: numpy array with p values per gene
+    """
+    if np.all(weights[weights > 0] == 1):
+        burden = (genotypes.sum(axis=2) > 0).astype(np.float64)
+    else:
+        burden = np.matmul(genotypes, weights[:, :, np.newaxis])[:, :, 0]
+
+    residuals = phenotypes - phenotypes.mean()
+    score = burden @ residuals
+    variance = phenotypes.mean() * (1 - phenotypes.mean()) * \
+        ((burden - burden.mean(axis=1, keepdims=True)) ** 2).sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        chi2 = np.where(variance > 0, score ** 2 / variance, 0)
+
+    return stats.chi2.sf(chi2, 1)
+
+
+def skat_test(genotypes, weights, phenotypes):
+    """ SKAT variance-component test with a weighted linear kernel,
+        p values are taken from Liu's moment-matching approximation of the chi-square mixture
+        :param genotypes: genes x samples x variants dosage array
+        :param weights: genes x variants array of variant weights
+        :param phenotypes: numpy array with 1 for case and 0 for control samples
+        :return: numpy array with p values per gene
+    """
+    residuals = phenotypes - phenotypes.mean()
+    weighted = genotypes * weights[:, np.newaxis, :]
+
+    # Q = sum over variants of (w_j * sum over samples of residual_i * g_ij)^2
+    scores = np.einsum("gnm,n->gm", weighted, residuals)
+    q = (scores ** 2).sum(axis=1)
+
+    centered = weighted - weighted.mean(axis=1, keepdims=True)
+    kernel = np.matmul(centered.transpose(0, 2, 1), centered) * phenotypes.mean() * (1 - phenotypes.mean())
+    eigenvalues = np.clip(np.linalg.eigvalsh(kernel), 0, None)
+
+    return liu_pvalues(q, eigenvalues)
+
+
+def liu_pvalues(q, eigenvalues):
+    """ approximates p values of quadratic forms distributed as sum of lambda_k * chi2(1)
+        :param q: numpy array with statistics per gene
+        :param eigenvalues: genes x k array of mixture weights
+        :return: numpy array with p values per gene
+    """
+    c1 = eigenvalues.sum(axis=1)
+    c2 = (eigenvalues ** 2).sum(axis=1)
+    c3 = (eigenvalues ** 3).sum(axis=1)
+    c4 = (eigenvalues ** 4).sum(axis=1)
+
+    pvalues = np.ones(len(q))
+    valid = c2 > 0
+
+    c1, c2, c3, c4, q = c1[valid], c2[valid], c3[valid], c4[valid], q[valid]
+    s1 = c3 / c2 ** 1.5
+    s2 = c4 / c2 ** 2
+
+    skewed = s1 ** 2 > s2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        a = np.where(skewed, 1 / (s1 - np.sqrt(np.clip(s1 ** 2 - s2, 0, None))), 1 / np.sqrt(s2))
+    delta = np.where(skewed, s1 * a ** 3 - a ** 2, 0)
+    dof = a ** 2 - 2 * delta
+
+    q_norm = (q - c1) / np.sqrt(2 * c2)
+    q_mixture = q_norm * np.sqrt(2) * a + dof + delta
+
+    pvalues[valid] = np.where(delta > 0,
+                              stats.ncx2.sf(q_mixture, dof, np.maximum(delta, 1e-12)),
+                              stats.chi2.sf(q_mixture, dof))
+    return pvalues
+
+
+STATISTICAL_TESTS = {
+    "cmc": cmc_test,
+    "skat": skat_test,
+}
+
+
+def _test_block(test_name, blocks, phenotypes):
+    genotypes, weights = stack_blocks(blocks)
+    return STATISTICAL_TESTS[test_name](genotypes, weights, phenotypes)
+
+
+def group_genes(genes, variants_num, samples_num, block_size, max_elements):
+    """ splits genes sorted by number of variants into blocks of at most block_size genes whose padded
+        genes x samples x variants array has at most max_elements elements, or a single gene
+        :return: list of lists of gene names
+    """
+    gene_blocks = []
+    for gene in genes:
+        block = gene_blocks[-1] if gene_blocks else None
+        # the last gene of a block has the most variants
+        if block and len(block) < block_size and \
+                (len(block) + 1) * samples_num * variants_num[gene] <= max_elements:
+            block.append(gene)
+        else:
+            gene_blocks.append([gene])
+    return gene_blocks
+
+
+def run_burden_test(test_name, blocks, phenotypes, threads=None, block_size=64, max_elements=2 ** 24):
+    """ runs the given test for all genes, genes with similar number of variants are tested together
+        in blocks so that every block is computed with a few batched matrix operations
+        :param test_name: key of STATISTICAL_TESTS
+        :param blocks: dictionary {gene name: (variants x samples dosage matrix, dense or sparse, variant weights)}
+        :param phenotypes: numpy array with 1 for case and 0 for control samples
+        :param threads: number of worker threads, all cpus if None; the celery workers can't start processes
+        :param block_size: maximal number of genes in one block
+        :param max_elements: maximal size of the dense genotype array of a block, bounds the memory per thread
+        :return: pandas Series with p values, indexed by gene name
+    """
+    variants_num = {gene: matrix.shape[0] for gene, (matrix, _) in blocks.items()}
+    genes = sorted(blocks.keys(), key=lambda gene: variants_num[gene])
+    gene_blocks = group_genes(genes, variants_num, len(phenotypes), block_size, max_elements)
+
+    # the batched numpy operations release the GIL
+    with ThreadPoolExecutor(max_workers=threads or cpu_count() or 1) as executor:
+        results = list(executor.map(lambda block: _test_block(test_name, [blocks[gene] for gene in block], phenotypes),
+                                    gene_blocks))
+
+    return pd.Series(np.concatenate(results) if results else [], index=genes, dtype=np.float64)
+
+
+def find_burden_scores(vcf_case, vcf_control, genes, csv_case, csv_control, test_name, output_file,
+                       cadd_weights=False):
+    """ creates a scores file like find_fisher_scores with p values from the given burden test
+        :param vcf_case: filtered case vcf file
+        :param vcf_control: filtered control vcf file
+        :param genes: dictionary {gene name: gene inheritance info}
+        :param csv_case: collapsed csv table with case samples
+        :param csv_control: collapsed csv table with control samples
+        :param test_name: key of STATISTICAL_TESTS
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :param cadd_weights: use CADD PHRED scores as variant weights
+        :return: string: output file name with the right extension
+    """
+    case_df = pd.read_csv(csv_case,
+                          header=0,
+                          index_col=0)
+    control_df = pd.read_csv(csv_control,
+                             header=0,
+                             index_col=0)
+
+    blocks, samples_num = get_genotype_blocks([vcf_case, vcf_control], genes, cadd_weights=cadd_weights)
+    phenotypes = np.concatenate([np.ones(samples_num[0]), np.zeros(samples_num[1])])
+
+    score_df = pd.DataFrame(index=case_df.index.values,
+                            columns=["case_pos", "case_neg", "control_pos", "control_neg", "p"])
+
+    score_df["case_pos"] = case_df.sum(axis=1)
+    score_df["case_neg"] = len(case_df.columns) - score_df["case_pos"]
+    score_df["control_pos"] = control_df.sum(axis=1)
+    score_df["control_neg"] = len(control_df.columns) - score_df["control_pos"]
+    score_df["p"] = run_burden_test(test_name, blocks, phenotypes).reindex(score_df.index).fillna(1.0)
+
+    score_df = score_df.sort_values("p")
+    score_df.to_csv(output_file + '.csv')
+
+    return output_file + '.csv'
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+import zlib
+
+import aiohttp
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+CADD_VERSION = "GRCh37-v1.6"
+FINISHED_LINK = re.compile(r'href="[^"]*finished/([^"/]+)"')
+# answers after which the same request may succeed
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class CaddError(Exception):
+    pass
+
+
+def get_backoff(attempt, backoff, max_backoff):
+    """ exponential backoff with full jitter: a random delay up to backoff * 2^attempt seconds """
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def decompress_chunks(chunks):
+    """ decompresses gzip data on the fly, including bgzip files which consist of many gzip members
+        :param chunks: iterable of compressed bytes
+        :return: generator of decompressed bytes
+        :raise zlib.error: if the data ends in the middle of a member, e.g. of a truncated download
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    in_member = False
+
+    for chunk in chunks:
+        while chunk:
+            in_member = True
+            yield decompressor.decompress(chunk)
+            if not decompressor.eof:
+                break
+            # the next member starts in the unused data
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            in_member = False
+
+    yield decompressor.flush()
+    if in_member and not decompressor.eof:
+        raise zlib.error("compressed data ends in the middle of a gzip member")
+
+
+class CaddClient:
+    """ Uploads variants to the CADD server and downloads their scores,
+        reuses connections and retries failed requests with exponential backoff
+        :param url: url of the CADD server, settings.CADD_URL by default
+        :param timeout: (connect, read) timeout in seconds
+        :param retries: number of retries of a failed request
+        :param backoff: base delay of the retries in seconds
+        :param max_backoff: maximal delay of a retry in seconds
+        :param pool_size: number of connections kept open
+    """
+    def __init__(self, url=None, timeout=(10, 120), retries=5, backoff=1.0, max_backoff=60.0, pool_size=10):
+        self.url = url or settings.CADD_URL
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        self.session.mount(self.url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def request(self, method, path, **kwargs):
+        """ sends a request, retrying connection errors, timeouts and 429/5xx answers
+            :return: requests.Response of the last attempt
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.request(method, self.url + path, timeout=self.timeout, **kwargs)
+                if response.status_code not in RETRY_STATUS or attempt == self.retries:
+                    return response
+                response.close()
+                error = "status %d" % response.status_code
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    raise CaddError("%s %s failed: %s" % (method, path, e)) from e
+                error = str(e)
+
+            delay = get_backoff(attempt, self.backoff, self.max_backoff)
+            logger.warning("%s %s failed (%s), retrying in %.1f s", method, path, error, delay)
+            time.sleep(delay)
+
+    def upload(self, vcf_file, version=CADD_VERSION):
+        """ uploads a bgzipped vcf file for scoring
+            :param version: genome build and CADD version, e.g. GRCh37-v1.6
+            :return: id of the scores file
+        """
+        # read once, a file object would be exhausted after the first attempt and retries would upload nothing
+        with open(vcf_file, "rb") as file:
+            content = file.read()
+
+        response = self.request("POST", "upload", files={"file": (os.path.basename(vcf_file), content)}, data={
+            "version": version,
+            "inclAnno": "No",
+            "submit": "Upload variants",
+        })
+
+        match = FINISHED_LINK.search(response.text)
+        if response.status_code != 200 or "You successfully uploaded" not in response.text or not match:
+            raise CaddError("upload of %s failed with status %d" % (vcf_file, response.status_code))
+
+        return match.group(1)
+
+    def is_ready(self, cadd_id):
+        """ :return: True if the scores can be downloaded """
+        response = self.request("HEAD", "static/finished/" + cadd_id)
+        if response.status_code not in (200, 404):
+            raise CaddError("checking %s failed with status %d" % (cadd_id, response.status_code))
+        return response.status_code == 200
+
+    def download(self, cadd_id, output_file, chunk_size=1024 * 1024):
+        """ downloads and decompresses the scores, nothing is written if they are not ready
+            :param cadd_id: id of the scores file returned by upload
+            :param output_file: name of an output file WITHOUT SUFFICES
+            :param chunk_size: size of the downloaded chunks in bytes
+            :return: string: output file name with the right extension or "" if the scores are not ready
+        """
+        response = self.request("GET", "static/finished/" + cadd_id, stream=True)
+
+        with response:
+            if response.status_code == 404:
+                return ""
+            if response.status_code != 200:
+                raise CaddError("download of %s failed with status %d" % (cadd_id, response.status_code))
+
+            # a broken download must not look like finished scores
+            tmp_file = output_file + ".tsv.part"
+            try:
+                with open(tmp_file, "wb") as tsv_file:
+                    for data in decompress_chunks(response.iter_content(chunk_size)):
+                        tsv_file.write(data)
+            except (requests.RequestException, zlib.error) as e:
+                os.remove(tmp_file)
+                raise CaddError("download of %s failed: %s" % (cadd_id, e)) from e
+
+        os.replace(tmp_file, output_file + ".tsv")
+        return output_file + ".tsv"
+
+
+class AsyncCaddClient:
+    """ Checks many scores files at once, with the retry policy of CaddClient
+        :param concurrency: maximal number of requests at the same time
+    """
+    def __init__(self, url=None, timeout=30, retries=3, backoff=1.0, max_backoff=30.0, concurrency=20):
+        self.url = url or settings.CADD_URL
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.concurrency = concurrency
+
+    async def is_ready(self, session, semaphore, cadd_id):
+        """ :return: True if ready, False if not ready, None if the server could not be asked """
+        for attempt in range(self.retries + 1):
+            try:
+                async with semaphore, session.head(self.url + "static/finished/" + cadd_id) as response:
+                    if response.status in (200, 404):
+                        return response.status == 200
+                    error = "status %d" % response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+
+            if attempt < self.retries:
+                await asyncio.sleep(get_backoff(attempt, self.backoff, self.max_backoff))
+
+        logger.warning("checking %s failed: %s", cadd_id, error)
+        return None
+
+    async def check(self, cadd_ids):
+        """ :return: dictionary {cadd id: True/False/None} """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+
+        async with aiohttp.ClientSession(timeout=self.timeout, connector=connector) as session:
+            results = await asyncio.gather(*[self.is_ready(session, semaphore, cadd_id) for cadd_id in cadd_ids])
+
+        return dict(zip(cadd_ids, results))
+
+    def check_all(self, cadd_ids):
+        """ checks the scores files concurrently from synchronous code
+            :return: dictionary {cadd id: True/False/None}
+        """
+        return asyncio.run(self.check(list(cadd_ids)))
+
+
+_client = None
+
+
+def get_client():
+    """ client shared by the tasks of a worker process, so that connections are reused """
+    global _client
+    if _client is None:
+        _client = CaddClient()
+    return _client
@@ -0,0 +1,63 @@
+from django.db import transaction
+
+from .models import Project, ProjectFiles, BackgroundJob
+from .progress import publish_progress
+
+
+def set_project_state(project: Project, state):
+    """ saves the new project state, without writing the other fields, and publishes it to the progress channel """
+    Project.objects.filter(pk=project.pk).update(state=state)
+    project.state = state
+    publish_progress(project.pk, state=state)
+
+
+class JobContext:
+    """ The background job, project and project files a task works on, loaded once per task.
+        Stages change the fields of files and write only these with save_files,
+        project states change with a row lock so that concurrent tasks can't both move a project on.
+        :param project: Project, with its background set loaded
+        :param job: BackgroundJob working on the project or None outside of tasks
+    """
+    def __init__(self, project: Project, job: BackgroundJob = None):
+        self.project = project
+        self.job = job
+        self._files = None
+
+    @classmethod
+    def load(cls, bj_id):
+        job = BackgroundJob.objects.select_related("project", "project__background").get(pk=bj_id)
+        return cls(job.project, job)
+
+    @property
+    def files(self) -> ProjectFiles:
+        if self._files is None:
+            self._files, _ = ProjectFiles.objects.get_or_create(project=self.project)
+        return self._files
+
+    def save_files(self, *fields):
+        """ writes the given fields of the project files """
+        self.files.save(update_fields=fields)
+
+    def set_state(self, state):
+        set_project_state(self.project, state)
+
+    def transition(self, state, from_states):
+        """ changes the project state if it is one of from_states, atomically
+        :return: True if the state was changed
+        """
+        with transaction.atomic():
+            current = Project.objects.select_for_update().values_list("state", flat=True).get(pk=self.project.pk)
+            if current not in from_states:
+                self.project.state = current
+                return False
+            Project.objects.filter(pk=self.project.pk).update(state=state)
+
+        self.project.state = state
+        publish_progress(self.project.pk, state=state)
+        return True
+
+    def set_job_state(self, state):
+        """ saves the new job state and publishes it to the progress channel of the project """
+        self.job.state = state
+        self.job.save(update_fields=["state"])
+        publish_progress(self.project.pk, stage=self.job.name, job_state=state, percent=100 if state == "done" else 0)
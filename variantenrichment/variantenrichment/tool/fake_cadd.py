@@ -0,0 +1,158 @@
+import gzip
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .synthetic import write_cadd_file
+
+# bgzip compresses blocks of at most 64 kB into separate gzip members
+BLOCK_SIZE = 65280
+VERSION = re.compile(r"^GRCh3[78]-v[0-9.]+$")
+FINISHED_PATH = re.compile(r"^/static/finished/(GRCh3[78]-v[0-9.]+_[0-9a-f]+\.tsv\.gz)$")
+
+
+def parse_multipart(content_type, body):
+    """ :return: dictionary {field name: bytes} of a multipart/form-data request body """
+    message = BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    return {
+        part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+        for part in message.get_payload()
+    }
+
+
+def bgzip_compress(data):
+    """ :return: data compressed into multiple gzip members like bgzip does """
+    return b"".join(gzip.compress(data[start:start + BLOCK_SIZE]) for start in range(0, len(data), BLOCK_SIZE)) + \
+        gzip.compress(b"")
+
+
+class FakeCaddHandler(BaseHTTPRequestHandler):
+    """ Answers like the CADD server: POST /upload stores the file and links the scores,
+        HEAD/GET /static/finished/<id> returns 404 until the scores are "ready", then the gzipped scores
+    """
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+
+        if self.server.should_fail():
+            return self.send_error(503)
+
+        if self.path != "/upload":
+            return self.send_error(404)
+
+        fields = parse_multipart(self.headers["Content-Type"], body)
+        vcf_content = fields.get("file")
+        if not vcf_content:
+            return self.send_error(400, "no file uploaded")
+
+        version = (fields.get("version") or b"GRCh37-v1.6").decode()
+        if not VERSION.match(version):
+            return self.send_error(400, "unknown version")
+
+        cadd_id = "%s_%s.tsv.gz" % (version, uuid.uuid4().hex)
+        self.server.add_upload(cadd_id, vcf_content)
+
+        page = ("<html><body><p>You successfully uploaded upload.vcf.gz.</p>"
+                "<p>Your results will be available at <a href=\"/static/finished/%s\">%s</a></p>"
+                "</body></html>" % (cadd_id, cadd_id)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def do_HEAD(self):
+        self.send_scores(with_body=False)
+
+    def do_GET(self):
+        self.send_scores(with_body=True)
+
+    def send_scores(self, with_body):
+        if self.server.should_fail():
+            return self.send_error(503)
+
+        match = FINISHED_PATH.match(self.path)
+        scores = self.server.get_scores(match.group(1)) if match else None
+        if scores is None:
+            return self.send_error(404)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/gzip")
+        self.send_header("Content-Length", str(len(scores)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(scores[:int(len(scores) * self.server.truncate)])
+            # the rest of the announced body never comes
+            self.close_connection = self.server.truncate < 1
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeCaddServer(ThreadingHTTPServer):
+    """ Local stand-in for the CADD server scoring uploaded variants with random PHRED scores
+        :param address: (host, port), port 0 picks a free one
+        :param delay: seconds after an upload until its scores are available
+        :param failures: number of first requests answered with 503, to test retries
+        :param truncate: fraction of the scores sent, the connection is closed after, to test broken downloads
+    """
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), delay=0.0, failures=0, truncate=1.0):
+        super().__init__(address, FakeCaddHandler)
+        self.delay = delay
+        self.failures = failures
+        self.truncate = truncate
+        self.directory = tempfile.mkdtemp(prefix="fake_cadd_")
+        # id: (time when the scores are ready, uploaded vcf file)
+        self.uploads = {}
+        # id: compressed scores
+        self.scores = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://%s:%d/" % self.server_address[:2]
+
+    def should_fail(self):
+        with self.lock:
+            self.failures -= 1
+            return self.failures >= 0
+
+    def add_upload(self, cadd_id, vcf_content):
+        vcf_file = os.path.join(self.directory, cadd_id.replace(".tsv.gz", ".vcf.gz"))
+        with open(vcf_file, "wb") as file:
+            file.write(vcf_content)
+
+        with self.lock:
+            self.uploads[cadd_id] = (time.monotonic() + self.delay, vcf_file)
+
+    def get_scores(self, cadd_id):
+        """ :return: gzipped scores or None if the id is unknown or the scores are not ready yet """
+        with self.lock:
+            ready, vcf_file = self.uploads.get(cadd_id, (None, None))
+
+        if ready is None or time.monotonic() < ready:
+            return None
+
+        if cadd_id not in self.scores:
+            scores_file = write_cadd_file(vcf_file, vcf_file[:-len(".vcf.gz")])
+            with open(scores_file, "rb") as file:
+                self.scores[cadd_id] = bgzip_compress(file.read())
+
+        return self.scores[cadd_id]
+
+    def start(self):
+        """ serves in a background thread """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def shutdown(self):
+        """ stops serving and removes the uploaded files """
+        super().shutdown()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -17,8 +17,10 @@ class ProjectForm(ModelForm):
         model = Project
         fields = [
             'title', 'impact', 'frequency',
-            'impact_exception', 'genes_exception', 'background',
-            'population', 'cadd_score', 'genomic_regions', 'inheritance'
+            'impact_exception', 'genes_exception', 'reference', 'background',
+            'population', 'cadd_score', 'statistical_test', 'cadd_weights', 'permutations', 'permutation_seed',
+            'profile',
+            'genomic_regions', 'inheritance'
         ]
 
 
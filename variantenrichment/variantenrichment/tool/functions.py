@@ -1,15 +1,28 @@
+import gzip
+import socket
 import subprocess
-import re
 import sys
-import requests
-from os import path
-from bs4 import BeautifulSoup
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os import cpu_count, path
 import numpy as np
 import pandas as pd
 import vcfpy as vp
 import scipy.stats as stats
-import matplotlib.pyplot as plt
+import matplotlib
 import math
+import json
+
+from django.conf import settings
+
+from .cadd import CADD_VERSION, CaddError, get_client
+from .instrumentation import RecordMeter, run_command, command_output
+from .io_threads import bgzip_threads, bcftools_threads, get_io_threads
+
+# render plots without a display in celery workers
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # noqa: E402
 
 
 def get_directory(path_to_dir):
@@ -18,7 +31,7 @@ def get_directory(path_to_dir):
         :return: a created directory or an existing one with the given path
     """
     if not path.exists(path_to_dir):
-        subprocess.run([
+        run_command([
             "mkdir", "-p",
             path_to_dir
         ])
@@ -32,41 +45,43 @@ def merge_files(vcf_files, output_file):
         :return: output file name with the right extension
     """
 
+    # next to the output, concurrent jobs of other projects must not share them
+    tmp_vcf = output_file + ".tmp.vcf"
     if len(vcf_files) > 1:
-        names_file = "file_names.txt"
+        names_file = output_file + ".file_names.txt"
         with open(names_file, "w") as file:
             for vcf in vcf_files:
                 if not vcf.endswith(".gz"):
-                    subprocess.run([
-                        "bgzip", "-f", vcf
+                    run_command([
+                        "bgzip", "-f", *bgzip_threads(), vcf
                     ])
                     vcf += ".gz"
 
-                subprocess.run([
+                run_command([
                     "tabix", "-p", "vcf", vcf
                 ])
                 file.write(vcf + '\n')
 
-        subprocess.run([
-            "bcftools", "merge", "-0", "-l", names_file, "-m", "none", "-o", "tmp.vcf"
+        run_command([
+            "bcftools", "merge", "-0", "-l", names_file, "-m", "none", "-o", tmp_vcf
         ])
 
-        subprocess.run([
+        run_command([
             "rm", names_file
         ])
 
     else:
-        vcf_content = subprocess.check_output([
-            "zcat", vcf_files[0]
+        vcf_content = command_output([
+            "bgzip", "-d", "-c", *bgzip_threads(), vcf_files[0]
         ])
 
-        with open("tmp.vcf", "w+") as tmp_file:
+        with open(tmp_vcf, "w+") as tmp_file:
             tmp_file.write(vcf_content.decode())
 
-    normalized = normalize_sample("tmp.vcf", output_file)
+    normalized = normalize_sample(tmp_vcf, output_file)
 
-    subprocess.run([
-        "rm", "tmp.vcf"
+    run_command([
+        "rm", tmp_vcf
     ])
 
     return normalized
@@ -79,27 +94,202 @@ def normalize_sample(vcf_file, output_file):
         :return: output file name with the right extension
     """
 
-    subprocess.run([
+    run_command([
         "bcftools", "sort", "-o", vcf_file, vcf_file
     ])
 
-    subprocess.run([
-        "bcftools", "norm", "-d", "none", "-o", output_file + ".vcf", vcf_file
+    run_command([
+        "bcftools", "norm", "-d", "none", *get_compressed_output(output_file), vcf_file
     ])
 
-    subprocess.run([
-        "bgzip", "-f", output_file + ".vcf"
-    ])
+    return index_vcf(output_file + ".vcf.gz")
+
+
+def open_vcf(vcf_file):
+    """ opens a plain or gzipped vcf file as text """
+    with open(vcf_file, "rb") as file:
+        gzipped = file.read(2) == b"\x1f\x8b"
+    return gzip.open(vcf_file, "rt") if gzipped else open(vcf_file)
+
+
+@contextmanager
+def bgzip_output(output_file, threads=None):
+    """ opens a text file whose content is compressed by bgzip into output_file
+        :param output_file: name of the bgzipped output file
+        :param threads: compression threads of bgzip, the I/O thread share of the job by default
+    """
+    with open(output_file, "wb") as raw_file:
+        process = subprocess.Popen(["bgzip", "-@", str(threads or get_io_threads()), "-c"], stdin=subprocess.PIPE,
+                                   stdout=raw_file, universal_newlines=True)
+    try:
+        yield process.stdin
+    finally:
+        process.stdin.close()
+        process.wait()
+
+    if process.returncode != 0:
+        raise RuntimeError("bgzip failed with exit code %d" % process.returncode)
+
+
+def index_vcf(vcf_file):
+    """ indexes a bgzipped variant file with tabix for region queries of the later stages
+        :return: the variant file
+    """
+    run_command([
+        "tabix", "-f", "-p", "vcf", vcf_file
+    ], check=True)
+
+    return vcf_file
+
+
+def get_compressed_output(output_file):
+    """ :param output_file: name of an output file WITHOUT SUFFICES
+        :return: bcftools options writing it bgzipped with the I/O thread share of the job
+    """
+    return ["-Oz", *bcftools_threads(), "-o", output_file + ".vcf.gz"]
 
-    subprocess.run([
-        "tabix", "-f", "-p", "vcf", output_file + ".vcf.gz"
-    ])
+
+def get_sites(vcf_file, output_file):
+    """ drops the genotypes of the variant file
+        :param vcf_file: variant file
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :return: output file name with the right extension
+    """
+    run_command([
+        "bcftools", "view", "-G", *get_compressed_output(output_file), vcf_file
+    ], check=True)
 
     return output_file + ".vcf.gz"
 
 
-def annotate_sample(vcf_file, fasta_file, gnomad_file, db_file, output_file):
-    """ annotates the variant file
+def join_annotations(vcf_file, sites_file, output_file):
+    """ replaces the INFO column of the variant file by the one of the annotated sites file in one pass,
+        both files have to list the same variants in the same order
+        :param vcf_file: variant file with genotypes
+        :param sites_file: annotated variant file without genotypes
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :return: output file name with the right extension
+    """
+    with open_vcf(vcf_file) as vcf, open_vcf(sites_file) as sites, \
+            bgzip_output(output_file + ".vcf.gz") as output:
+        header = []
+        for line in vcf:
+            if line.startswith("#CHROM"):
+                break
+            header.append(line)
+
+        info_ids = {get_info_id(line) for line in header if line.startswith("##INFO")}
+        site = next(sites)
+        while site.startswith("##"):
+            if site.startswith("##INFO") and get_info_id(site) not in info_ids:
+                header.append(site)
+            site = next(sites)
+
+        output.writelines(header)
+        output.write(line)
+
+        # not zip, which drops a record of the variant file when the sites file ends first
+        for line in vcf:
+            site = next(sites, None)
+            if site is None:
+                raise ValueError("%s and %s have different numbers of variants" % (vcf_file, sites_file))
+            fields = line.split("\t", 8)
+            site_fields = site.rstrip("\n").split("\t", 8)
+            if fields[:5] != site_fields[:5]:
+                raise ValueError("%s and %s differ at %s:%s" % (vcf_file, sites_file, fields[0], fields[1]))
+
+            fields[7] = site_fields[7]
+            output.write("\t".join(fields))
+
+        if next(sites, None) is not None:
+            raise ValueError("%s and %s have different numbers of variants" % (vcf_file, sites_file))
+
+    return index_vcf(output_file + ".vcf.gz")
+
+
+def get_key(line):
+    """ :return: (chrom, pos, ref, alt) of a vcf record line """
+    chrom, pos, _, ref, alt = line.split("\t", 5)[:5]
+    return chrom, int(pos), ref, alt
+
+
+def split_info(info):
+    return [] if info == "." else info.split(";")
+
+
+def read_sites(sites_file):
+    """ :return: tuple (list of header lines, list of (chrom, pos, ref, alt) of the records) """
+    header, keys = [], []
+    with open_vcf(sites_file) as sites:
+        for line in sites:
+            if line.startswith("#"):
+                header.append(line)
+            else:
+                keys.append(get_key(line))
+    return header, keys
+
+
+def write_keys(keys, header, output_file):
+    """ writes the variants without ids and INFO fields, the input jannovar needs to annotate them
+        :param keys: list of (chrom, pos, ref, alt)
+        :param header: header lines of a sites file
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :return: output file name with the right extension
+    """
+    with open(output_file + ".vcf", "w") as sites:
+        sites.writelines(header)
+        sites.writelines("%s\t%d\t.\t%s\t%s\t.\t.\t.\n" % key for key in keys)
+
+    return output_file + ".vcf"
+
+
+def get_info_id(header_line):
+    """ :return: ID of an ##INFO=<ID=...> header line """
+    return header_line.split("ID=", 1)[1].split(",", 1)[0].rstrip(">\n")
+
+
+def read_annotations(vcf_file, header):
+    """ :param vcf_file: file written by write_keys and annotated by jannovar
+        :param header: header lines of the file before the annotation
+        :return: tuple (dictionary {(chrom, pos, ref, alt): annotation INFO fields}, list of added INFO header lines)
+    """
+    info_ids = {get_info_id(line) for line in header if line.startswith("##INFO")}
+    annotations, added_header = {}, []
+    with open_vcf(vcf_file) as annotated:
+        for line in annotated:
+            if line.startswith("##INFO") and get_info_id(line) not in info_ids:
+                added_header.append(line)
+            elif not line.startswith("#"):
+                annotations[get_key(line)] = line.rstrip("\n").split("\t")[7]
+
+    return annotations, added_header
+
+
+def write_annotated_sites(sites_file, annotations, added_header, output_file):
+    """ appends the annotations to the INFO fields of a sites file, like jannovar does
+        :param sites_file: variant file without genotypes
+        :param annotations: dictionary {(chrom, pos, ref, alt): annotation INFO fields}
+        :param added_header: INFO header lines of the annotations
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :return: output file name with the right extension
+    """
+    with open_vcf(sites_file) as sites, open(output_file + ".vcf", "w") as annotated:
+        for line in sites:
+            if line.startswith("#CHROM"):
+                annotated.writelines(added_header)
+            if line.startswith("#"):
+                annotated.write(line)
+                continue
+
+            fields = line.rstrip("\n").split("\t")
+            fields[7] = ";".join(split_info(fields[7]) + split_info(annotations.get(get_key(line), "."))) or "."
+            annotated.write("\t".join(fields) + "\n")
+
+    return output_file + ".vcf"
+
+
+def run_jannovar(vcf_file, fasta_file, gnomad_file, db_file, output_file):
+    """ annotates the variant file with a new jannovar process
         :param vcf_file: variant file
         :param fasta_file: reference fasta file for annotating
         :param gnomad_file: vcf with gnomad exomes
@@ -107,8 +297,7 @@ def annotate_sample(vcf_file, fasta_file, gnomad_file, db_file, output_file):
         :param output_file: name of an output file WITHOUT SUFFICES
         :return: output file name with the right extension
     """
-
-    subprocess.run([
+    run_command([
         "jannovar",
         "annotate-vcf",
         "--show-all",
@@ -119,15 +308,94 @@ def annotate_sample(vcf_file, fasta_file, gnomad_file, db_file, output_file):
         "-o", output_file + ".vcf.gz"
     ], check=True)
 
-    print("Done with Jannovar, tabix is next", file=sys.stderr)
+    return output_file + ".vcf.gz"
 
-    subprocess.run([
-        "tabix", "-p", "vcf", output_file + ".vcf.gz"
-    ], check=True)
 
-    print("Done with tabix, result is %s" % (output_file + ".vcf.gz"), file=sys.stderr)
+def get_annotation_timeout(sites_file):
+    """ :return: seconds to wait for the annotation daemon: ANNOTATION_DAEMON_TIMEOUT
+        and ANNOTATION_DAEMON_TIMEOUT_PER_MB for every megabyte of the sites file
+    """
+    megabytes = path.getsize(sites_file) / 2 ** 20
+    return settings.ANNOTATION_DAEMON_TIMEOUT + settings.ANNOTATION_DAEMON_TIMEOUT_PER_MB * megabytes
 
-    return output_file + ".vcf.gz"
+
+def request_annotation(socket_path, message, timeout, connect_timeout=5):
+    """ sends a request to the annotation daemon and waits for the answer
+        :param socket_path: unix socket of the daemon
+        :param message: dictionary, see annotation_daemon.AnnotationDaemon
+        :param timeout: seconds to wait for the answer, socket.timeout is raised after
+        :param connect_timeout: seconds to wait for the daemon to accept the connection
+        :return: dictionary answer of the daemon
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(connect_timeout)
+        connection.connect(socket_path)
+        connection.settimeout(timeout)
+        connection.sendall(json.dumps(message).encode() + b"\n")
+        with connection.makefile("rb") as answer:
+            line = answer.readline()
+
+    if not line:
+        raise ConnectionError("the annotation daemon closed the connection")
+    return json.loads(line)
+
+
+def annotate_sites(sites_file, fasta_file, gnomad_file, db_file, output_file):
+    """ annotates a variant file by the annotation daemon if it runs and answers in time,
+        by a new jannovar process otherwise
+        :param sites_file: variant file, best without genotypes
+        :param fasta_file: reference fasta file for annotating
+        :param gnomad_file: vcf with gnomad exomes
+        :param db_file: reference database
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :return: output file name with the right extension
+    """
+    if settings.ANNOTATION_DAEMON_SOCKET:
+        try:
+            answer = request_annotation(settings.ANNOTATION_DAEMON_SOCKET, {
+                "input": path.abspath(sites_file),
+                "output": path.abspath(output_file),
+                "fasta_file": path.abspath(fasta_file),
+                "gnomad_file": path.abspath(gnomad_file),
+                "db_file": path.abspath(db_file)
+            }, timeout=get_annotation_timeout(sites_file))
+            if answer["ok"]:
+                return answer["output"]
+            print("annotation daemon failed: %s" % answer["error"], file=sys.stderr)
+
+        except socket.timeout:
+            print("annotation daemon did not answer in time", file=sys.stderr)
+        except OSError as e:
+            print("annotation daemon not available: %s" % e, file=sys.stderr)
+
+    return run_jannovar(sites_file, fasta_file, gnomad_file, db_file, output_file)
+
+
+def annotate_sample(vcf_file, fasta_file, gnomad_file, db_file, output_file):
+    """ annotates the sites of the variant file and joins the annotations back onto the genotypes
+        :param vcf_file: variant file
+        :param fasta_file: reference fasta file for annotating
+        :param gnomad_file: vcf with gnomad exomes
+        :param db_file: reference database
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :return: output file name with the right extension
+    """
+    sites_file = get_sites(vcf_file, output_file + ".sites")
+    annotated_sites = annotate_sites(sites_file, fasta_file, gnomad_file, db_file, output_file + ".sites.annotated")
+
+    print("Done with Jannovar, joining the genotypes is next", file=sys.stderr)
+
+    joined = join_annotations(vcf_file=vcf_file,
+                              sites_file=annotated_sites,
+                              output_file=output_file)
+
+    run_command([
+        "rm", sites_file, annotated_sites
+    ])
+
+    print("Done with joining, result is %s" % joined, file=sys.stderr)
+
+    return joined
 
 
 def filter_by_gene(vcf_file, gene_file, output_file):
@@ -137,22 +405,23 @@ def filter_by_gene(vcf_file, gene_file, output_file):
         :param output_file: name of an output file WITHOUT SUFFICES
         :return: output file name with the right extension
     """
-    filtered_variants = subprocess.check_output([
+    filtered_variants = command_output([
         "tabix", "-R", gene_file, vcf_file
     ])
 
-    header = subprocess.check_output([
+    header = command_output([
         "tabix", "-H", vcf_file
     ])
 
-    with open("tmp.vcf", "w") as o_file:
+    tmp_vcf = output_file + ".tmp.vcf"
+    with open(tmp_vcf, "w") as o_file:
         o_file.write(header.decode())
         o_file.write(filtered_variants.decode())
 
-    normalized = normalize_sample("tmp.vcf", output_file)
+    normalized = normalize_sample(tmp_vcf, output_file)
 
-    subprocess.run([
-        "rm", "tmp.vcf"
+    run_command([
+        "rm", tmp_vcf
     ])
 
     return normalized
@@ -169,13 +438,13 @@ def filter_by_frequency(vcf_file, frequency, output_file):
     freq_str = 'INFO/GNOMAD_EXOMES_AF_ALL = "." || INFO/GNOMAD_EXOMES_AF_ALL < ' + str(frequency)
     print(freq_str)
 
-    subprocess.run([
+    run_command([
         "bcftools", "filter", "-i",
         freq_str,
-        "-o", output_file + ".vcf", vcf_file
+        *get_compressed_output(output_file), vcf_file
     ])
 
-    return output_file + ".vcf"
+    return index_vcf(output_file + ".vcf.gz")
 
 
 def filter_by_impact(vcf_file, impact, impact_mod, genes_mod, output_file):
@@ -198,13 +467,13 @@ def filter_by_impact(vcf_file, impact, impact_mod, genes_mod, output_file):
 
     print("FILTER BY IMPACT:", impact_str)
 
-    subprocess.run([
+    run_command([
         "bcftools", "filter", "-i",
         impact_str,
-        "-o", output_file + ".vcf", vcf_file
+        *get_compressed_output(output_file), vcf_file
     ])
 
-    return output_file + ".vcf"
+    return index_vcf(output_file + ".vcf.gz")
 
 
 def filter_population(vcf_file, samples_file, population, output_file):
@@ -217,15 +486,16 @@ def filter_population(vcf_file, samples_file, population, output_file):
     samples_filtered = samples_df[samples_df["Superpopulation code"].isin(population)]["Sample name"]
     samples_filtered.to_csv("sample_names.txt", index=False, header=False)
 
-    subprocess.run([
-        "bcftools", "view", "-S", "sample_names.txt", "-c1", "--force-samples", "-o", output_file + ".vcf", vcf_file
+    run_command([
+        "bcftools", "view", "-S", "sample_names.txt", "-c1", "--force-samples", *get_compressed_output(output_file),
+        vcf_file
     ])
 
     # subprocess.run([
     #     "rm", "sample_names.txt"
     # ])
 
-    return output_file + ".vcf"
+    return index_vcf(output_file + ".vcf.gz")
 
 
 def get_genes_dict(genes_file):
@@ -278,35 +548,44 @@ def is_interesting(ann, genes_names, impact_def, impact_mod, impact_position):
     return True
 
 
-def filter_file(vcf_file, genes_names, impact, impact_mod, output_file):
+def filter_file(vcf_file, genes_names, impact, impact_mod, output_file, meter=None):
     """ creates a new vcf file with annotations about "interesting" variants only
         :param vcf_file: jannovar annotated vcf file
         :param genes_names: list of genes names on which to look for variants
         :param impact: default impact defined by user
         :param impact_mod: an exception impact defined by user for a group of genes
         :param output_file: name of an output file WITHOUT SUFFICES
+        :param meter: RecordMeter to report progress to
         :return: string: output file name with the right extension
     """
     reader = vp.Reader.from_path(vcf_file)
-    writer = vp.Writer.from_path(output_file + ".vcf", reader.header)
+    meter = meter or RecordMeter("filter_file")
+    meter.attach(vcf_file, reader.stream)
 
     # position of impact value in ANN string to use for filtering
     # 2: LOW/MODERATE/HIGH
     # 1: synonymous_variant
     impact_position = 1 if impact == "synonymous_variant" else 2
 
-    for record in reader:
-        annotations = record.INFO['ANN']
-        # leave only annotations for "interesting" genes and impact
-        record.INFO['ANN'][:] = [
-            ann for ann in annotations
-            if is_interesting(ann, genes_names, impact, impact_mod, impact_position)
-        ]
-
-        if len(record.INFO['ANN']) != 0:
-            writer.write_record(record)
+    with bgzip_output(output_file + ".vcf.gz") as output:
+        writer = vp.Writer.from_stream(output, reader.header, use_bgzf=False)
 
-    return output_file + ".vcf"
+        for record in reader:
+            annotations = record.INFO['ANN']
+            # leave only annotations for "interesting" genes and impact
+            record.INFO['ANN'][:] = [
+                ann for ann in annotations
+                if is_interesting(ann, genes_names, impact, impact_mod, impact_position)
+            ]
+
+            if len(record.INFO['ANN']) != 0:
+                writer.write_record(record)
+
+            meter.update()
+
+    meter.finish()
+
+    return index_vcf(output_file + ".vcf.gz")
 
 
 def get_annotated_genes(annotations):
@@ -322,18 +601,21 @@ def get_annotated_genes(annotations):
     return genes
 
 
-def count_variants(vcf_file, genes, output_file):
+def count_variants(vcf_file, genes, output_file, meter=None):
     """ creates two csv files for a vcf file:
         -one with a number of variants pro gene in each sample,
         -the other with 1/0 values: 1 if there are any variations on this gene in this sample, 0 if none
         :param vcf_file: jannovar annotated vcf file
         :param genes: dictionary {gene name: gene inheritance info} with genes on which to look for variants
         :param output_file: name of an output file WITHOUT SUFFICES
+        :param meter: RecordMeter to report progress to
         :return: string: output file name with the right extension
     """
 
     reader = vp.Reader.from_path(vcf_file)
     samples = reader.header.samples.names
+    meter = meter or RecordMeter("count_variants")
+    meter.attach(vcf_file, reader.stream)
 
     df = pd.DataFrame(
        np.zeros((len(genes), len(samples))),
@@ -360,6 +642,10 @@ def count_variants(vcf_file, genes, output_file):
                 # only "1" values for gen-wise collapsed table
                 df_collapse[call.sample][gene_name] = 1
 
+        meter.update()
+
+    meter.finish()
+
     # make two different tables (normal and gen-wise collapsed)
     df.to_csv(output_file + '.csv')
     df_collapse.to_csv(output_file + '.collapsed.csv')
@@ -367,70 +653,51 @@ def count_variants(vcf_file, genes, output_file):
     return output_file + '.collapsed.csv'
 
 
-CADD_URL = "https://cadd.gs.washington.edu/"
-CADD_URL_UPLOAD = CADD_URL + "upload"
-
-
-def post_file_cadd(vcf_file):
+def post_file_cadd(vcf_file, cadd_version=CADD_VERSION):
+    """ uploads a vcf file to the CADD server
+        :param vcf_file: vcf file, bgzipped or not
+        :param cadd_version: genome build and CADD version to score with, e.g. GRCh37-v1.6
+        :return: id of the scores file or "" if the upload failed
+    """
     if not vcf_file.endswith(".gz"):
-        vcf_compressed = subprocess.check_output([
-            "bgzip", "-c", vcf_file
-        ])
-        with open(vcf_file + ".gz", "wb+") as tmp_file:
-            tmp_file.write(vcf_compressed)
+        with open(vcf_file + ".gz", "wb") as compressed_file:
+            run_command([
+                "bgzip", "-c", *bgzip_threads(), vcf_file
+            ], stdout=compressed_file, check=True)
         vcf_file += ".gz"
 
     try:
-        file = {"file": open(vcf_file, "rb")}
-
-        data = {
-            "version": "GRCh37-v1.6",
-            "inclAnno": "No",
-            "submit": "Upload variants",
-        }
-
-        r = requests.post(CADD_URL_UPLOAD, data=data, files=file)
+        return get_client().upload(vcf_file, version=cadd_version)
 
-        soup = BeautifulSoup(r.text, "html.parser")
-        p_success = soup.find("p", string=re.compile("You successfully uploaded"))
-        print(p_success)
-        link_parts = p_success.find_next_sibling("p").find("a")["href"].split("/")
-        return link_parts[len(link_parts) - 1]
-
-    except Exception as e:
+    except CaddError as e:
         print("error:", e)
         return ""
 
 
 def save_cadd_file(cadd_id, output_file):
-    cadd_file_url = CADD_URL + "static/finished/" + cadd_id
-
-    if requests.head(cadd_file_url).status_code == 200:
-        cadd_scores = requests.get(cadd_file_url)
-
-        with open(output_file + ".tsv.gz", "wb") as tsv_file:
-            tsv_file.write(cadd_scores.content)
-
-        subprocess.run([
-            "bgzip", "-d", "-f", output_file + ".tsv.gz"
-        ])
-
-        return output_file + ".tsv"
+    """ downloads the CADD scores if they are ready
+        :param cadd_id: id of the scores file returned by post_file_cadd
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :return: string: output file name with the right extension or "" if the scores are not ready
+    """
+    try:
+        return get_client().download(cadd_id, output_file)
 
-    else:
-        print("try again later, sorry")
+    except CaddError as e:
+        print("error:", e)
         return ""
 
 
-def add_cadd_annotations(vcf_file, cadd_file, output_file):
+def add_cadd_annotations(vcf_file, cadd_file, output_file, meter=None):
     reader = vp.Reader.from_path(vcf_file)
+    meter = meter or RecordMeter("add_cadd_annotations")
+    meter.attach(vcf_file, reader.stream)
     reader.header.add_info_line(vp.OrderedDict([
         ("ID", "CADDRS"), ("Number", "1"), ("Type", "Float"), ("Description", "CADD raw score")
     ]))
     reader.header.add_info_line(vp.OrderedDict([
         ("ID", "CADDPHRED"), ("Number", "1"), ("Type", "Float"), ("Description", "CADD PHRED-scaled score")
     ]))
-    writer = vp.Writer.from_path(output_file + ".vcf", reader.header)
 
     cadd_df = pd.read_csv(cadd_file,
                           delimiter="\t",
@@ -440,41 +707,47 @@ def add_cadd_annotations(vcf_file, cadd_file, output_file):
     cadd_line_num = 0
     cadd_len = len(cadd_df)
 
-    for record in reader:
-        counter = 0
-        cadd_line = cadd_df.iloc[cadd_line_num]
+    with bgzip_output(output_file + ".vcf.gz") as output:
+        writer = vp.Writer.from_stream(output, reader.header, use_bgzf=False)
 
-        while record.CHROM != cadd_line["#Chrom"] or record.POS != cadd_line["Pos"]:
-            cadd_line_num = (cadd_line_num + 1) % cadd_len
+        for record in reader:
+            meter.update()
+            counter = 0
             cadd_line = cadd_df.iloc[cadd_line_num]
-            counter += 1
+
+            while record.CHROM != cadd_line["#Chrom"] or record.POS != cadd_line["Pos"]:
+                cadd_line_num = (cadd_line_num + 1) % cadd_len
+                cadd_line = cadd_df.iloc[cadd_line_num]
+                counter += 1
+
+                if counter == cadd_len:
+                    print("made a round, not found")
+                    record.INFO["CADDRS"] = "."
+                    record.INFO["CADDPHRED"] = "."
+                    writer.write_record(record)
+                    break
 
             if counter == cadd_len:
-                print("made a round, not found")
-                record.INFO["CADDRS"] = "."
-                record.INFO["CADDPHRED"] = "."
-                writer.write_record(record)
-                break
+                continue
 
-        if counter == cadd_len:
-            continue
+            record.INFO["CADDRS"] = cadd_line["RawScore"]
+            record.INFO["CADDPHRED"] = cadd_line["PHRED"]
+            cadd_line_num = (cadd_line_num + 1) % cadd_len
+            writer.write_record(record)
 
-        record.INFO["CADDRS"] = cadd_line["RawScore"]
-        record.INFO["CADDPHRED"] = cadd_line["PHRED"]
-        cadd_line_num = (cadd_line_num + 1) % cadd_len
-        writer.write_record(record)
+    meter.finish()
 
-    return output_file + ".vcf"
+    return index_vcf(output_file + ".vcf.gz")
 
 
 def filter_by_cadd(vcf_file, cadd_score, output_file):
-    subprocess.run([
+    run_command([
         "bcftools", "filter", "-i",
         'INFO/CADDPHRED = "." || INFO/CADDPHRED >= ' + str(cadd_score),
-        "-o", output_file + ".vcf", vcf_file
+        *get_compressed_output(output_file), vcf_file
     ])
 
-    return output_file + ".vcf"
+    return index_vcf(output_file + ".vcf.gz")
 
 
 def find_fisher_scores(csv_case, csv_control, output_file):
@@ -509,30 +782,241 @@ def find_fisher_scores(csv_case, csv_control, output_file):
     return output_file + '.csv'
 
 
-def visualize_p_values(scores_file, output_file):
+# number of set bits for every possible byte value
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _run_permutations(data, args):
+    """ shuffles case/control labels and counts case carriers for the given genes
+        :param data: dictionary with carriers_packed, observed, p_table, n_samples and n_case
+        :param args: tuple (indices of genes to count, numpy SeedSequence, number of permutations)
+        :return: tuple (number of permutations with case carriers >= observed per gene,
+            minimal Fisher p value over the given genes per permutation)
+    """
+    genes_idx, seed_seq, permutations = args
+    rng = np.random.default_rng(seed_seq)
+
+    carriers = data["carriers_packed"][genes_idx]
+    observed = data["observed"][genes_idx]
+    p_table = data["p_table"][genes_idx]
+    rows = np.arange(len(genes_idx))
+
+    exceeding = np.zeros(len(genes_idx), dtype=np.int64)
+    min_p = np.ones(permutations)
+    labels = np.zeros(data["n_samples"], dtype=bool)
+
+    for i in range(permutations):
+        labels[:] = False
+        labels[rng.choice(data["n_samples"], data["n_case"], replace=False)] = True
+        mask = np.packbits(labels)
+
+        # case carriers = number of bits set in (carriers AND case labels)
+        counts = POPCOUNT_TABLE[carriers & mask].sum(axis=1, dtype=np.int64)
+
+        exceeding += counts >= observed
+        if len(rows):
+            min_p[i] = p_table[rows, counts].min()
+
+    return exceeding, min_p
+
+
+def find_permutation_scores(csv_case, csv_control, scores_file, permutations, seed=None, threads=None,
+                            alpha=0.05, batch_size=100, stop_after=100, fwer_permutations=1000):
+    """ adds empirical p values from case/control label permutations to the scores file
+        after the first fwer_permutations permutations genes are dropped from further permutations
+        as soon as stop_after permutations reached their observed number of case carriers (clearly null genes),
+        the minimal p value distribution used for family-wise error correction is only taken
+        from permutations over all genes
+        :param csv_case: collapsed csv table with case samples
+        :param csv_control: collapsed csv table with control samples
+        :param scores_file: csv file created by find_fisher_scores, will be overwritten
+        :param permutations: maximal number of permutations
+        :param seed: seed for the random number generator
+        :param threads: number of worker threads, all cpus if None; threads and not processes
+            because the celery workers are daemonic processes which can't have children
+        :param alpha: family-wise error rate for the returned threshold
+        :param batch_size: number of permutations per worker task
+        :param stop_after: number of exceeding permutations after which a gene is not permuted anymore
+        :param fwer_permutations: number of permutations over all genes before dropping any of them
+        :return: tuple (scores file name, p value threshold for the given family-wise error rate)
+    """
+    case_df = pd.read_csv(csv_case,
+                          header=0,
+                          index_col=0)
+    control_df = pd.read_csv(csv_control,
+                             header=0,
+                             index_col=0)
+    score_df = pd.read_csv(scores_file,
+                           header=0,
+                           index_col=0)
+
+    carriers = np.concatenate([case_df.values, control_df.reindex(case_df.index).values], axis=1) > 0
+    n_case = len(case_df.columns)
+    n_samples = carriers.shape[1]
+
+    carriers_packed = np.packbits(carriers, axis=1)
+    observed = carriers[:, :n_case].sum(axis=1)
+    total = carriers.sum(axis=1)
+
+    # one-sided Fisher p value for every possible number of case carriers, k = 0..n_case
+    k = np.arange(n_case + 1)
+    p_table = stats.hypergeom.sf(k[np.newaxis, :] - 1, n_samples, total[:, np.newaxis], n_case)
+    observed_p = p_table[np.arange(len(observed)), observed]
+
+    exceeding = np.zeros(len(observed), dtype=np.int64)
+    done = np.zeros(len(observed), dtype=np.int64)
+    min_p = []
+    tested = np.flatnonzero(total > 0)
+    active = tested
+
+    threads = threads or cpu_count() or 1
+    seed_sequences = iter(np.random.SeedSequence(seed).spawn(math.ceil(permutations / batch_size)))
+    run_permutations = partial(_run_permutations, dict(carriers_packed=carriers_packed, observed=observed,
+                                                       p_table=p_table, n_samples=n_samples, n_case=n_case))
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        remaining = permutations
+
+        # permute in rounds of one batch per thread to be able to drop null genes in between
+        while remaining > 0 and len(active):
+            batches = []
+            while remaining > 0 and len(batches) < threads:
+                batches.append(min(batch_size, remaining))
+                remaining -= batches[-1]
+
+            results = executor.map(run_permutations, [
+                (active, next(seed_sequences), batch) for batch in batches
+            ])
+
+            for batch_exceeding, batch_min_p in results:
+                exceeding[active] += batch_exceeding
+                if len(active) == len(tested):
+                    min_p.append(batch_min_p)
+            done[active] += sum(batches)
+
+            if permutations - remaining >= fwer_permutations:
+                active = active[exceeding[active] < stop_after]
+
+    min_p = np.concatenate(min_p) if min_p else np.ones(1)
+
+    genes = case_df.index
+    score_df["p_perm"] = pd.Series((exceeding + 1) / (done + 1), index=genes)
+    score_df["p_fwer"] = pd.Series(
+        (np.searchsorted(np.sort(min_p), observed_p, side="right") + 1) / (len(min_p) + 1), index=genes)
+    score_df["permutations"] = pd.Series(done, index=genes)
+    score_df.to_csv(scores_file)
+
+    return scores_file, np.quantile(min_p, alpha)
+
+
+def correct_p_values(scores_file, alpha=0.05):
+    """ adds multiple testing corrected p values to the scores file and computes summary statistics,
+        only genes with at least one carrier in case or control samples count as tested
+        :param scores_file: csv file created by find_fisher_scores, will be overwritten
+        :param alpha: significance level for the Bonferroni threshold and the number of significant genes
+        :return: dictionary with genes_tested, significant_genes, bonferroni_threshold and lambda_gc values
+    """
+    score_df = pd.read_csv(scores_file,
+                           header=0,
+                           index_col=0)
+
+    tested = ((score_df["case_pos"] + score_df["control_pos"]) > 0).values
+    pvalues = score_df["p"].values[tested]
+    genes_tested = len(pvalues)
+
+    # Benjamini-Hochberg: q_(i) = min over j >= i of p_(j) * m / j
+    order = np.argsort(pvalues)
+    ranked = pvalues[order] * genes_tested / np.arange(1, genes_tested + 1)
+    qvalues = np.ones(len(score_df))
+    qvalues[np.flatnonzero(tested)[order]] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+
+    bonferroni = np.ones(len(score_df))
+    bonferroni[tested] = np.minimum(pvalues * genes_tested, 1)
+
+    score_df["q"] = qvalues
+    score_df["p_bonferroni"] = bonferroni
+    score_df.to_csv(scores_file)
+
+    return {
+        "genes_tested": genes_tested,
+        "significant_genes": int((qvalues[tested] <= alpha).sum()),
+        "bonferroni_threshold": alpha / genes_tested if genes_tested else None,
+        "lambda_gc": get_inflation_factor(pvalues) if genes_tested else None,
+    }
+
+
+def get_inflation_factor(pvalues):
+    """ computes the genomic control inflation factor lambda
+        :param pvalues: numpy array with p values of tested genes
+        :return: median of observed chi-square statistics divided by the expected median
+    """
+    return float(np.median(stats.chi2.isf(pvalues, 1)) / stats.chi2.ppf(0.5, 1))
+
+
+def visualize_p_values(scores_file, output_file, lambda_gc=None):
+    """ creates a QQ plot image and a json file with downsampled QQ plot points
+        :param scores_file: scores csv file
+        :param output_file: name of output files WITHOUT SUFFICES
+        :param lambda_gc: genomic inflation factor to show on the plot
+        :return: tuple (png file name, json file name)
+    """
     scores_df = pd.read_csv(scores_file,
                             header=0,
                             index_col=0)
-    ps_raw = scores_df["p"]
-    ps_filtered = ps_raw[ps_raw != 1.0]
-    p_obs = -np.log10(ps_filtered)
+    tested = (scores_df["case_pos"] + scores_df["control_pos"]) > 0
+    # p values of 0 would be plotted at infinity, missing ones can't be plotted
+    ps_sorted = scores_df["p"][tested].dropna().clip(lower=np.finfo(float).tiny).sort_values()
+    p_obs = -np.log10(ps_sorted.values)
     p_exp = -np.log10(np.linspace(0, 1, num=len(p_obs) + 1, endpoint=False)[1:])
-    save_qq_plot(p_exp, p_obs, output_file + ".png")
 
-    return output_file + ".png"
+    x_sample, y_sample, genes = downsample_qq_points(p_exp, p_obs, ps_sorted.index.values)
+
+    save_qq_plot(x_sample, y_sample, output_file + ".png", lambda_gc=lambda_gc)
+
+    with open(output_file + ".json", "w") as json_file:
+        json.dump({
+            "expected": np.round(x_sample, 4).tolist(),
+            "observed": np.round(y_sample, 4).tolist(),
+            "genes": genes,
+            "lambda": lambda_gc if lambda_gc is not None and np.isfinite(lambda_gc) else None,
+        }, json_file, allow_nan=False)
 
+    return output_file + ".png", output_file + ".json"
 
-def save_qq_plot(x_sample, y_sample, output_file):
-    m, b = np.polyfit(x_sample, y_sample, 1)
 
-    upper = math.ceil(max(max(x_sample), max(y_sample)) + 0.5)
+def downsample_qq_points(p_exp, p_obs, genes, tail=1000, resolution=0.01):
+    """ reduces the number of QQ plot points: the tail (smallest p values) is kept as it is,
+        other points are binned to a grid, one point per occupied grid cell
+        :param p_exp: expected -log10(p) values, sorted descending
+        :param p_obs: observed -log10(p) values, sorted descending
+        :param genes: gene names for the points
+        :param tail: number of points with the smallest p values to keep
+        :param resolution: grid cell size in -log10(p) units
+        :return: tuple (expected values, observed values, gene names or None for binned points)
+    """
+    binned = np.unique(np.round(np.column_stack([p_exp[tail:], p_obs[tail:]]) / resolution), axis=0) * resolution
+
+    x_sample = np.concatenate([p_exp[:tail], binned[:, 0]])
+    y_sample = np.concatenate([p_obs[:tail], binned[:, 1]])
+    point_genes = [str(gene) for gene in genes[:tail]] + [None] * len(binned)
+
+    return x_sample, y_sample, point_genes
+
+
+def save_qq_plot(x_sample, y_sample, output_file, lambda_gc=None):
+    upper = math.ceil(max(max(x_sample, default=0), max(y_sample, default=0)) + 0.5)
     fig, ax = plt.subplots()
-    ax.scatter(x_sample, y_sample, color="royalblue")
-    ax.set_xlim(0, upper)
-    ax.set_ylim(0, upper)
-    ax.plot([0, upper], [0, upper], color="dimgrey")
-    ax.plot([0, upper], [b, b + m * upper], color="orange", ls="dashed")
-    ax.set_xlabel("-log10(p_exp)")
-    ax.set_ylabel("-log10(p_obs)")
-    fig.savefig(output_file, bbox_inches='tight')
 
+    try:
+        ax.scatter(x_sample, y_sample, color="royalblue", s=12, rasterized=True)
+        ax.set_xlim(0, upper)
+        ax.set_ylim(0, upper)
+        ax.plot([0, upper], [0, upper], color="dimgrey")
+        ax.set_xlabel("-log10(p_exp)")
+        ax.set_ylabel("-log10(p_obs)")
+        if lambda_gc is not None:
+            ax.set_title("lambda = %.3f" % lambda_gc)
+        fig.savefig(output_file, bbox_inches='tight')
+    finally:
+        # figures are kept by pyplot until closed, workers would accumulate them
+        plt.close(fig)
@@ -0,0 +1,244 @@
+import resource
+import subprocess
+import time
+from os import path
+
+import numpy as np
+
+try:
+    import prometheus_client
+except ImportError:  # metrics are optional
+    prometheus_client = None
+
+if prometheus_client:
+    RECORDS_PROCESSED = prometheus_client.Counter(
+        "variantenrichment_records_processed", "Variant records processed by streaming stages", ["stage"])
+    BYTES_READ = prometheus_client.Counter(
+        "variantenrichment_bytes_read", "Bytes read by streaming stages", ["stage"])
+    RECORDS_PER_SECOND = prometheus_client.Gauge(
+        "variantenrichment_records_per_second", "Throughput of the last streaming stage run", ["stage"],
+        multiprocess_mode="max")
+    STAGE_DURATION = prometheus_client.Histogram(
+        "variantenrichment_stage_duration_seconds", "Duration of streaming stages", ["stage"],
+        buckets=(1, 5, 15, 60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600))
+
+
+# wall time this process spent waiting for external tools, see run_command
+subprocess_time = 0.0
+
+
+def run_command(args, **kwargs):
+    """ subprocess.run which adds its wall time to subprocess_time """
+    global subprocess_time
+    start = time.monotonic()
+    try:
+        return subprocess.run(args, **kwargs)
+    finally:
+        subprocess_time += time.monotonic() - start
+
+
+def command_output(args, **kwargs):
+    """ subprocess.check_output which adds its wall time to subprocess_time """
+    global subprocess_time
+    start = time.monotonic()
+    try:
+        return subprocess.check_output(args, **kwargs)
+    finally:
+        subprocess_time += time.monotonic() - start
+
+
+def get_raw_stream(stream):
+    """ finds the underlying binary file of text and gzip wrappers, its position is the number of bytes read
+        (compressed bytes for gzipped files)
+    """
+    while True:
+        for attr in ("buffer", "fileobj"):
+            inner = getattr(stream, attr, None)
+            if inner is not None:
+                stream = inner
+                break
+        else:
+            return stream
+
+
+class RecordMeter:
+    """ Measures a record loop: records, bytes read, records/sec, elapsed and remaining time;
+        calls the callback (and updates prometheus metrics) at most once per interval
+    """
+    # checking the clock on every record would cost more than counting it
+    check_every = 1000
+
+    def __init__(self, stage, callback=None, interval=5.0):
+        self.stage = stage
+        self.callback = callback
+        self.interval = interval
+        self.records = 0
+        self.reported_records = 0
+        self.bytes_read = 0
+        self.reported_bytes = 0
+        self.total_bytes = None
+        self.stream = None
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    def attach(self, file_name, stream):
+        """ uses the position in the opened file to measure bytes read """
+        self.stream = get_raw_stream(stream)
+        self.total_bytes = path.getsize(file_name)
+
+    def update(self, records=1):
+        self.records += records
+        if self.records % self.check_every == 0 and time.monotonic() - self.last_report >= self.interval:
+            self.report()
+
+    def finish(self):
+        self.report()
+        if prometheus_client:
+            STAGE_DURATION.labels(self.stage).observe(self.elapsed)
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    @property
+    def records_per_second(self):
+        return self.records / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def percent(self):
+        if not self.total_bytes:
+            return None
+        return min(100.0 * self.bytes_read / self.total_bytes, 100.0)
+
+    @property
+    def eta(self):
+        """ estimated remaining seconds from the share of the file read so far """
+        if not self.total_bytes or not self.bytes_read:
+            return None
+        return self.elapsed * max(self.total_bytes - self.bytes_read, 0) / self.bytes_read
+
+    def report(self):
+        self.last_report = time.monotonic()
+
+        if self.stream is not None:
+            try:
+                self.bytes_read = self.stream.tell()
+            except (OSError, ValueError):
+                pass
+
+        if prometheus_client:
+            RECORDS_PROCESSED.labels(self.stage).inc(self.records - self.reported_records)
+            BYTES_READ.labels(self.stage).inc(max(self.bytes_read - self.reported_bytes, 0))
+            RECORDS_PER_SECOND.labels(self.stage).set(self.records_per_second)
+        self.reported_records, self.reported_bytes = self.records, self.bytes_read
+
+        if self.callback:
+            self.callback(self)
+
+
+def read_proc_io():
+    """ :return: tuple (bytes read, bytes written) by this process and its finished subprocesses,
+        (0, 0) where /proc/self/io is not available
+    """
+    try:
+        with open("/proc/self/io") as io:
+            counters = dict(line.split(": ") for line in io.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def reset_peak_rss():
+    """ resets the peak RSS of this process (linux >= 4.0), so that it can be measured per job
+        :return: True if the peak was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def read_peak_rss():
+    """ :return: peak RSS of this process in bytes """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_cpu_time():
+    """ :return: user + system cpu seconds of this process and its finished subprocesses """
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+class JobProfiler:
+    """ Measures a background job: wall and cpu time, peak RSS, bytes read and written
+        and wall time spent in external tools, subprocesses included
+        with JobProfiler() as profiler:
+            ...
+        profiler.wall_time, profiler.cpu_time, ...
+    """
+    def __enter__(self):
+        reset_peak_rss()
+        self.started = time.time()
+        self.finished = None
+        self._start = time.monotonic()
+        self._cpu = get_cpu_time()
+        self._io = read_proc_io()
+        self._subprocess_time = subprocess_time
+        self._children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return self
+
+    def __exit__(self, *exc_info):
+        self.finished = time.time()
+        self.wall_time = time.monotonic() - self._start
+        self.cpu_time = get_cpu_time() - self._cpu
+        io = read_proc_io()
+        self.bytes_read, self.bytes_written = io[0] - self._io[0], io[1] - self._io[1]
+        self.subprocess_time = subprocess_time - self._subprocess_time
+
+        # the peak of the largest subprocess only counts if it ran during the job
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        self.peak_rss = max(read_peak_rss(), children_rss * 1024 if children_rss > self._children_rss else 0)
+        return False
+
+
+def summarize_durations(durations, percentiles=(50, 95)):
+    """ :param durations: dictionary {key: list of durations in seconds}
+        :param percentiles: percentiles to compute
+        :return: list of dictionaries {"key", "count", "p50", "p95", ...} sorted by key
+    """
+    summary = []
+    for key in sorted(durations):
+        values = np.array([value for value in durations[key] if value is not None], dtype=float)
+        row = {"key": key, "count": len(values)}
+        for percentile in percentiles:
+            row["p%d" % percentile] = float(np.percentile(values, percentile)) if len(values) else None
+        summary.append(row)
+    return summary
+
+
+def start_metrics_server(port):
+    """ exports prometheus metrics of this process and, if PROMETHEUS_MULTIPROC_DIR is set,
+        of all worker child processes
+    """
+    if not prometheus_client:
+        return
+
+    from prometheus_client import multiprocess
+    from os import environ
+
+    if "PROMETHEUS_MULTIPROC_DIR" in environ or "prometheus_multiproc_dir" in environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        prometheus_client.start_http_server(port, registry=registry)
+    else:
+        prometheus_client.start_http_server(port)
@@ -0,0 +1,70 @@
+import os
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def count_jobs():
+    """ counts the jobs registered with io_job on this host, removing the entries of processes which are gone """
+    try:
+        entries = os.listdir(settings.IO_JOBS_DIR)
+    except FileNotFoundError:
+        return 0
+
+    running = 0
+    for entry in entries:
+        if entry.isdigit() and is_running(int(entry)):
+            running += 1
+            continue
+
+        try:
+            os.remove(os.path.join(settings.IO_JOBS_DIR, entry))
+        except FileNotFoundError:
+            pass
+
+    return running
+
+
+@contextmanager
+def io_job():
+    """ registers the job running in this process, so the jobs on the host share the I/O threads """
+    os.makedirs(settings.IO_JOBS_DIR, exist_ok=True)
+    entry = os.path.join(settings.IO_JOBS_DIR, str(os.getpid()))
+    open(entry, "w").close()
+
+    try:
+        yield
+    finally:
+        try:
+            os.remove(entry)
+        except FileNotFoundError:
+            pass
+
+
+def get_io_threads():
+    """ :return: compression and decompression threads of the current job: the IO_HOST_THREADS divided among
+        the jobs running on the host, at most IO_JOB_THREADS; checked again for every command,
+        so the share grows when other jobs finish
+    """
+    jobs = max(count_jobs(), 1)
+    return max(1, min(settings.IO_JOB_THREADS, settings.IO_HOST_THREADS // jobs))
+
+
+def bgzip_threads():
+    """ :return: bgzip options of the current thread share """
+    return ["-@", str(get_io_threads())]
+
+
+def bcftools_threads():
+    """ :return: bcftools options of the current thread share, used for compressing its output """
+    return ["--threads", str(get_io_threads())]
@@ -0,0 +1,84 @@
+import signal
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from variantenrichment.tool.annotation_daemon import AnnotationDaemon
+
+# seconds a daemon has to run to reset the restart delay
+STABLE_TIME = 60
+MAX_RESTART_DELAY = 60
+
+
+class Command(BaseCommand):
+    help = "Runs the annotation daemon which batches the jannovar annotations of the workers on this host, " \
+           "restarting it whenever it exits; set ANNOTATION_DAEMON_SOCKET for the workers to use it. " \
+           "Batching only raises the throughput when several jobs annotate at the same time: every batch " \
+           "starts a new jannovar process which loads its database, the daemon does not keep it loaded"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--socket", default=settings.ANNOTATION_DAEMON_SOCKET)
+        parser.add_argument("--concurrency", type=int, default=2, help="jannovar processes at the same time")
+        parser.add_argument("--batch-window", type=float, default=0.0,
+                            help="seconds to wait for more requests once a jannovar process is free, "
+                                 "the requests arriving while all are busy are annotated together anyway")
+        parser.add_argument("--max-batch", type=int, default=20, help="requests annotated together at most")
+        parser.add_argument("--max-pending", type=int, default=100,
+                            help="waiting requests beyond this number are refused")
+        parser.add_argument("--request-timeout", type=float, default=3600,
+                            help="seconds a request waits for its batch before it is answered with an error")
+        parser.add_argument("--no-supervise", action="store_true", help="serve in this process without restarts")
+
+    def handle(self, *args, **options):
+        if not options["socket"]:
+            raise CommandError("no socket given and ANNOTATION_DAEMON_SOCKET not set")
+
+        if options["no_supervise"]:
+            self.serve(options)
+        else:
+            self.supervise()
+
+    def serve(self, options):
+        daemon = AnnotationDaemon(options["socket"],
+                                  concurrency=options["concurrency"],
+                                  batch_window=options["batch_window"],
+                                  max_batch=options["max_batch"],
+                                  max_pending=options["max_pending"],
+                                  request_timeout=options["request_timeout"])
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        self.stdout.write("annotation daemon listening on %s" % options["socket"])
+
+        try:
+            daemon.serve_forever()
+        finally:
+            daemon.server_close()
+
+    def supervise(self):
+        """ runs the daemon in a child process and restarts it with a growing delay if it exits """
+        args = [sys.executable, sys.argv[0]] + sys.argv[1:] + ["--no-supervise"]
+        stopping = False
+        delay = 1
+        child = None
+
+        def stop(*args):
+            nonlocal stopping
+            stopping = True
+            if child:
+                child.terminate()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        while not stopping:
+            start = time.monotonic()
+            child = subprocess.Popen(args)
+            returncode = child.wait()
+            if stopping:
+                break
+
+            delay = 1 if time.monotonic() - start > STABLE_TIME else min(delay * 2, MAX_RESTART_DELAY)
+            self.stderr.write("annotation daemon exited with code %d, restarting in %d s" % (returncode, delay))
+            time.sleep(delay)
@@ -0,0 +1,43 @@
+import time
+
+import numpy as np
+import scipy.sparse as sparse
+from django.core.management.base import BaseCommand
+
+from variantenrichment.tool.burden import STATISTICAL_TESTS, run_burden_test
+
+
+class Command(BaseCommand):
+    help = "Times the burden tests on synthetic genotype blocks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--genes", type=int, default=2000)
+        parser.add_argument("--cases", type=int, default=200)
+        parser.add_argument("--controls", type=int, default=2000)
+        parser.add_argument("--max-variants", type=int, default=40, help="maximal number of variants per gene")
+        parser.add_argument("--frequency", type=float, default=0.005, help="carrier frequency per variant")
+        parser.add_argument("--threads", type=int, default=None)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--tests", nargs="+", default=list(STATISTICAL_TESTS.keys()),
+                            choices=list(STATISTICAL_TESTS.keys()))
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options["seed"])
+        samples_num = options["cases"] + options["controls"]
+        phenotypes = np.concatenate([np.ones(options["cases"]), np.zeros(options["controls"])])
+
+        blocks = {}
+        for gene in range(options["genes"]):
+            variants_num = rng.integers(1, options["max_variants"] + 1)
+            genotypes = (rng.random((variants_num, samples_num)) < options["frequency"]).astype(np.int8)
+            # sparse like the blocks of get_genotype_blocks
+            blocks["GENE%d" % gene] = (sparse.csr_matrix(genotypes), rng.uniform(1, 40, variants_num))
+
+        for test_name in options["tests"]:
+            start = time.perf_counter()
+            pvalues = run_burden_test(test_name, blocks, phenotypes, threads=options["threads"])
+            elapsed = time.perf_counter() - start
+
+            self.stdout.write("%s: %d genes x %d samples in %.2f s (%.0f genes/s), %.3f of p values < 0.05" % (
+                test_name, len(blocks), samples_num, elapsed, len(blocks) / elapsed, (pvalues < 0.05).mean()
+            ))
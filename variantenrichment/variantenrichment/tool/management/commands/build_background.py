@@ -0,0 +1,71 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from variantenrichment.tool.background import BackgroundError, normalize_background, write_background_sidecar
+from variantenrichment.tool.functions import annotate_sample, get_directory
+from variantenrichment.tool.models import BackgroundSet
+from variantenrichment.tool.references import get_annotation_db_version, get_bundle, get_resources
+from variantenrichment.tool.synthetic import has_tools
+
+BACKGROUNDS_DIR = "variantenrichment/data/backgrounds/"
+
+
+class Command(BaseCommand):
+    help = "Normalizes, annotates, indexes and validates a background vcf file once, writes its variants and " \
+           "carriers as a numpy sidecar and registers it as a background set with the annotation version"
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", help="name of the background set")
+        parser.add_argument("vcf", help="background vcf file")
+        parser.add_argument("samples", help="tab delimited file with 'Sample name' and 'Superpopulation code' columns")
+        parser.add_argument("--output", help="directory for the built files, %s<name> by default" % BACKGROUNDS_DIR)
+        parser.add_argument("--reference", default=settings.DEFAULT_REFERENCE, choices=list(settings.REFERENCE_BUNDLES),
+                            help="reference bundle to annotate with")
+        parser.add_argument("--threads", type=int,
+                            help="compression threads of bcftools, by default the share of IO_HOST_THREADS")
+
+    def handle(self, *args, **options):
+        if not has_tools("bcftools", "bgzip", "tabix", "jannovar"):
+            raise CommandError("bcftools, bgzip, tabix and jannovar are needed")
+
+        name = options["name"]
+        output = get_directory(options["output"] or BACKGROUNDS_DIR + name)
+
+        bundle = get_resources().get(options["reference"])
+
+        start = time.monotonic()
+        normalized = normalize_background(options["vcf"], os.path.join(output, "background.normalized"),
+                                          threads=options["threads"])
+        self.stdout.write("normalized: %.1f s" % (time.monotonic() - start))
+
+        start = time.monotonic()
+        annotated = annotate_sample(vcf_file=normalized,
+                                    fasta_file=bundle.fasta_file,
+                                    gnomad_file=bundle.gnomad_exomes_file,
+                                    db_file=bundle.db_file,
+                                    output_file=os.path.join(output, "background.annotated"))
+        os.remove(normalized)
+        self.stdout.write("annotated: %.1f s" % (time.monotonic() - start))
+
+        start = time.monotonic()
+        try:
+            sidecar, variants = write_background_sidecar(annotated, options["samples"],
+                                                         os.path.join(output, "background.carriers"))
+        except BackgroundError as e:
+            raise CommandError(e)
+        self.stdout.write("validated %d variants: %.1f s" % (variants, time.monotonic() - start))
+
+        BackgroundSet.objects.update_or_create(name=name, defaults={
+            "file": os.path.abspath(annotated),
+            "samples_file": os.path.abspath(options["samples"]),
+            "annotation_version": get_annotation_db_version(get_bundle(bundle.name)),
+            "reference": bundle.name,
+            "sidecar_file": os.path.abspath(sidecar),
+            "variants": variants,
+            "built": timezone.now()
+        })
+        self.stdout.write("registered background set %s" % name)
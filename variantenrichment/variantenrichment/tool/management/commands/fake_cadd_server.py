@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from variantenrichment.tool.fake_cadd import FakeCaddServer
+
+
+class Command(BaseCommand):
+    help = "Runs a local stand-in for the CADD server, point CADD_URL to it"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8001)
+        parser.add_argument("--delay", type=float, default=0.0, help="seconds until uploaded files are scored")
+        parser.add_argument("--failures", type=int, default=0, help="number of first requests failing with 503")
+
+    def handle(self, *args, **options):
+        server = FakeCaddServer((options["host"], options["port"]), delay=options["delay"],
+                                failures=options["failures"])
+        self.stdout.write("CADD_URL=%s" % server.url)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.shutdown()
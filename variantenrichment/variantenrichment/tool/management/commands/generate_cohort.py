@@ -0,0 +1,98 @@
+import os
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from variantenrichment.tool.functions import get_genes_dict
+from variantenrichment.tool.models import BackgroundSet
+from variantenrichment.tool.references import get_annotation_db_version, get_bundle
+from variantenrichment.tool.synthetic import make_gene_names, make_gene_model, generate_variants, write_vcf, \
+    write_inheritance_file, write_bed_file, write_samples_file, get_sample_names, has_tools
+
+
+class Command(BaseCommand):
+    help = "Generates a synthetic case cohort and background set: bgzipped and indexed vcf files, " \
+           "inheritance, bed and background samples files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="directory for the generated files")
+        parser.add_argument("--inheritance", help="inheritance file with the genes to use, "
+                                                  "random genes are generated if not given")
+        parser.add_argument("--genes", type=int, default=1000, help="number of random genes")
+        parser.add_argument("--variants-per-gene", type=int, default=10)
+        parser.add_argument("--case-samples", type=int, default=100)
+        parser.add_argument("--control-samples", type=int, default=1000)
+        parser.add_argument("--enriched-genes", type=int, default=10,
+                            help="number of genes with more variants in the case cohort")
+        parser.add_argument("--effect-size", type=float, default=5.0,
+                            help="factor applied to the allele frequencies in enriched genes of the case cohort")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--threads", type=int, default=1, help="bgzip compression threads")
+        parser.add_argument("--background-name", help="register the control cohort as a background set")
+
+    def handle(self, *args, **options):
+        if not has_tools("bgzip", "tabix"):
+            raise CommandError("bgzip and tabix are needed")
+
+        output = options["output"]
+        os.makedirs(output, exist_ok=True)
+        seed = options["seed"]
+
+        if options["inheritance"]:
+            genes = get_genes_dict(options["inheritance"])
+        else:
+            genes = make_gene_names(options["genes"], seed=seed)
+
+        if options["enriched_genes"] > len(genes):
+            raise CommandError("only %d genes available" % len(genes))
+
+        gene_model = make_gene_model(genes)
+        enriched_genes = sorted(np.random.default_rng(seed).choice(list(genes), size=options["enriched_genes"],
+                                                                   replace=False))
+
+        inheritance = write_inheritance_file(genes, os.path.join(output, "inheritance"))
+        bed = write_bed_file(gene_model, os.path.join(output, "genes"))
+        with open(os.path.join(output, "enriched_genes.txt"), "w") as file:
+            file.write("".join(gene + "\n" for gene in enriched_genes))
+
+        start = time.monotonic()
+        # case and control share the variants (same seed) but not the genotypes
+        case = write_vcf(os.path.join(output, "case"),
+                         generate_variants(gene_model, options["variants_per_gene"], seed=seed),
+                         options["case_samples"],
+                         sample_prefix="case",
+                         seed=seed + 1,
+                         enriched_genes=enriched_genes,
+                         effect_size=options["effect_size"],
+                         compress=True,
+                         threads=options["threads"])
+        self.stdout.write("%s: %.1f s" % (case, time.monotonic() - start))
+
+        start = time.monotonic()
+        control = write_vcf(os.path.join(output, "background"),
+                            generate_variants(gene_model, options["variants_per_gene"], seed=seed),
+                            options["control_samples"],
+                            sample_prefix="control",
+                            seed=seed + 2,
+                            compress=True,
+                            threads=options["threads"])
+        self.stdout.write("%s: %.1f s" % (control, time.monotonic() - start))
+
+        samples = write_samples_file(get_sample_names("control", options["control_samples"]),
+                                     os.path.join(output, "background.samples"),
+                                     seed=seed + 3)
+
+        for file in (inheritance, bed, samples):
+            self.stdout.write(file)
+
+        if options["background_name"]:
+            BackgroundSet.objects.update_or_create(name=options["background_name"], defaults={
+                "file": os.path.abspath(control),
+                "samples_file": os.path.abspath(samples),
+                # the synthetic variants carry ANN and GNOMAD_EXOMES_AF_ALL like an annotated background set
+                "annotation_version": get_annotation_db_version(get_bundle(settings.DEFAULT_REFERENCE)),
+                "reference": settings.DEFAULT_REFERENCE
+            })
+            self.stdout.write("registered background set %s" % options["background_name"])
@@ -0,0 +1,259 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+
+from config.celery_app import app
+from variantenrichment.tool.fake_cadd import FakeCaddServer
+from variantenrichment.tool.instrumentation import summarize_durations
+from variantenrichment.tool.models import BackgroundSet, Project
+from variantenrichment.tool.references import get_annotation_db_version, get_bundle
+from variantenrichment.tool.synthetic import make_gene_names, make_gene_model, generate_variants, write_vcf, \
+    write_inheritance_file, write_samples_file, get_sample_names, install_tool_stubs, has_tools
+
+FINAL_STATES = ["done", "cadd-error", "background-error"]
+
+
+class LoadTest:
+    """ Runs projects through the web views concurrently and collects latencies and query counts per view
+        as well as queue depth and busy worker processes over time
+    """
+    def __init__(self, files, host, cadd_score, timeout):
+        self.files = files
+        self.host = host
+        self.cadd_score = cadd_score
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # view name: list of (latency, number of queries)
+        self.requests = {}
+        self.end_to_end = []
+        self.failures = []
+        self.samples = []
+
+    def request(self, client, view, method, url, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.monotonic()
+            response = getattr(client, method)(url, **kwargs)
+            latency = time.monotonic() - start
+
+        if response.status_code >= 400:
+            raise RuntimeError("%s %s returned %d" % (method.upper(), url, response.status_code))
+
+        with self.lock:
+            self.requests.setdefault(view, []).append((latency, len(queries)))
+        return response
+
+    def run_project(self, number):
+        client = Client(SERVER_NAME=self.host)
+        start = time.monotonic()
+
+        try:
+            with open(self.files["inheritance"], "rb") as inheritance:
+                response = self.request(client, "ProjectCreateView", "post", reverse("project-create"), data={
+                    "title": "load test %d" % number,
+                    "impact": "MODERATE",
+                    "frequency": "0.001",
+                    "reference": settings.DEFAULT_REFERENCE,
+                    "background": self.files["background"].pk,
+                    "cadd_score": self.cadd_score or "",
+                    "statistical_test": "fisher",
+                    "permutations": 0,
+                    "inheritance": inheritance
+                })
+            project_uuid = resolve(response.url).kwargs["pk"]
+
+            with open(self.files["case"], "rb") as case:
+                self.request(client, "FileUploadView", "post", reverse("file-upload", args=[project_uuid]), data={
+                    "individual_name": "case",
+                    "uploaded_file": case
+                })
+
+            self.request(client, "ConfirmProcessingView", "post", reverse("confirm-processing", args=[project_uuid]))
+
+            state = self.wait_for_project(project_uuid, start)
+            if state != "done":
+                raise RuntimeError("project %s ended in state %s" % (project_uuid, state))
+
+            self.request(client, "ProjectResultsView", "get", reverse("project-results", args=[project_uuid]))
+            self.request(client, "ProjectScoresView", "get", reverse("project-scores", args=[project_uuid]))
+
+            with self.lock:
+                self.end_to_end.append(time.monotonic() - start)
+
+        except Exception as e:
+            with self.lock:
+                self.failures.append("project %d: %s" % (number, e))
+        finally:
+            connection.close()
+
+    def wait_for_project(self, project_uuid, start):
+        while time.monotonic() - start < self.timeout:
+            state = Project.objects.filter(uuid=project_uuid).values_list("state", flat=True).first()
+            if state in FINAL_STATES:
+                return state
+            time.sleep(1)
+        return "timeout"
+
+    def monitor(self, stop, interval):
+        """ samples the celery queue length and the busy worker processes until stop is set """
+        broker = redis.Redis.from_url(app.conf.broker_url)
+        start = time.monotonic()
+
+        while not stop.wait(interval):
+            inspect = app.control.inspect(timeout=1)
+            active, stats = inspect.active() or {}, inspect.stats() or {}
+            processes = sum(worker["pool"].get("max-concurrency", 0) for worker in stats.values())
+            self.samples.append({
+                "time": time.monotonic() - start,
+                "queue_depth": broker.llen("celery"),
+                "busy": sum(len(tasks) for tasks in active.values()),
+                "processes": processes
+            })
+
+    def report(self):
+        views = summarize_durations({view: [latency for latency, _ in values]
+                                     for view, values in self.requests.items()})
+        for row in views:
+            queries = [count for _, count in self.requests[row["key"]]]
+            row["queries_max"] = max(queries)
+            row["queries_mean"] = sum(queries) / len(queries)
+
+        saturation = [sample["busy"] / sample["processes"] for sample in self.samples if sample["processes"]]
+
+        return {
+            "views": views,
+            "end_to_end": summarize_durations({"project": self.end_to_end})[0],
+            "queue_depth_max": max((sample["queue_depth"] for sample in self.samples), default=None),
+            "worker_saturation_mean": sum(saturation) / len(saturation) if saturation else None,
+            "samples": self.samples,
+            "failures": self.failures
+        }
+
+
+class Command(BaseCommand):
+    help = "Drives concurrent projects through the web views and the celery workers on synthetic data " \
+           "with a jannovar stand-in and a local fake CADD server, and reports latencies, query counts, " \
+           "queue depth and worker saturation; run it from the directory the workers run in"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--projects", type=int, default=10)
+        parser.add_argument("--concurrency", type=int, default=5, help="projects driven at the same time")
+        parser.add_argument("--case-samples", type=int, default=20)
+        parser.add_argument("--control-samples", type=int, default=500)
+        parser.add_argument("--genes", type=int, default=200)
+        parser.add_argument("--variants-per-gene", type=int, default=10)
+        parser.add_argument("--cadd-score", type=int, help="filter by CADD scores of the fake server")
+        parser.add_argument("--cadd-delay", type=float, default=0.0, help="seconds until fake CADD scores are ready")
+        parser.add_argument("--start-worker", action="store_true",
+                            help="start a celery worker using the stand-ins, otherwise the running workers "
+                                 "need PATH and CADD_URL as printed")
+        parser.add_argument("--worker-concurrency", type=int, default=4)
+        parser.add_argument("--host", default="localhost", help="host name the requests are made for")
+        parser.add_argument("--interval", type=float, default=2.0, help="seconds between queue samples")
+        parser.add_argument("--timeout", type=float, default=1800.0, help="seconds a project may take")
+        parser.add_argument("--output", help="json file for the results")
+
+    def handle(self, *args, **options):
+        if not has_tools("bcftools", "bgzip", "tabix"):
+            raise CommandError("bcftools, bgzip and tabix are needed")
+
+        # the synthetic files and tool stubs are removed however the run ends
+        directory = tempfile.mkdtemp(prefix="load_test_")
+        try:
+            load_test = self.run_load_test(directory, options)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        report = load_test.report()
+        for row in report["views"]:
+            self.stdout.write("%(key)s: p50 %(p50).3f s, p95 %(p95).3f s, queries mean %(queries_mean).1f, "
+                              "max %(queries_max)d" % row)
+        if report["end_to_end"]["count"]:
+            self.stdout.write("end to end: p50 %(p50).1f s, p95 %(p95).1f s" % report["end_to_end"])
+        self.stdout.write("max queue depth: %s, mean worker saturation: %s" % (
+            report["queue_depth_max"], report["worker_saturation_mean"]))
+
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump(report, file, indent=2)
+
+        if report["failures"]:
+            raise CommandError("%d projects failed:\n%s" % (len(report["failures"]), "\n".join(report["failures"])))
+
+    def run_load_test(self, directory, options):
+        """ runs the projects against the server with the files and tool stubs in directory
+            :return: LoadTest with the measurements
+        """
+        files = self.generate_files(directory, options)
+
+        cadd_server = FakeCaddServer(delay=options["cadd_delay"]).start()
+        env = dict(os.environ,
+                   PATH=install_tool_stubs(os.path.join(directory, "bin")) + os.pathsep + os.environ["PATH"],
+                   CADD_URL=cadd_server.url)
+
+        worker = None
+        if options["start_worker"]:
+            worker = subprocess.Popen(["celery", "-A", "config.celery_app", "worker", "-l", "warning",
+                                       "--concurrency", str(options["worker_concurrency"])], env=env)
+        else:
+            self.stdout.write("workers need PATH=%s and CADD_URL=%s" % (env["PATH"], env["CADD_URL"]))
+
+        load_test = LoadTest(files, options["host"], options["cadd_score"], options["timeout"])
+        stop = threading.Event()
+        monitor = threading.Thread(target=load_test.monitor, args=(stop, options["interval"]), daemon=True)
+        monitor.start()
+
+        try:
+            with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+                list(executor.map(load_test.run_project, range(options["projects"])))
+        finally:
+            stop.set()
+            monitor.join()
+            cadd_server.shutdown()
+            if worker:
+                worker.terminate()
+                worker.wait()
+            Project.objects.filter(background=files["background"]).delete()
+            files["background"].delete()
+
+        return load_test
+
+    def generate_files(self, directory, options):
+        genes = make_gene_names(options["genes"], seed=0)
+        gene_model = make_gene_model(genes)
+
+        case = write_vcf(os.path.join(directory, "case"),
+                         generate_variants(gene_model, options["variants_per_gene"], seed=1),
+                         options["case_samples"], sample_prefix="case", seed=2,
+                         enriched_genes=list(genes)[:max(options["genes"] // 50, 1)], effect_size=5.0,
+                         compress=True)
+        control = write_vcf(os.path.join(directory, "background"),
+                            generate_variants(gene_model, options["variants_per_gene"], seed=1),
+                            options["control_samples"], sample_prefix="control", seed=3, compress=True)
+        samples = write_samples_file(get_sample_names("control", options["control_samples"]),
+                                     os.path.join(directory, "background.samples"))
+
+        background, _ = BackgroundSet.objects.update_or_create(name="load-test", defaults={
+            "file": control,
+            "samples_file": samples,
+            "annotation_version": get_annotation_db_version(get_bundle(settings.DEFAULT_REFERENCE)),
+            "reference": settings.DEFAULT_REFERENCE
+        })
+
+        return {
+            "case": case,
+            "inheritance": write_inheritance_file(genes, os.path.join(directory, "inheritance")),
+            "background": background
+        }
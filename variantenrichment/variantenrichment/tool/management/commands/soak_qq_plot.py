@@ -0,0 +1,54 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+
+from variantenrichment.tool.functions import visualize_p_values
+
+
+def get_rss():
+    """ current resident set size of this process in bytes """
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class Command(BaseCommand):
+    help = "Renders the QQ plot stage repeatedly and checks that the process memory stays flat"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=1000)
+        parser.add_argument("--genes", type=int, default=20000)
+        parser.add_argument("--warmup", type=int, default=100, help="runs before the baseline RSS is taken")
+        parser.add_argument("--max-growth", type=float, default=20.0, help="allowed RSS growth in MB")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options["seed"])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            scores_file = os.path.join(tmp_dir, "scores.csv")
+            pd.DataFrame({
+                "case_pos": rng.integers(0, 20, options["genes"]),
+                "case_neg": 100,
+                "control_pos": rng.integers(0, 20, options["genes"]),
+                "control_neg": 1000,
+                "p": rng.uniform(size=options["genes"]),
+            }, index=["GENE%d" % i for i in range(options["genes"])]).to_csv(scores_file)
+
+            baseline = None
+            for run in range(1, options["runs"] + 1):
+                visualize_p_values(scores_file, os.path.join(tmp_dir, "qq_plot"), lambda_gc=1.0)
+
+                if run == options["warmup"]:
+                    baseline = get_rss()
+
+                if run % 100 == 0:
+                    self.stdout.write("run %d: RSS %.1f MB" % (run, get_rss() / 2 ** 20))
+
+        growth = (get_rss() - (baseline or get_rss())) / 2 ** 20
+        self.stdout.write("RSS growth after warmup: %.1f MB" % growth)
+
+        if growth > options["max_growth"]:
+            raise CommandError("RSS grew by %.1f MB, more than %.1f MB" % (growth, options["max_growth"]))
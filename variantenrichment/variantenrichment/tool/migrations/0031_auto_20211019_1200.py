@@ -0,0 +1,23 @@
+# Generated by Django 3.0.13 on 2021-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0030_project_population'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='permutations',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='permutation_seed',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.13 on 2021-10-19 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0031_auto_20211019_1200'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='statistical_test',
+            field=models.CharField(choices=[('fisher', 'Fisher exact test on collapsed carriers'), ('cmc', 'CMC burden test'), ('skat', 'SKAT variance-component test')], default='fisher', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='cadd_weights',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.0.13 on 2021-10-19 14:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0032_auto_20211019_1300'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProjectStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('genes_tested', models.IntegerField(default=0)),
+                ('significant_genes', models.IntegerField(default=0)),
+                ('bonferroni_threshold', models.FloatField(blank=True, null=True)),
+                ('fwer_threshold', models.FloatField(blank=True, null=True)),
+                ('lambda_gc', models.FloatField(blank=True, null=True)),
+                ('lambda_gc_syn', models.FloatField(blank=True, null=True)),
+                ('project', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='tool.Project')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.13 on 2021-10-19 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0033_auto_20211019_1400'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectfiles',
+            name='scores_table',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.13 on 2021-10-19 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0034_projectfiles_scores_table'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectfiles',
+            name='qq_plot_points',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='projectfiles',
+            name='qq_plot_syn_points',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+    ]
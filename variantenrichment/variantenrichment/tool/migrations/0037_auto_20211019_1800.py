@@ -0,0 +1,40 @@
+# Generated by Django 3.0.13 on 2021-10-19 18:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0036_auto_20211019_1700'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='JobMetrics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField()),
+                ('queue_latency', models.FloatField(blank=True, null=True)),
+                ('wall_time', models.FloatField()),
+                ('cpu_time', models.FloatField()),
+                ('subprocess_time', models.FloatField()),
+                ('peak_rss', models.BigIntegerField()),
+                ('bytes_read', models.BigIntegerField()),
+                ('bytes_written', models.BigIntegerField()),
+                ('job', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='metrics', to='tool.BackgroundJob')),
+            ],
+            options={
+                'verbose_name_plural': 'job metrics',
+            },
+        ),
+    ]
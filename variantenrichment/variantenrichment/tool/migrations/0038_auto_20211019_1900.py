@@ -0,0 +1,23 @@
+# Generated by Django 3.0.13 on 2021-10-19 19:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0037_auto_20211019_1800'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='profile',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='jobmetrics',
+            name='profile',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.13 on 2021-10-20 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0038_auto_20211019_1900'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectfiles',
+            name='cadd_posted',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='projectfiles',
+            name='cadd_checks',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='projectfiles',
+            name='cadd_next_check',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.0.13 on 2021-10-21 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0039_auto_20211020_1000'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backgroundset',
+            name='annotation_version',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='backgroundset',
+            name='reference',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='backgroundset',
+            name='sidecar_file',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='backgroundset',
+            name='variants',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backgroundset',
+            name='built',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='project',
+            name='state',
+            field=models.CharField(choices=[('initial', 'Initial'), ('annotating', 'Annotating variants'), ('annotated', 'Ready for filtering'), ('filtering', 'Filtering data sets'), ('cadd-waiting', 'Waiting for CADD answer'), ('cadd-checking', 'Checking if CADD scores are ready'), ('cadd-filtering', 'Annotating with CADD functional scores and filtering data sets by PHRED cutoff'), ('cadd-error', 'No answer from CADD server'), ('background-error', 'Background set is not annotated like the case files'), ('analyzing', 'Analyzing datasets and computing statistics'), ('done', 'Done')], default='initial', max_length=20),
+        ),
+    ]
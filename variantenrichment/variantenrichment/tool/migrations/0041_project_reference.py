@@ -0,0 +1,18 @@
+# Generated by Django 3.0.13 on 2021-10-22 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0040_auto_20211021_0900'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='reference',
+            field=models.CharField(choices=[('GRCh37', 'GRCh37'), ('GRCh38', 'GRCh38')], default='GRCh37', max_length=20),
+        ),
+    ]
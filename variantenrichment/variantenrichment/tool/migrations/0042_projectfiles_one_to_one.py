@@ -0,0 +1,36 @@
+# Generated by Django 3.0.13 on 2021-10-25 10:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def remove_duplicate_project_files(apps, schema_editor):
+    """ keeps the last created files of every project, the pipeline only ever used that one """
+    ProjectFiles = apps.get_model('tool', 'ProjectFiles')
+    last = models.Max('pk')
+    keep = ProjectFiles.objects.values('project').annotate(last=last).values_list('last', flat=True)
+    ProjectFiles.objects.exclude(pk__in=list(keep)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tool', '0041_project_reference'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_project_files, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='projectfiles',
+            name='project',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='tool.Project'),
+        ),
+        migrations.AddIndex(
+            model_name='backgroundjob',
+            index=models.Index(fields=['project', 'state'], name='tool_job_project_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='backgroundjob',
+            index=models.Index(fields=['project', 'created'], name='tool_job_project_created_idx'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 import uuid
+from django.conf import settings
 from django.db import models
 from django.contrib.postgres.fields import ArrayField
 
@@ -11,6 +12,10 @@ def get_project_directory(instance, filename):
     return 'projects/{0}/{1}'.format(instance.uuid, filename)
 
 
+def get_reference_choices():
+    return [(name, name) for name in settings.REFERENCE_BUNDLES]
+
+
 def get_default_bgset():
     """ get a default value for result status; create new result if not available """
     return BackgroundSet.objects.get_or_create(name="IGSR")[0]
@@ -23,6 +28,13 @@ class BackgroundSet(models.Model):
     name = models.CharField(max_length=30, unique=True)
     file = models.CharField(max_length=200)
     samples_file = models.CharField(max_length=200)
+    # set by the build_background command or in the admin, projects only use background sets annotated like
+    # their case files; sets without a version are used unverified
+    annotation_version = models.CharField(max_length=200, blank=True)
+    reference = models.CharField(max_length=200, blank=True)
+    sidecar_file = models.CharField(max_length=200, blank=True)
+    variants = models.PositiveIntegerField(null=True, blank=True)
+    built = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return self.name
@@ -40,13 +52,21 @@ class Project(models.Model):
         ('cadd-checking', 'Checking if CADD scores are ready'),
         ('cadd-filtering', 'Annotating with CADD functional scores and filtering data sets by PHRED cutoff'),
         ('cadd-error', 'No answer from CADD server'),
+        ('background-error', 'Background set is not annotated like the case files'),
         ('analyzing', 'Analyzing datasets and computing statistics'),
         ('done', 'Done')
     ]
+    # states in which a background job is working on the project
+    PROCESSING_STATES = ['annotating', 'filtering', 'cadd-checking', 'cadd-filtering', 'analyzing']
     IMPACT_CHOICES = [
         ('MODERATE', 'Moderate'),
         ('HIGH', 'High')
     ]
+    TEST_CHOICES = [
+        ('fisher', 'Fisher exact test on collapsed carriers'),
+        ('cmc', 'CMC burden test'),
+        ('skat', 'SKAT variance-component test')
+    ]
 
     uuid = models.UUIDField(
         primary_key=True,
@@ -54,7 +74,7 @@ class Project(models.Model):
         editable=False)
     title = models.CharField(max_length=100)
     state = models.CharField(
-        max_length=15,
+        max_length=20,
         choices=STATE_CHOICES,
         default='initial'
     )
@@ -80,8 +100,22 @@ class Project(models.Model):
         BackgroundSet,
         default=get_default_bgset,
         on_delete=models.SET_DEFAULT)
+    reference = models.CharField(
+        max_length=20,
+        choices=get_reference_choices(),
+        default=settings.DEFAULT_REFERENCE)
     population = ArrayField(models.CharField(max_length=3), default=list, null=True, blank=True)
     cadd_score = models.IntegerField(null=True, blank=True)
+    statistical_test = models.CharField(
+        max_length=10,
+        choices=TEST_CHOICES,
+        default='fisher'
+    )
+    cadd_weights = models.BooleanField(default=False)
+    permutations = models.PositiveIntegerField(default=0)
+    permutation_seed = models.IntegerField(null=True, blank=True)
+    # store a cProfile dump of every pipeline stage
+    profile = models.BooleanField(default=False)
     genomic_regions = models.FileField(upload_to=get_project_directory, blank=True)
     inheritance = models.FileField(upload_to=get_project_directory)
 
@@ -107,7 +141,7 @@ class ProjectFiles(models.Model):
     """ Stores paths to last created case and control files,
         CADD job ids and paths to downloaded CADD tsv files
     """
-    project = models.ForeignKey(
+    project = models.OneToOneField(
         Project,
         on_delete=models.CASCADE
     )
@@ -118,16 +152,41 @@ class ProjectFiles(models.Model):
     cadd_case = models.CharField(max_length=200, blank=True)
     cadd_control_id = models.CharField(max_length=60, blank=True)
     cadd_control = models.CharField(max_length=200, blank=True)
+    # polling of the CADD server for the posted files
+    cadd_posted = models.DateTimeField(null=True, blank=True)
+    cadd_checks = models.PositiveIntegerField(default=0)
+    cadd_next_check = models.DateTimeField(null=True, blank=True)
     case_csv = models.CharField(max_length=200, blank=True)
     control_csv = models.CharField(max_length=200, blank=True)
     scores_csv = models.CharField(max_length=200, blank=True)
+    scores_table = models.CharField(max_length=200, blank=True)
     qq_plot = models.CharField(max_length=200, blank=True)
     qq_plot_syn = models.CharField(max_length=200, blank=True)
+    qq_plot_points = models.CharField(max_length=200, blank=True)
+    qq_plot_syn_points = models.CharField(max_length=200, blank=True)
 
     def __str__(self):
         return self.case_annotated
 
 
+class ProjectStatistics(models.Model):
+    """ Stores multiple testing and genomic inflation summary of the last statistics run
+    """
+    project = models.OneToOneField(
+        Project,
+        on_delete=models.CASCADE
+    )
+    genes_tested = models.IntegerField(default=0)
+    significant_genes = models.IntegerField(default=0)
+    bonferroni_threshold = models.FloatField(null=True, blank=True)
+    fwer_threshold = models.FloatField(null=True, blank=True)
+    lambda_gc = models.FloatField(null=True, blank=True)
+    lambda_gc_syn = models.FloatField(null=True, blank=True)
+
+    def __str__(self):
+        return str(self.project) + ': ' + str(self.genes_tested) + ' genes tested'
+
+
 class BackgroundJob(models.Model):
     """ Describes jobs that are passed to Celery to run as background tasks
     """
@@ -148,6 +207,76 @@ class BackgroundJob(models.Model):
         choices=STATE_CHOICES,
         default='new'
     )
+    created = models.DateTimeField(auto_now_add=True)
+
+    # progress of the record loop currently running in the job
+    stage = models.CharField(max_length=50, blank=True)
+    records_processed = models.BigIntegerField(default=0)
+    bytes_read = models.BigIntegerField(default=0)
+    records_per_second = models.FloatField(null=True, blank=True)
+    elapsed = models.FloatField(null=True, blank=True)
+    eta = models.FloatField(null=True, blank=True)
+    progress_updated = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'state'], name='tool_job_project_state_idx'),
+            models.Index(fields=['project', 'created'], name='tool_job_project_created_idx'),
+        ]
 
     def __str__(self):
         return self.name + ': ' + self.state
+
+
+class JobMetrics(models.Model):
+    """ Stores timing and resource usage of a finished background job,
+        cpu time, peak RSS and bytes read/written include the external tools run by the job
+    """
+    job = models.OneToOneField(
+        BackgroundJob,
+        on_delete=models.CASCADE,
+        related_name='metrics'
+    )
+    started = models.DateTimeField()
+    finished = models.DateTimeField()
+    queue_latency = models.FloatField(null=True, blank=True)
+    wall_time = models.FloatField()
+    cpu_time = models.FloatField()
+    subprocess_time = models.FloatField()
+    peak_rss = models.BigIntegerField()
+    bytes_read = models.BigIntegerField()
+    bytes_written = models.BigIntegerField()
+    # cProfile dump if the project was run with profiling
+    profile = models.CharField(max_length=200, blank=True)
+
+    class Meta:
+        verbose_name_plural = "job metrics"
+
+    def __str__(self):
+        return "%s: %.1f s" % (self.job.name, self.wall_time)
+
+
+class Artifact(models.Model):
+    """ File written into the project directory by a pipeline stage,
+        tracked to compress or delete intermediates and to keep the disk use within the quotas
+    """
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE
+    )
+    path = models.CharField(max_length=300)
+    stage = models.CharField(max_length=30)
+    size = models.BigIntegerField()
+    checksum = models.CharField(max_length=64)
+    # modification time of the file when the checksum was computed
+    modified = models.DateTimeField()
+    compressed = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['project', 'path'], name='tool_artifact_project_path')
+        ]
+
+    def __str__(self):
+        return self.path
@@ -1,23 +1,104 @@
+import logging
+from datetime import timedelta
 from time import sleep
-from .models import Project, VariantFile, ProjectFiles
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from .models import Project, VariantFile, ProjectFiles, ProjectStatistics, BackgroundJob
+from .context import JobContext
 from .functions import get_directory, merge_files, annotate_sample, \
     filter_by_gene, filter_by_impact, filter_by_frequency, filter_file, \
-    get_genes_dict, count_variants, find_fisher_scores, \
+    get_genes_dict, count_variants, find_fisher_scores, find_permutation_scores, correct_p_values, \
     post_file_cadd, save_cadd_file, add_cadd_annotations, filter_by_cadd, filter_population, visualize_p_values
+from .burden import find_burden_scores
+from .results import save_scores_table
+from .progress import publish_progress
+from .instrumentation import RecordMeter
+from .cadd import AsyncCaddClient
+from .annotation_cache import AnnotationCache, annotate_sample_cached
+from .references import get_bundle, get_annotation_db_version, get_resources
 
 FILES_DIR = "variantenrichment/data/projects/"
-DB_FILE = "variantenrichment/data/refseq_105_hg19.ser"
-FASTA_FILE = "variantenrichment/data/hs37d5.fa"
-GNOMAD_EXOMES_FILE = "variantenrichment/data/gnomad.exomes.r2.0.2.sites.vcf.gz"
 
+logger = logging.getLogger(__name__)
 
-def assemble_case_sample(project: Project):
+
+def check_background(ctx: JobContext):
+    """ moves the project to background-error if its background set is not annotated like the case files;
+        sets registered before the version was recorded are used unverified, with a warning
+    :return: True if the background set can be used
+    """
+    project = ctx.project
+    background = project.background
+    version = get_annotation_db_version(get_bundle(project.reference))
+    if not background.annotation_version:
+        logger.warning("background set %s has no annotation version, using it unverified for project %s; "
+                       "rebuild it with build_background or set its version in the admin", background.name, project.pk)
+        return True
+
+    if background.reference == project.reference and background.annotation_version == version:
+        return True
+
+    logger.warning("background set %s is annotated with %s %r, not %s %r", background.name,
+                   background.reference or "unknown reference", background.annotation_version, project.reference,
+                   version)
+    ctx.set_state("background-error")
+    return False
+
+
+def job_meter(bj: BackgroundJob, stage):
+    """ creates a RecordMeter which stores the progress of a record loop in the background job
+        and publishes it to the progress channel of the project
+    :param bj: BackgroundJob running the loop, no progress is stored if None
+    :param stage: name of the stage, e.g. "filter_file"
+    :return: RecordMeter or None
+    """
+    if bj is None:
+        return None
+
+    def save_progress(meter: RecordMeter):
+        bj.stage = stage
+        bj.records_processed, bj.bytes_read = meter.records, meter.bytes_read
+        bj.records_per_second, bj.elapsed, bj.eta = meter.records_per_second, meter.elapsed, meter.eta
+        bj.progress_updated = timezone.now()
+        bj.save(update_fields=["stage", "records_processed", "bytes_read", "records_per_second", "elapsed", "eta",
+                               "progress_updated"])
+        publish_progress(bj.project_id, stage=bj.name, step=stage, percent=meter.percent, records=meter.records,
+                         records_per_second=meter.records_per_second, eta=meter.eta)
+
+    return RecordMeter(stage, callback=save_progress)
+
+
+def find_scores(project: Project, vcf_case, vcf_control, csv_case, csv_control, genes, output_file,
+                cadd_weights=False):
+    """ computes p values per gene with the statistical test chosen for the project
+    :return: name of the scores csv file
+    """
+    if project.statistical_test == "fisher":
+        return find_fisher_scores(csv_case=csv_case,
+                                  csv_control=csv_control,
+                                  output_file=output_file)
+
+    return find_burden_scores(vcf_case=vcf_case,
+                              vcf_control=vcf_control,
+                              genes=genes,
+                              csv_case=csv_case,
+                              csv_control=csv_control,
+                              test_name=project.statistical_test,
+                              output_file=output_file,
+                              cadd_weights=cadd_weights)
+
+
+def assemble_case_sample(ctx: JobContext):
     """ merges and annotates vcf files provided by user
-    :param project: Project object for which the annotation should be done
-    :return: name of the merged and annotated vcf file
+    :param ctx: JobContext of the project for which the annotation should be done
+    :return: name of the merged and annotated vcf file or None if the background set can't be used
     """
-    project.state = "annotating"
-    project.save()
+    project = ctx.project
+    if not check_background(ctx):
+        return None
+
+    ctx.set_state("annotating")
 
     project_files_dir = get_directory(FILES_DIR + str(project.uuid))
     vcf_files = [
@@ -27,23 +108,45 @@ def assemble_case_sample(project: Project):
     merged = merge_files(vcf_files=vcf_files,
                          output_file=project_files_dir + "/case")
 
-    annotated = annotate_sample(vcf_file=merged,
-                                fasta_file=FASTA_FILE,
-                                gnomad_file=GNOMAD_EXOMES_FILE,
-                                db_file=DB_FILE,
-                                output_file=project_files_dir + "/case.annotated")
-
-    project_files, created = ProjectFiles.objects.get_or_create(project=project)
-    project_files.case_annotated = annotated
-    project_files.save()
-
+    bundle = get_resources().get(project.reference)
+
+    if settings.ANNOTATION_CACHE_FILE:
+        cache = AnnotationCache(settings.ANNOTATION_CACHE_FILE,
+                                version=get_annotation_db_version(get_bundle(project.reference)),
+                                max_entries=settings.ANNOTATION_CACHE_MAX_ENTRIES)
+        try:
+            annotated = annotate_sample_cached(vcf_file=merged,
+                                               fasta_file=bundle.fasta_file,
+                                               gnomad_file=bundle.gnomad_exomes_file,
+                                               db_file=bundle.db_file,
+                                               output_file=project_files_dir + "/case.annotated",
+                                               cache=cache)
+        finally:
+            cache.close()
+    else:
+        annotated = annotate_sample(vcf_file=merged,
+                                    fasta_file=bundle.fasta_file,
+                                    gnomad_file=bundle.gnomad_exomes_file,
+                                    db_file=bundle.db_file,
+                                    output_file=project_files_dir + "/case.annotated")
+
+    ctx.files.case_annotated = annotated
+    ctx.save_files("case_annotated")
+
+    return annotated
+
+
+def filter_samples_initial(ctx: JobContext):
+    """ filters case and control files by genes, frequency and population
+    :return: False if the background set can't be used
+    """
+    project, project_files = ctx.project, ctx.files
+    if not check_background(ctx):
+        return False
 
-def filter_samples_initial(project: Project):
-    project.state = "filtering"
-    project.save()
+    ctx.set_state("filtering")
 
     project_files_dir = get_directory(FILES_DIR + str(project.uuid))
-    project_files = ProjectFiles.objects.get(project=project)
     case_file = project_files.case_annotated
 
     control_file = str(project.background.file)
@@ -76,12 +179,14 @@ def filter_samples_initial(project: Project):
                                          output_file=project_files_dir + "/control.population_filtered")
 
     project_files.case_filtered, project_files.control_filtered = case_file, control_file
-    project_files.save()
+    ctx.save_files("case_filtered", "control_filtered")
+
+    return True
 
 
-def filter_samples_final(project: Project):
+def filter_samples_final(ctx: JobContext):
+    project, project_files, bj = ctx.project, ctx.files, ctx.job
     project_files_dir = get_directory(FILES_DIR + str(project.uuid))
-    project_files = ProjectFiles.objects.get(project=project)
 
     # prepare the list of gene names set up as genes with a different impact by user
     genes_exception = project.genes_exception
@@ -109,30 +214,32 @@ def filter_samples_final(project: Project):
                             genes_names=genes_names,
                             impact=project.impact,
                             impact_mod=project.impact_exception,
-                            output_file=project_files_dir + "/case.filtered")
+                            output_file=project_files_dir + "/case.filtered",
+                            meter=job_meter(bj, "filter_file"))
 
     control_file = filter_file(vcf_file=control_file,
                                genes_names=genes_names,
                                impact=project.impact,
                                impact_mod=project.impact_exception,
-                               output_file=project_files_dir + "/control.filtered")
+                               output_file=project_files_dir + "/control.filtered",
+                               meter=job_meter(bj, "filter_file"))
 
-    # post filtered vcf files to cadd server if user provided cadd cutoff value
+    project_files.case_filtered, project_files.control_filtered = case_file, control_file
+
+    # post filtered vcf files to cadd server if user provided cadd cutoff value,
+    # poll_cadd checks for the scores from then on
     if project.cadd_score:
-        project_files.cadd_case_id = post_file_cadd(vcf_file=case_file)
-        project_files.cadd_control_id = post_file_cadd(vcf_file=control_file)
-        project_files.save()
+        post_cadd_files(project_files, get_bundle(project.reference).cadd_version)
+        ctx.save_files("case_filtered", "control_filtered", *CADD_POST_FIELDS)
 
-        project.state = "cadd-waiting"
-        project.save()
+        ctx.set_state("cadd-waiting" if project_files.cadd_case_id and project_files.cadd_control_id else "cadd-error")
+    else:
+        ctx.save_files("case_filtered", "control_filtered")
 
-    project_files.case_filtered, project_files.control_filtered = case_file, control_file
-    project_files.save()
 
-
-def check_quality(project: Project):
+def check_quality(ctx: JobContext):
+    project, project_files, bj = ctx.project, ctx.files, ctx.job
     project_files_dir = get_directory(FILES_DIR + str(project.uuid))
-    project_files = ProjectFiles.objects.get(project=project)
     case_file = project_files.case_filtered
     control_file = project_files.control_filtered
     impact = "synonymous_variant"
@@ -155,88 +262,133 @@ def check_quality(project: Project):
                                 genes_names=genes_dict.keys(),
                                 impact=impact,
                                 impact_mod="",
-                                output_file=project_files_dir + "/case.synonymous.filtered")
+                                output_file=project_files_dir + "/case.synonymous.filtered",
+                                meter=job_meter(bj, "filter_file"))
 
     control_file_syn = filter_file(vcf_file=control_file_syn,
                                    genes_names=genes_dict.keys(),
                                    impact=impact,
                                    impact_mod="",
-                                   output_file=project_files_dir + "/control.synonymous.filtered")
+                                   output_file=project_files_dir + "/control.synonymous.filtered",
+                                   meter=job_meter(bj, "filter_file"))
 
     case_csv_syn = count_variants(vcf_file=case_file_syn,
                                   genes=genes_dict,
-                                  output_file=project_files_dir + "/case.synonymous")
+                                  output_file=project_files_dir + "/case.synonymous",
+                                  meter=job_meter(bj, "count_variants"))
 
     control_csv_syn = count_variants(vcf_file=control_file_syn,
                                      genes=genes_dict,
-                                     output_file=project_files_dir + "/control.synonymous")
+                                     output_file=project_files_dir + "/control.synonymous",
+                                     meter=job_meter(bj, "count_variants"))
+
+    scores_syn = find_scores(project=project,
+                             vcf_case=case_file_syn,
+                             vcf_control=control_file_syn,
+                             csv_case=case_csv_syn,
+                             csv_control=control_csv_syn,
+                             genes=genes_dict,
+                             output_file=project_files_dir + "/scores.synonymous")
 
-    scores_syn = find_fisher_scores(csv_case=case_csv_syn,
-                                    csv_control=control_csv_syn,
-                                    output_file=project_files_dir + "/scores.synonymous")
+    summary_syn = correct_p_values(scores_file=scores_syn)
 
-    qq_plot = visualize_p_values(scores_file=scores_syn,
-                                 output_file=project_files_dir + "/qq_plot_syn")
+    project_files.qq_plot_syn, project_files.qq_plot_syn_points = visualize_p_values(
+        scores_file=scores_syn,
+        output_file=project_files_dir + "/qq_plot_syn",
+        lambda_gc=summary_syn["lambda_gc"])
 
-    project_files.qq_plot_syn = qq_plot
-    project_files.save()
+    ctx.save_files("qq_plot_syn", "qq_plot_syn_points")
 
+    ProjectStatistics.objects.update_or_create(project=project, defaults={
+        "lambda_gc_syn": summary_syn["lambda_gc"]
+    })
 
-def count_statistics(project: Project):
-    project.state = "analyzing"
-    project.save()
+
+def count_statistics(ctx: JobContext):
+    project, project_files, bj = ctx.project, ctx.files, ctx.job
+    ctx.set_state("analyzing")
 
     project_files_dir = get_directory(FILES_DIR + str(project.uuid))
-    project_files = ProjectFiles.objects.get(project=project)
 
     genes_dict = get_genes_dict('variantenrichment/media/' + str(project.inheritance))
 
     case_csv = count_variants(vcf_file=project_files.case_filtered,
                               genes=genes_dict,
-                              output_file=project_files_dir + "/case")
+                              output_file=project_files_dir + "/case",
+                              meter=job_meter(bj, "count_variants"))
 
     control_csv = count_variants(vcf_file=project_files.control_filtered,
                                  genes=genes_dict,
-                                 output_file=project_files_dir + "/control")
-
-    project_files.scores_csv = find_fisher_scores(csv_case=case_csv,
-                                                  csv_control=control_csv,
-                                                  output_file=project_files_dir + "/scores")
+                                 output_file=project_files_dir + "/control",
+                                 meter=job_meter(bj, "count_variants"))
+
+    project_files.scores_csv = find_scores(project=project,
+                                           vcf_case=project_files.case_filtered,
+                                           vcf_control=project_files.control_filtered,
+                                           csv_case=case_csv,
+                                           csv_control=control_csv,
+                                           genes=genes_dict,
+                                           output_file=project_files_dir + "/scores",
+                                           cadd_weights=project.cadd_weights)
+
+    summary = correct_p_values(scores_file=project_files.scores_csv)
+    summary["fwer_threshold"] = None
+
+    if project.permutations:
+        project_files.scores_csv, summary["fwer_threshold"] = find_permutation_scores(
+            csv_case=case_csv,
+            csv_control=control_csv,
+            scores_file=project_files.scores_csv,
+            permutations=project.permutations,
+            seed=project.permutation_seed)
 
     project_files.case_csv, project_files.control_csv = case_csv, control_csv
+    project_files.scores_table = save_scores_table(scores_file=project_files.scores_csv,
+                                                   output_file=project_files_dir + "/scores")
 
-    qq_plot = visualize_p_values(scores_file=project_files.scores_csv,
-                                 output_file=project_files_dir + "/qq_plot")
+    project_files.qq_plot, project_files.qq_plot_points = visualize_p_values(
+        scores_file=project_files.scores_csv,
+        output_file=project_files_dir + "/qq_plot",
+        lambda_gc=summary["lambda_gc"])
 
-    project_files.qq_plot = qq_plot
-    project_files.save()
+    ctx.save_files("scores_csv", "case_csv", "control_csv", "scores_table", "qq_plot", "qq_plot_points")
 
-    project.state = "done"
-    project.save()
+    ProjectStatistics.objects.update_or_create(project=project, defaults=summary)
 
+    ctx.set_state("done")
 
-def check_cadd(project: Project):
-    project.state = "cadd-checking"
-    project.save()
 
-    project_files_dir = get_directory(FILES_DIR + str(project.uuid))
-    project_files = ProjectFiles.objects.get(project=project)
+# fields of ProjectFiles changed by post_cadd_files
+CADD_POST_FIELDS = ["cadd_case_id", "cadd_control_id", "cadd_posted", "cadd_checks", "cadd_next_check"]
+
 
-    print("on cadd check start", project_files.cadd_case_id, project_files.cadd_case, project_files.cadd_control_id, project_files.cadd_control)
+def schedule_cadd_check(project_files: ProjectFiles, checks):
+    """ sets the time of the next check of the CADD scores, the interval doubles with every check """
+    interval = min(settings.CADD_POLL_INTERVAL * 2 ** checks, settings.CADD_POLL_MAX_INTERVAL)
+    project_files.cadd_checks = checks
+    project_files.cadd_next_check = timezone.now() + timedelta(seconds=interval)
 
+
+def post_cadd_files(project_files: ProjectFiles, cadd_version):
+    """ posts the filtered files which have no CADD job yet, the changed fields are CADD_POST_FIELDS
+    :param cadd_version: genome build and CADD version to score with, see ReferenceBundle
+    """
     if not project_files.cadd_case_id:
-        project_files.cadd_case_id = post_file_cadd(vcf_file=project_files.case_filtered)
+        project_files.cadd_case_id = post_file_cadd(vcf_file=project_files.case_filtered, cadd_version=cadd_version)
 
     if not project_files.cadd_control_id:
-        project_files.cadd_control_id = post_file_cadd(vcf_file=project_files.control_filtered)
+        project_files.cadd_control_id = post_file_cadd(vcf_file=project_files.control_filtered,
+                                                       cadd_version=cadd_version)
 
-    project_files.save()
+    project_files.cadd_posted = timezone.now()
+    schedule_cadd_check(project_files, 0)
 
-    cadd_posted = project_files.cadd_case_id and project_files.cadd_control_id
-    if not cadd_posted:
-        project.state = "cadd-error"
-        project.save()
-        return cadd_posted
+
+def download_cadd_files(project_files: ProjectFiles):
+    """ downloads the CADD scores which are not downloaded yet
+    :return: True if the scores of both files are downloaded
+    """
+    project_files_dir = get_directory(FILES_DIR + str(project_files.project_id))
 
     if not project_files.cadd_case:
         project_files.cadd_case = save_cadd_file(cadd_id=project_files.cadd_case_id,
@@ -245,33 +397,108 @@ def check_cadd(project: Project):
     if not project_files.cadd_control:
         project_files.cadd_control = save_cadd_file(cadd_id=project_files.cadd_control_id,
                                                     output_file=project_files_dir + "/control")
-    project_files.save()
+    project_files.save(update_fields=["cadd_case", "cadd_control"])
 
-    cadd_ready = project_files.cadd_case and project_files.cadd_control
-    if not cadd_ready:
-        project.state = "cadd-waiting"
-        project.save()
+    return bool(project_files.cadd_case and project_files.cadd_control)
 
-    print("on cadd check end", project_files.cadd_case_id, project_files.cadd_case, project_files.cadd_control_id,
-          project_files.cadd_control)
+
+def check_cadd(ctx: JobContext):
+    """ checks the CADD scores of a project on request of the user, posting the files again if needed
+    :return: True if the scores are ready
+    """
+    project, project_files = ctx.project, ctx.files
+    timed_out = project.state == "cadd-error"
+    # the poller may have moved the project on since the check was requested
+    if not ctx.transition("cadd-checking", from_states=["cadd-waiting", "cadd-error"]):
+        logger.info("project %s is %s, not checking CADD", project.pk, project.state)
+        return False
+
+    if not project_files.cadd_case_id or not project_files.cadd_control_id:
+        post_cadd_files(project_files, get_bundle(project.reference).cadd_version)
+        ctx.save_files(*CADD_POST_FIELDS)
+
+    cadd_posted = bool(project_files.cadd_case_id and project_files.cadd_control_id)
+    if not cadd_posted:
+        ctx.set_state("cadd-error")
+        return cadd_posted
+
+    cadd_ready = download_cadd_files(project_files)
+    if not cadd_ready:
+        # checked by hand, so the poller starts over with short intervals and a new timeout
+        schedule_cadd_check(project_files, 0)
+        if timed_out or not project_files.cadd_posted:
+            project_files.cadd_posted = timezone.now()
+        ctx.save_files("cadd_checks", "cadd_next_check", "cadd_posted")
+        ctx.set_state("cadd-waiting")
 
     return cadd_ready
 
 
-def cadd_filter_samples(project: Project):
-    project.state = "cadd-filtering"
-    project.save()
+def poll_cadd():
+    """ checks the CADD jobs of all projects waiting for scores with one concurrent pass,
+        projects whose scores are ready are moved to cadd-filtering
+    :return: list of projects whose scores are ready
+    """
+    now = timezone.now()
+    waiting = ProjectFiles.objects.select_related("project").filter(project__state="cadd-waiting").filter(
+        Q(cadd_next_check__isnull=True) | Q(cadd_next_check__lte=now))
+
+    pending = []
+    for project_files in waiting:
+        # like below, a check the user started in the meantime keeps the project
+        if not project_files.cadd_case_id or not project_files.cadd_control_id:
+            JobContext(project_files.project).transition("cadd-error", from_states=["cadd-waiting"])
+        elif project_files.cadd_posted and now - project_files.cadd_posted > timedelta(seconds=settings.CADD_TIMEOUT):
+            logger.warning("no CADD scores for %s after %s", project_files.project_id, now - project_files.cadd_posted)
+            JobContext(project_files.project).transition("cadd-error", from_states=["cadd-waiting"])
+        else:
+            cadd_ids = [cadd_id for cadd_id, scores in [(project_files.cadd_case_id, project_files.cadd_case),
+                                                        (project_files.cadd_control_id, project_files.cadd_control)]
+                        if not scores]
+            pending.append((project_files, cadd_ids))
+
+    if not pending:
+        return []
+
+    ready = AsyncCaddClient().check_all({cadd_id for _, cadd_ids in pending for cadd_id in cadd_ids})
+
+    ready_projects = []
+    for project_files, cadd_ids in pending:
+        if all(ready[cadd_id] for cadd_id in cadd_ids):
+            # a user may have started the check at the same time, only one of them moves the project on
+            if JobContext(project_files.project).transition("cadd-filtering", from_states=["cadd-waiting"]):
+                ready_projects.append(project_files.project)
+        else:
+            schedule_cadd_check(project_files, project_files.cadd_checks + 1)
+            project_files.cadd_posted = project_files.cadd_posted or now
+            project_files.save(update_fields=["cadd_checks", "cadd_next_check", "cadd_posted"])
+
+    return ready_projects
+
+
+def cadd_filter_samples(ctx: JobContext):
+    """ annotates the filtered files with CADD scores, downloading them first if needed,
+        and filters them by the PHRED cutoff
+    :return: False if the scores could not be downloaded
+    """
+    project, project_files, bj = ctx.project, ctx.files, ctx.job
+    ctx.set_state("cadd-filtering")
 
     project_files_dir = get_directory(FILES_DIR + str(project.uuid))
-    project_files = ProjectFiles.objects.get(project=project)
+
+    if not download_cadd_files(project_files):
+        ctx.set_state("cadd-waiting")
+        return False
 
     case_file = add_cadd_annotations(vcf_file=project_files.case_filtered,
                                      cadd_file=project_files.cadd_case,
-                                     output_file=project_files_dir + "/case.filtered.cadd-annotated")
+                                     output_file=project_files_dir + "/case.filtered.cadd-annotated",
+                                     meter=job_meter(bj, "add_cadd_annotations"))
 
     control_file = add_cadd_annotations(vcf_file=project_files.control_filtered,
                                         cadd_file=project_files.cadd_control,
-                                        output_file=project_files_dir + "/control.filtered.cadd-annotated")
+                                        output_file=project_files_dir + "/control.filtered.cadd-annotated",
+                                        meter=job_meter(bj, "add_cadd_annotations"))
 
     project_files.case_filtered = filter_by_cadd(vcf_file=case_file,
                                                  cadd_score=project.cadd_score,
@@ -281,4 +508,6 @@ def cadd_filter_samples(project: Project):
                                                     cadd_score=project.cadd_score,
                                                     output_file=project_files_dir + "/control.cadd-filtered")
 
-    project_files.save()
+    ctx.save_files("case_filtered", "control_filtered")
+
+    return True
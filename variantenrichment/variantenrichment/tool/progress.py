@@ -0,0 +1,55 @@
+import json
+import logging
+import time
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_KEY = "variantenrichment:progress:%s"
+# progress of finished projects is of no interest after a day
+PROGRESS_TTL = 24 * 60 * 60
+
+_client = None
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.PROGRESS_REDIS_URL, decode_responses=True)
+    return _client
+
+
+def publish_progress(project_uuid, **fields):
+    """ stores the latest progress of a project, which the detail page polls,
+        e.g. publish_progress(project.uuid, state="annotating", stage="Annotating", percent=0)
+        errors are only logged, progress reporting must never break the pipeline
+        :param project_uuid: uuid of the project
+        :param fields: progress fields to update: state, stage, percent, records, ...
+    """
+    key = PROGRESS_KEY % project_uuid
+    fields["updated"] = time.time()
+
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hset(key, mapping={name: json.dumps(value) for name, value in fields.items()})
+        pipe.expire(key, PROGRESS_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("could not publish progress for %s: %s", project_uuid, e)
+
+
+def decode_progress(progress):
+    return {name: json.loads(value) for name, value in progress.items()}
+
+
+def get_progress(project_uuid):
+    """ :return: dictionary with the latest progress fields of the project, empty if unknown,
+        None if redis can't be reached
+    """
+    try:
+        return decode_progress(get_redis().hgetall(PROGRESS_KEY % project_uuid))
+    except redis.RedisError as e:
+        logger.warning("could not read progress for %s: %s", project_uuid, e)
+        return None
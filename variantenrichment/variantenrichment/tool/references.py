@@ -0,0 +1,121 @@
+import os
+import shutil
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+
+from .annotation_cache import get_annotation_version
+from .instrumentation import run_command
+
+# files of a reference bundle, copied to the worker cache together with their indexes
+BUNDLE_FILES = ["db_file", "fasta_file", "gnomad_exomes_file"]
+INDEX_SUFFIXES = [".fai", ".tbi", ".csi"]
+
+ReferenceBundle = namedtuple("ReferenceBundle", ["name", "db_file", "fasta_file", "gnomad_exomes_file", "cadd_version",
+                                                 "annotation_version"])
+
+
+def get_bundle(name):
+    """ :param name: name of a bundle in settings.REFERENCE_BUNDLES, e.g. GRCh37
+        :return: ReferenceBundle with the shared paths of the files
+    """
+    try:
+        return ReferenceBundle(name=name, **settings.REFERENCE_BUNDLES[name])
+    except KeyError:
+        raise ValueError("unknown reference %s, known are %s" % (name, ", ".join(settings.REFERENCE_BUNDLES)))
+
+
+def get_annotation_db_version(bundle: ReferenceBundle):
+    """ :return: version of the files variants are annotated with, as configured for the bundle;
+        it does not change when the same files are copied or touched
+    """
+    return bundle.annotation_version
+
+
+def get_files_version(bundle: ReferenceBundle):
+    """ :return: names, sizes and modification times of the files, see get_annotation_version """
+    return get_annotation_version(*[getattr(bundle, field) for field in BUNDLE_FILES])
+
+
+def copy_if_changed(source, destination):
+    """ copies a file unless the destination has the same size and modification time,
+        concurrent copies of several processes don't see each other's partial files
+    """
+    if not os.path.exists(source):
+        return
+
+    stat = os.stat(source)
+    if os.path.exists(destination):
+        copied = os.stat(destination)
+        if copied.st_size == stat.st_size and int(copied.st_mtime) == int(stat.st_mtime):
+            return
+
+    partial = "%s.%d.part" % (destination, os.getpid())
+    shutil.copy2(source, partial)
+    os.replace(partial, destination)
+
+
+class ResourcePool:
+    """ Reference bundles prepared once per worker: copied to a local disk if cache_dir is set,
+        with missing .fai and tabix indexes created, so jobs find them ready; the jannovar database is
+        only copied, every jannovar run loads it again
+        :param cache_dir: directory on a fast local disk, the shared files are used in place if empty
+    """
+    def __init__(self, cache_dir=""):
+        self.cache_dir = cache_dir
+        # name: (version of the shared files, bundle with local paths)
+        self.bundles = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """ :return: ReferenceBundle with local paths, prepared again if the shared files changed """
+        bundle = get_bundle(name)
+        version = get_files_version(bundle)
+
+        with self.lock:
+            if name not in self.bundles or self.bundles[name][0] != version:
+                self.bundles[name] = (version, self.warm(bundle))
+            return self.bundles[name][1]
+
+    def warm(self, bundle: ReferenceBundle):
+        files = {field: self.localize(bundle.name, getattr(bundle, field)) for field in BUNDLE_FILES}
+
+        if os.path.exists(files["fasta_file"]) and not os.path.exists(files["fasta_file"] + ".fai"):
+            run_command([
+                "samtools", "faidx", files["fasta_file"]
+            ], check=True)
+
+        gnomad_file = files["gnomad_exomes_file"]
+        if os.path.exists(gnomad_file) and not any(os.path.exists(gnomad_file + suffix) for suffix in (".tbi", ".csi")):
+            run_command([
+                "tabix", "-p", "vcf", gnomad_file
+            ], check=True)
+
+        return bundle._replace(**files)
+
+    def localize(self, bundle_name, file):
+        """ :return: path of the local copy of the file or the file itself without cache_dir """
+        if not self.cache_dir or not os.path.exists(file):
+            return file
+
+        directory = os.path.join(self.cache_dir, bundle_name)
+        os.makedirs(directory, exist_ok=True)
+        local_file = os.path.join(directory, os.path.basename(file))
+
+        copy_if_changed(file, local_file)
+        for suffix in INDEX_SUFFIXES:
+            copy_if_changed(file + suffix, local_file + suffix)
+
+        return local_file
+
+
+_pool = None
+
+
+def get_resources():
+    """ pool shared by the tasks of a worker process """
+    global _pool
+    if _pool is None:
+        _pool = ResourcePool(settings.REFERENCE_CACHE_DIR)
+    return _pool
@@ -0,0 +1,92 @@
+from functools import lru_cache
+from os import path
+import numpy as np
+import pandas as pd
+
+
+def save_scores_table(scores_file, output_file):
+    """ stores a scores csv file as a compressed columnar numpy archive
+        :param scores_file: csv file created by find_fisher_scores or find_burden_scores
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :return: string: output file name with the right extension
+    """
+    score_df = pd.read_csv(scores_file,
+                           header=0,
+                           index_col=0)
+
+    columns = {"gene": score_df.index.to_numpy(dtype=str)}
+    for column in score_df.columns:
+        values = score_df[column].values
+        columns[column] = values.astype(np.int32) if np.issubdtype(values.dtype, np.integer) else values
+
+    np.savez_compressed(output_file + ".npz", **columns)
+
+    return output_file + ".npz"
+
+
+def load_scores_table(scores_file):
+    """ loads a scores table saved by save_scores_table (or a scores csv file for older projects),
+        tables are cached per worker until the file changes
+        :param scores_file: path to .npz or .csv scores file
+        :return: dictionary {column name: numpy array}
+    """
+    return _load_scores_table(scores_file, path.getmtime(scores_file))
+
+
+@lru_cache(maxsize=32)
+def _load_scores_table(scores_file, mtime):
+    if scores_file.endswith(".csv"):
+        score_df = pd.read_csv(scores_file,
+                               header=0,
+                               index_col=0)
+        table = {"gene": score_df.index.to_numpy(dtype=str)}
+        table.update({column: score_df[column].values for column in score_df.columns})
+        return table
+
+    with np.load(scores_file, allow_pickle=False) as archive:
+        return {column: archive[column] for column in archive.files}
+
+
+def query_scores(table, sort="p", descending=False, p_max=None, q_max=None, search="", page=1, page_size=50):
+    """ filters, sorts and paginates a scores table
+        :param table: dictionary {column name: numpy array} as returned by load_scores_table
+        :param sort: name of the column to sort by
+        :param descending: sort in descending order
+        :param p_max: only include genes with p value <= p_max
+        :param q_max: only include genes with q value <= q_max
+        :param search: only include genes which names contain this string (case insensitive)
+        :param page: number of the page, starting with 1
+        :param page_size: number of genes per page
+        :return: tuple (number of genes after filtering, list of dictionaries {column name: value} for the page)
+    """
+    if sort not in table:
+        raise ValueError("unknown column: %s" % sort)
+
+    selected = np.ones(len(table["gene"]), dtype=bool)
+
+    if p_max is not None:
+        selected &= table["p"] <= p_max
+    if q_max is not None and "q" in table:
+        selected &= table["q"] <= q_max
+    if search:
+        selected &= np.char.find(np.char.lower(table["gene"]), search.lower()) >= 0
+
+    indices = np.flatnonzero(selected)
+    order = np.argsort(table[sort][indices], kind="stable")
+    if descending:
+        order = order[::-1]
+
+    page_indices = indices[order][(page - 1) * page_size:page * page_size]
+
+    columns = {}
+    for column, values in table.items():
+        page_values = values[page_indices]
+        if np.issubdtype(page_values.dtype, np.floating):
+            # json has no NaN
+            columns[column] = [None if np.isnan(value) else value for value in page_values.tolist()]
+        else:
+            columns[column] = page_values.tolist()
+
+    rows = [dict(zip(columns.keys(), values)) for values in zip(*columns.values())]
+
+    return len(indices), rows
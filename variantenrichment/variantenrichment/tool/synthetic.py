@@ -0,0 +1,277 @@
+import gzip
+import os
+import shutil
+import stat
+import subprocess
+from collections import namedtuple
+
+import numpy as np
+
+from .instrumentation import run_command
+
+Gene = namedtuple("Gene", ["name", "chrom", "start", "end", "inheritance"])
+Variant = namedtuple("Variant", ["chrom", "pos", "ref", "alt", "gene", "effect", "impact", "af"])
+
+# (effect, impact, share of variants)
+EFFECTS = [
+    ("synonymous_variant", "LOW", 0.35),
+    ("missense_variant", "MODERATE", 0.5),
+    ("stop_gained", "HIGH", 0.05),
+    ("frameshift_variant", "HIGH", 0.05),
+    ("splice_donor_variant", "HIGH", 0.05),
+]
+# mean CADD PHRED score per impact
+PHRED_MEANS = {"LOW": 5.0, "MODERATE": 20.0, "HIGH": 35.0}
+INHERITANCE_MODELS = ["Autosomal dominant", "Autosomal recessive"]
+BASES = np.array(list("ACGT"))
+# fixed width genotype columns, a row of them is joined by taking the bytes of the array
+GENOTYPES = np.array([b"0/0\t", b"0/1\t", b"1/1\t"], dtype="S4")
+POPULATIONS = ["AFR", "AMR", "EAS", "EUR", "SAS"]
+# gnomAD exomes r2 has ~125k samples, rarer variants can't be observed
+MIN_AF = 1 / (2 * 125748)
+
+VCF_HEADER = """##fileformat=VCFv4.2
+##INFO=<ID=GNOMAD_EXOMES_AF_ALL,Number=A,Type=Float,Description="Synthetic gnomAD exomes allele frequency">
+##INFO=<ID=ANN,Number=.,Type=String,Description="Functional annotations: 'Allele | Annotation | \
+Annotation_Impact | Gene_Name | Gene_ID | Feature_Type | Feature_ID | Transcript_BioType | Rank | HGVS.c | HGVS.p | \
+cDNA.pos / cDNA.length | CDS.pos / CDS.length | AA.pos / AA.length | Distance | ERRORS / WARNINGS / INFO'">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+"""
+
+# stand-in for jannovar annotate-vcf: synthetic files are annotated already, so the input is only copied
+JANNOVAR_STUB = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -i) input="$2"; shift ;;
+        -o) output="$2"; shift ;;
+    esac
+    shift
+done
+case "$input" in
+    *.gz) zcat "$input" | bgzip -c > "$output" ;;
+    *) bgzip -c "$input" > "$output" ;;
+esac
+"""
+
+
+def make_gene_names(genes_number, seed=None):
+    """ :param genes_number: number of genes
+        :param seed: seed of the random inheritance models
+        :return: dictionary {gene name: inheritance model} as returned by get_genes_dict
+    """
+    rng = np.random.default_rng(seed)
+    models = rng.choice(INHERITANCE_MODELS, size=genes_number)
+    return {"GENE%05d" % i: str(model) for i, model in enumerate(models)}
+
+
+def make_gene_model(genes, gene_length=20000, spacing=100000):
+    """ places genes one after another on the autosomes
+        :param genes: dictionary {gene name: inheritance model}
+        :param gene_length: length of every gene in bases
+        :param spacing: distance between gene starts
+        :return: list of Gene sorted by chromosome and position
+    """
+    genes_per_chromosome = max(len(genes) // 22 + 1, 1)
+    model = []
+    for i, (name, inheritance) in enumerate(genes.items()):
+        chrom = str(i // genes_per_chromosome + 1)
+        start = (i % genes_per_chromosome + 1) * spacing
+        model.append(Gene(name, chrom, start, start + gene_length, inheritance))
+    return model
+
+
+def draw_allele_frequencies(rng, size):
+    """ draws allele frequencies resembling the gnomAD spectrum: most variants are very rare, few are common
+        :param rng: numpy random generator
+        :param size: number of frequencies
+        :return: numpy array of allele frequencies
+    """
+    return np.clip(rng.beta(0.1, 40, size), MIN_AF, 0.5)
+
+
+def generate_variants(gene_model, variants_per_gene, seed=None):
+    """ generates SNVs in the genes, sorted by position
+        :param gene_model: list of Gene returned by make_gene_model
+        :param variants_per_gene: number of variants in every gene
+        :param seed: seed of the random variants
+        :return: generator of Variant
+    """
+    rng = np.random.default_rng(seed)
+    effects = [(effect, impact) for effect, impact, _ in EFFECTS]
+    shares = [share for _, _, share in EFFECTS]
+
+    for gene in gene_model:
+        size = min(variants_per_gene, gene.end - gene.start)
+        positions = np.sort(rng.choice(np.arange(gene.start, gene.end), size=size, replace=False))
+        refs = rng.integers(0, 4, size)
+        # alternative base differs from the reference one
+        alts = (refs + rng.integers(1, 4, size)) % 4
+        chosen = rng.choice(len(effects), size=size, p=shares)
+        afs = draw_allele_frequencies(rng, size)
+
+        for pos, ref, alt, effect, af in zip(positions, refs, alts, chosen, afs):
+            yield Variant(gene.chrom, int(pos), BASES[ref], BASES[alt], gene.name, *effects[effect], float(af))
+
+
+def format_annotation(variant: Variant):
+    """ :return: jannovar-style ANN value of the variant """
+    return "%s|%s|%s|%s|%s|transcript|NM_%s.1|Coding|1/1|c.1%s>%s|p.(=)||||" % (
+        variant.alt, variant.effect, variant.impact, variant.gene, variant.gene, variant.gene[4:],
+        variant.ref, variant.alt
+    )
+
+
+def open_output(output_file, compress=False, threads=1):
+    """ opens a binary file for writing, with compress=True pipes it through bgzip
+        :return: tuple (writable binary file, bgzip process or None)
+    """
+    if not compress:
+        return open(output_file, "wb"), None
+
+    with open(output_file, "wb") as raw_file:
+        process = subprocess.Popen(["bgzip", "-@", str(threads), "-c"], stdin=subprocess.PIPE, stdout=raw_file)
+    return process.stdin, process
+
+
+def close_output(file, process):
+    file.close()
+    if process is not None and process.wait() != 0:
+        raise RuntimeError("bgzip failed with exit code %d" % process.returncode)
+
+
+def get_sample_names(sample_prefix, samples_number):
+    return ["%s%d" % (sample_prefix, i) for i in range(samples_number)]
+
+
+def write_vcf(output_file, variants, samples_number, sample_prefix="sample", seed=None, enriched_genes=(),
+              effect_size=1.0, compress=False, threads=1):
+    """ writes an annotated vcf file with random genotypes line by line, the memory used
+        grows with the number of samples of one line only
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :param variants: iterable of Variant sorted by position
+        :param samples_number: number of samples
+        :param sample_prefix: names of the samples are prefix + number
+        :param seed: seed of the random genotypes
+        :param enriched_genes: names of genes in which variants are more frequent
+        :param effect_size: factor applied to the allele frequency of variants in enriched genes
+        :param compress: write a bgzipped file and index it with tabix
+        :param threads: number of bgzip compression threads
+        :return: string: output file name with the right extension
+    """
+    rng = np.random.default_rng(seed)
+    enriched_genes = set(enriched_genes)
+    vcf_file = output_file + (".vcf.gz" if compress else ".vcf")
+    samples = get_sample_names(sample_prefix, samples_number)
+    file, process = open_output(vcf_file, compress, threads)
+
+    try:
+        file.write(VCF_HEADER.encode())
+        for chrom in range(1, 23):
+            file.write(b"##contig=<ID=%d>\n" % chrom)
+        file.write(("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t%s\n" % "\t".join(samples)).encode())
+
+        for variant in variants:
+            af = variant.af * effect_size if variant.gene in enriched_genes else variant.af
+            genotypes = GENOTYPES[rng.binomial(2, min(af, 1.0), samples_number)].tobytes()
+            file.write(("%s\t%d\t.\t%s\t%s\t.\tPASS\tGNOMAD_EXOMES_AF_ALL=%.3g;ANN=%s\tGT\t" % (
+                variant.chrom, variant.pos, variant.ref, variant.alt, variant.af, format_annotation(variant)
+            )).encode())
+            # the last genotype ends with a tab instead of the line break
+            file.write(genotypes[:-1] + b"\n")
+    finally:
+        close_output(file, process)
+
+    if compress:
+        run_command(["tabix", "-f", "-p", "vcf", vcf_file], check=True)
+
+    return vcf_file
+
+
+def write_inheritance_file(genes, output_file):
+    """ :param genes: dictionary {gene name: inheritance model}
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :return: string: output file name with the right extension
+    """
+    with open(output_file + ".txt", "w") as file:
+        for name, inheritance in genes.items():
+            file.write("%s\t%s\n" % (name, inheritance))
+
+    return output_file + ".txt"
+
+
+def write_bed_file(gene_model, output_file):
+    """ :param gene_model: list of Gene
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :return: string: output file name with the right extension
+    """
+    with open(output_file + ".bed", "w") as file:
+        for gene in gene_model:
+            # bed positions are 0-based
+            file.write("%s\t%d\t%d\t%s\n" % (gene.chrom, gene.start - 1, gene.end, gene.name))
+
+    return output_file + ".bed"
+
+
+def write_samples_file(samples, output_file, seed=None):
+    """ writes the samples file of a background set with a random superpopulation for every sample,
+        in the format read by filter_population
+        :param samples: list of sample names
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :param seed: seed of the random populations
+        :return: string: output file name with the right extension
+    """
+    rng = np.random.default_rng(seed)
+
+    with open(output_file + ".tsv", "w") as file:
+        file.write("Sample name\tSuperpopulation code\n")
+        for sample, population in zip(samples, rng.choice(POPULATIONS, size=len(samples))):
+            file.write("%s\t%s\n" % (sample, population))
+
+    return output_file + ".tsv"
+
+
+def write_cadd_file(vcf_file, output_file, seed=None):
+    """ writes CADD scores for every variant of a vcf file in the format of the CADD server,
+        PHRED scores are drawn around a mean depending on the variant impact
+        :param vcf_file: annotated vcf file, bgzipped or not
+        :param output_file: name of an output file WITHOUT SUFFICES
+        :param seed: seed of the random scores
+        :return: string: output file name with the right extension
+    """
+    rng = np.random.default_rng(seed)
+    opener = gzip.open if vcf_file.endswith(".gz") else open
+
+    with opener(vcf_file, "rt") as vcf, open(output_file + ".tsv", "w") as tsv:
+        tsv.write("## CADD GRCh37-v1.6 (c) University of Washington, Hudson-Alpha Institute for Biotechnology "
+                  "and Berlin Institute of Health 2013-2020. All rights reserved.\n")
+        tsv.write("#Chrom\tPos\tRef\tAlt\tRawScore\tPHRED\n")
+
+        for line in vcf:
+            if line.startswith("#"):
+                continue
+
+            chrom, pos, _, ref, alt, _, _, info = line.split("\t", 8)[:8]
+            impact = info.split("ANN=", 1)[1].split("|", 3)[2]
+            phred = max(rng.normal(PHRED_MEANS.get(impact, 10.0), 5.0), 0.0)
+            tsv.write("%s\t%s\t%s\t%s\t%.6f\t%.3f\n" % (chrom, pos, ref, alt, phred / 10 - 1, phred))
+
+    return output_file + ".tsv"
+
+
+def install_tool_stubs(bin_dir):
+    """ writes a jannovar stand-in into bin_dir, put bin_dir first in PATH to use it
+        :return: bin_dir
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    jannovar = os.path.join(bin_dir, "jannovar")
+
+    with open(jannovar, "w") as file:
+        file.write(JANNOVAR_STUB)
+    os.chmod(jannovar, os.stat(jannovar).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    return bin_dir
+
+
+def has_tools(*tools):
+    """ :return: True if all the command line tools are installed """
+    return all(shutil.which(tool) for tool in tools)
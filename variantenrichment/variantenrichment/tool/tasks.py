@@ -1,149 +1,187 @@
+import cProfile
+import logging
+import re
+from datetime import datetime
+from functools import wraps
+from django.utils import timezone
 from config.celery_app import app
-from .processes import assemble_case_sample, filter_samples_initial, filter_samples_final, \
-    check_quality, count_statistics, check_cadd, cadd_filter_samples
-from .models import BackgroundJob
+from .artifacts import apply_artifact_policy, collect_garbage, register_artifacts
+from .functions import get_directory
+from .processes import FILES_DIR, assemble_case_sample, filter_samples_initial, filter_samples_final, \
+    check_quality, count_statistics, check_cadd, cadd_filter_samples, poll_cadd
+from .models import BackgroundJob, JobMetrics
+from .context import JobContext
+from .instrumentation import JobProfiler
+from .io_threads import io_job
+
+logger = logging.getLogger(__name__)
+
+
+def start_job(name, project, task):
+    """ creates the background job of the next stage and queues its task """
+    bj_new = BackgroundJob.objects.create(name=name, project=project, state="new")
+    task.apply_async(args=[bj_new.pk], countdown=1)
+
+
+def save_job_metrics(bj: BackgroundJob, profiler: JobProfiler, profile_file=""):
+    started = datetime.fromtimestamp(profiler.started, tz=timezone.utc)
+
+    JobMetrics.objects.update_or_create(job=bj, defaults={
+        "started": started,
+        "finished": datetime.fromtimestamp(profiler.finished, tz=timezone.utc),
+        # includes the countdown the task was scheduled with
+        "queue_latency": (started - bj.created).total_seconds(),
+        "wall_time": profiler.wall_time,
+        "cpu_time": profiler.cpu_time,
+        "subprocess_time": profiler.subprocess_time,
+        "peak_rss": profiler.peak_rss,
+        "bytes_read": profiler.bytes_read,
+        "bytes_written": profiler.bytes_written,
+        "profile": profile_file
+    })
+
+
+def save_profile(bj: BackgroundJob, stage_profile: cProfile.Profile):
+    """ dumps the profile of a job into the profiles directory of the project
+    :return: name of the dump file
+    """
+    profiles_dir = get_directory(FILES_DIR + str(bj.project_id) + "/profiles")
+    profile_file = "%s/%d.%s.prof" % (profiles_dir, bj.pk, re.sub(r"\W+", "_", bj.name.lower()))
+    stage_profile.dump_stats(profile_file)
+    return profile_file
+
+
+def profile_job(task):
+    """ records timing and resource usage of a background job task and the files it wrote, also if the task fails,
+        and runs the task under cProfile if profiling is switched on for the project;
+        the task gets the JobContext of the job instead of its id
+    """
+    @wraps(task)
+    def wrapper(bj_id):
+        ctx = JobContext.load(bj_id)
+        stage_profile = cProfile.Profile() if ctx.project.profile else None
+        profiler = JobProfiler()
+        try:
+            with io_job(), profiler:
+                if stage_profile is None:
+                    return task(ctx)
+                return stage_profile.runcall(task, ctx)
+        finally:
+            # bookkeeping errors are only logged, they must not replace the result or the error of the task
+            try:
+                save_job_metrics(ctx.job, profiler, save_profile(ctx.job, stage_profile) if stage_profile else "")
+            except Exception:
+                logger.exception("could not save the metrics of job %s", ctx.job.pk)
+            try:
+                register_artifacts(ctx.project, ctx.job.name)
+            except Exception:
+                logger.exception("could not register the files of job %s", ctx.job.pk)
+
+    return wrapper
 
 
 @app.task
-def annotate_task(bj_id):
-    bj = BackgroundJob.objects.get(pk=bj_id)
-    bj.state = "running"
-    bj.save()
+@profile_job
+def annotate_task(ctx: JobContext):
+    ctx.set_job_state("running")
 
-    assemble_case_sample(bj.project)
+    annotated = assemble_case_sample(ctx)
 
-    bj.state = "done"
-    bj.save()
+    ctx.set_job_state("done")
 
-    bj_new = BackgroundJob(
-        name="Initial filtering",
-        project=bj.project,
-        state="new"
-    )
-    bj_new.save()
-    prefilter_task.apply_async(args=[bj_new.pk], countdown=1)
+    if annotated:
+        start_job("Initial filtering", ctx.project, prefilter_task)
 
 
 @app.task
-def prefilter_task(bj_id):
-    bj = BackgroundJob.objects.get(pk=bj_id)
-    bj.state = "running"
-    bj.save()
+@profile_job
+def prefilter_task(ctx: JobContext):
+    ctx.set_job_state("running")
 
-    filter_samples_initial(project=bj.project)
+    filtered = filter_samples_initial(ctx)
 
-    bj.state = "done"
-    bj.save()
+    ctx.set_job_state("done")
 
-    bj_new = BackgroundJob(
-        name="Quality checking",
-        project=bj.project,
-        state="new"
-    )
-    bj_new.save()
-    check_quality_task.apply_async(args=[bj_new.pk], countdown=1)
+    if filtered:
+        start_job("Quality checking", ctx.project, check_quality_task)
 
 
 @app.task
-def filter_task(bj_id):
-    bj = BackgroundJob.objects.get(pk=bj_id)
-    bj.state = "running"
-    bj.save()
-
-    filter_samples_final(project=bj.project)
-
-    bj.state = "done"
-    bj.save()
-
-    if not bj.project.cadd_score:
-        bj_new = BackgroundJob(
-            name="Analyzing",
-            project=bj.project,
-            state="new"
-        )
-        bj_new.save()
-        stats_task.apply_async(args=[bj_new.pk], countdown=1)
-
-    elif check_cadd(project=bj.project):
-        bj_new = BackgroundJob(
-            name="CADD filtering",
-            project=bj.project,
-            state="new"
-        )
-        bj_new.save()
-        filter_cadd_task.apply_async(args=[bj_new.pk], countdown=1)
+@profile_job
+def filter_task(ctx: JobContext):
+    ctx.set_job_state("running")
+
+    filter_samples_final(ctx)
+
+    ctx.set_job_state("done")
+
+    if not ctx.project.cadd_score:
+        start_job("Analyzing", ctx.project, stats_task)
+
+    # with a cadd cutoff poll_cadd_task starts the cadd filtering once the scores are ready
 
 
 @app.task
-def check_quality_task(bj_id):
-    bj = BackgroundJob.objects.get(pk=bj_id)
-    bj.state = "running"
-    bj.save()
+@profile_job
+def check_quality_task(ctx: JobContext):
+    ctx.set_job_state("running")
 
-    check_quality(project=bj.project)
+    check_quality(ctx)
 
-    bj.state = "done"
-    bj.save()
+    ctx.set_job_state("done")
 
-    bj_new = BackgroundJob(
-        name="Filtering",
-        project=bj.project,
-        state="new"
-    )
-    bj_new.save()
-    filter_task.apply_async(args=[bj_new.pk], countdown=1)
+    start_job("Filtering", ctx.project, filter_task)
 
 
 @app.task
-def stats_task(bj_id):
-    bj = BackgroundJob.objects.get(pk=bj_id)
-    bj.state = "running"
-    bj.save()
+@profile_job
+def stats_task(ctx: JobContext):
+    ctx.set_job_state("running")
 
-    count_statistics(project=bj.project)
+    count_statistics(ctx)
+    apply_artifact_policy(ctx.project)
 
-    bj.state = "done"
-    bj.save()
+    ctx.set_job_state("done")
 
 
 @app.task
-def check_cadd_task(bj_id):
-    bj = BackgroundJob.objects.get(pk=bj_id)
-    bj.state = "running"
-    bj.save()
+@profile_job
+def check_cadd_task(ctx: JobContext):
+    ctx.set_job_state("running")
 
-    cadd_ready = check_cadd(project=bj.project)
+    cadd_ready = check_cadd(ctx)
 
-    bj.state = "done"
-    bj.save()
+    ctx.set_job_state("done")
 
     if cadd_ready:
-        bj_new = BackgroundJob(
-            name="CADD filtering",
-            project=bj.project,
-            state="new"
-        )
-        bj_new.save()
-        filter_cadd_task.apply_async(args=[bj_new.pk], countdown=1)
+        start_job("CADD filtering", ctx.project, filter_cadd_task)
     else:
-        print("try again later")
+        logger.info("CADD scores of project %s are not ready, trying again later", ctx.project.pk)
+
+
+@app.task
+@profile_job
+def filter_cadd_task(ctx: JobContext):
+    ctx.set_job_state("running")
+
+    cadd_filtered = cadd_filter_samples(ctx)
+
+    ctx.set_job_state("done")
+
+    if cadd_filtered:
+        start_job("Analyzing", ctx.project, stats_task)
+
+
+@app.task
+def poll_cadd_task():
+    """ run periodically by celery beat, starts the cadd filtering of all projects whose scores are ready """
+    for project in poll_cadd():
+        start_job("CADD filtering", project, filter_cadd_task)
 
 
 @app.task
-def filter_cadd_task(bj_id):
-    bj = BackgroundJob.objects.get(pk=bj_id)
-    bj.state = "running"
-    bj.save()
-
-    cadd_filter_samples(project=bj.project)
-
-    bj.state = "done"
-    bj.save()
-
-    bj_new = BackgroundJob(
-        name="Analyzing",
-        project=bj.project,
-        state="new"
-    )
-    bj_new.save()
-    stats_task.apply_async(args=[bj_new.pk], countdown=1)
+def artifact_gc_task():
+    """ run periodically by celery beat, keeps the project files within the disk quotas """
+    freed = collect_garbage()
+    if freed:
+        logger.info("freed %d bytes of project files", freed)
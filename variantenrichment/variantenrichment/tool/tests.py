@@ -1,3 +1,715 @@
-from django.test import TestCase
+import gzip
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import threading
+import time
+import zlib
+from datetime import timedelta
+from types import SimpleNamespace
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import pytest
+import redis
+import scipy.sparse as sparse
+import scipy.stats as stats
+from django.urls import reverse
+from django.utils import timezone
+
+from variantenrichment.tool import annotation_daemon, artifacts, cadd, io_threads, processes, progress, tasks
+from variantenrichment.tool.annotation_cache import AnnotationCache
+from variantenrichment.tool.background import BackgroundError, load_carriers, write_background_sidecar
+from variantenrichment.tool.burden import cmc_test, get_genotype_blocks, group_genes, liu_pvalues, run_burden_test, \
+    skat_test
+from variantenrichment.tool.cadd import AsyncCaddClient, CaddClient, CaddError, decompress_chunks
+from variantenrichment.tool.fake_cadd import FakeCaddServer, bgzip_compress
+from variantenrichment.tool.functions import correct_p_values, find_permutation_scores, get_inflation_factor, \
+    join_annotations, request_annotation, visualize_p_values
+from variantenrichment.tool.instrumentation import summarize_durations
+from variantenrichment.tool.models import Artifact, BackgroundJob, BackgroundSet, JobMetrics, Project, \
+    ProjectFiles, ProjectStatistics, VariantFile
+from variantenrichment.tool.processes import check_background
+from variantenrichment.tool.references import get_annotation_db_version, get_bundle
+from variantenrichment.tool.results import query_scores
+from variantenrichment.tool.synthetic import make_gene_names, make_gene_model, generate_variants, has_tools, \
+    write_vcf
+from variantenrichment.tool.views import IGNORE_RANGE, ProjectArtifactView, ProjectProgressView, clear_project_files, \
+    parse_range
+
+
+class TestParseRange:
+    def test_closed_range(self):
+        assert parse_range("bytes=0-9", 100) == (0, 9)
+
+    def test_open_and_suffix_ranges(self):
+        assert parse_range("bytes=90-", 100) == (90, 99)
+        assert parse_range("bytes=-10", 100) == (90, 99)
+        assert parse_range("bytes=50-500", 100) == (50, 99)
+
+    def test_unsatisfiable_ranges(self):
+        assert parse_range("bytes=100-", 100) is None
+        assert parse_range("bytes=-0", 100) is None
+
+    def test_ignored_ranges(self):
+        # answered with the whole file
+        assert parse_range("items=0-1", 100) == IGNORE_RANGE
+        assert parse_range("bytes=0-1,5-6", 100) == IGNORE_RANGE
+        assert parse_range("bytes=9-1", 100) == IGNORE_RANGE
+        assert parse_range("bytes=-", 100) == IGNORE_RANGE
+
+    @pytest.mark.parametrize("range_header, status", [("bytes=0-9", 206), ("items=0-9", 200), ("bytes=0-1,5-6", 200),
+                                                      ("bytes=100-", 416)])
+    def test_responses(self, tmp_path, rf, range_header, status):
+        data_file = tmp_path / "scores.csv"
+        data_file.write_bytes(b"x" * 100)
+
+        request = rf.get("/", HTTP_RANGE=range_header)
+        assert ProjectArtifactView.file_response(request, str(data_file), "text/csv").status_code == status
+
+
+class TestQueryScores:
+    table = {
+        "gene": np.array(["BRCA1", "BRCA2", "TP53", "MYH7"]),
+        "p": np.array([0.01, 0.5, 0.001, np.nan]),
+        "q": np.array([0.02, 0.5, 0.004, 1.0]),
+    }
+
+    def test_sort_and_paginate(self):
+        count, rows = query_scores(self.table, sort="p", page=1, page_size=2)
+
+        assert count == 4
+        assert [row["gene"] for row in rows] == ["TP53", "BRCA1"]
+
+    def test_filter_and_search(self):
+        count, rows = query_scores(self.table, q_max=0.1, search="brca")
+
+        assert count == 1
+        assert rows[0]["gene"] == "BRCA1"
+
+    def test_nan_values_are_none(self):
+        _, rows = query_scores(self.table, search="MYH7")
+
+        assert rows[0]["p"] is None
+
+
+class TestSummarizeDurations:
+    def test_percentiles_per_key(self):
+        summary = summarize_durations({"Filtering": [float(i) for i in range(1, 101)], "Analyzing": [3.0]})
+
+        assert [row["key"] for row in summary] == ["Analyzing", "Filtering"]
+        assert summary[0]["p95"] == 3.0
+        assert summary[1]["count"] == 100
+        assert summary[1]["p50"] == 50.5
+
+    def test_missing_values(self):
+        summary = summarize_durations({"Annotating": [None]})
+
+        assert summary[0]["count"] == 0
+        assert summary[0]["p50"] is None
+
+
+class TestAnnotationCache:
+    def test_get_put(self, tmp_path):
+        cache = AnnotationCache(str(tmp_path / "cache.sqlite"), version="v1")
+        cache.put({("1", 100, "A", "G"): "ANN=G|missense_variant"})
+
+        assert cache.get([("1", 100, "A", "G"), ("1", 101, "C", "T")]) == {
+            ("1", 100, "A", "G"): "ANN=G|missense_variant"}
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert AnnotationCache(str(tmp_path / "cache.sqlite"), version="v2").get([("1", 100, "A", "G")]) == {}
+
+    def test_many_keys(self, tmp_path):
+        cache = AnnotationCache(str(tmp_path / "cache.sqlite"), version="v1")
+        # the limit of SQLite before 3.32
+        cache.connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        keys = [("1", pos, "A", "G") for pos in range(1000)]
+        cache.put({key: "ANN=%d" % key[1] for key in keys[::2]})
+
+        found = cache.get(keys + keys[:10])
+        assert len(found) == 500
+        assert found[("1", 998, "A", "G")] == "ANN=998"
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        cache = AnnotationCache(str(tmp_path / "cache.sqlite"), version="v1", max_entries=2)
+        cache.put({("1", 100, "A", "G"): "ANN=a", ("1", 200, "A", "G"): "ANN=b"})
+        cache.connection.execute("UPDATE annotation SET used = used - 10 WHERE pos = 200")
+        cache.put({("1", 300, "A", "G"): "ANN=c"})
+
+        assert set(cache.get([("1", 100, "A", "G"), ("1", 200, "A", "G"), ("1", 300, "A", "G")])) == {
+            ("1", 100, "A", "G"), ("1", 300, "A", "G")}
+
+
+class TestAnnotationDaemon:
+    MESSAGE = {"input": "case.sites.vcf", "output": "case.annotated", "fasta_file": "hs37d5.fa",
+               "gnomad_file": "gnomad.vcf.gz", "db_file": "refseq.ser"}
+
+    def test_request_timeout(self, tmp_path, monkeypatch):
+        release = threading.Event()
+        monkeypatch.setattr(annotation_daemon, "annotate_batch", lambda *args: release.wait())
+        socket_path = str(tmp_path / "daemon.sock")
+        daemon = annotation_daemon.AnnotationDaemon(socket_path, batch_window=0, request_timeout=0.2)
+        threading.Thread(target=daemon.serve_forever, daemon=True).start()
+
+        try:
+            # the daemon gives up on the batch first
+            answer = request_annotation(socket_path, self.MESSAGE, timeout=5)
+            assert not answer["ok"] and "within" in answer["error"]
+
+            # the job gives up on the daemon first and runs jannovar itself
+            daemon.request_timeout = 5
+            with pytest.raises(socket.timeout):
+                request_annotation(socket_path, self.MESSAGE, timeout=0.2)
+        finally:
+            release.set()
+            daemon.shutdown()
+            daemon.server_close()
+
+    def test_batches(self, tmp_path, monkeypatch):
+        started, release, sizes = threading.Event(), threading.Event(), []
+
+        def annotate_batch(requests, files, directory):
+            sizes.append(len(requests))
+            started.set()
+            release.wait()
+            for request in requests:
+                request.finish({"ok": True, "output": request.output})
+
+        monkeypatch.setattr(annotation_daemon, "annotate_batch", annotate_batch)
+        socket_path = str(tmp_path / "daemon.sock")
+        daemon = annotation_daemon.AnnotationDaemon(socket_path, concurrency=1)
+        threading.Thread(target=daemon.serve_forever, daemon=True).start()
+
+        def request():
+            answers.append(request_annotation(socket_path, self.MESSAGE, timeout=5))
+
+        answers = []
+        try:
+            # a lone request starts at once
+            threads = [threading.Thread(target=request)]
+            threads[0].start()
+            assert started.wait(1)
+
+            # the requests arriving while the process is busy are annotated together
+            threads += [threading.Thread(target=request) for _ in range(2)]
+            for thread in threads[1:]:
+                thread.start()
+            deadline = time.monotonic() + 5
+            while daemon.unanswered < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+            assert sizes == [1, 2]
+            assert [answer["ok"] for answer in answers] == [True] * 3
+        finally:
+            release.set()
+            daemon.shutdown()
+            daemon.server_close()
+
+
+@pytest.mark.skipif(not has_tools("bgzip", "tabix"), reason="bgzip and tabix are needed")
+class TestJoinAnnotations:
+    HEADER = "##fileformat=VCFv4.2\n##INFO=<ID=DP,Number=1,Type=Integer,Description=\"\">\n"
+    COLUMNS = "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n"
+    SITES_HEADER = "##fileformat=VCFv4.2\n##INFO=<ID=DP,Number=1,Type=Integer,Description=\"\">\n" \
+                   "##INFO=<ID=ANN,Number=.,Type=String,Description=\"\">\n" \
+                   "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+
+    def join(self, tmp_path, records, sites):
+        vcf = tmp_path / "case.vcf"
+        vcf.write_text(self.HEADER + self.COLUMNS + "".join(
+            "1\t%d\t.\tA\tG\t.\t.\tDP=10\tGT\t0/1\n" % pos for pos in records))
+        sites_file = tmp_path / "case.sites.vcf"
+        sites_file.write_text(self.SITES_HEADER + "".join(
+            "1\t%d\t.\tA\tG\t.\t.\tANN=G|%d\n" % (pos, pos) for pos in sites))
+        return join_annotations(str(vcf), str(sites_file), str(tmp_path / "case.annotated"))
+
+    def test_join(self, tmp_path):
+        with gzip.open(self.join(tmp_path, [100, 200], [100, 200]), "rt") as file:
+            lines = file.read().splitlines()
+
+        # the INFO definitions of both files, each once
+        assert [line for line in lines if line.startswith("##INFO")] == [
+            '##INFO=<ID=DP,Number=1,Type=Integer,Description="">',
+            '##INFO=<ID=ANN,Number=.,Type=String,Description="">']
+        assert lines[-2:] == ["1\t100\t.\tA\tG\t.\t.\tANN=G|100\tGT\t0/1",
+                              "1\t200\t.\tA\tG\t.\t.\tANN=G|200\tGT\t0/1"]
+
+    def test_different_variants(self, tmp_path):
+        with pytest.raises(ValueError, match="differ at 1:200"):
+            self.join(tmp_path, [100, 200], [100, 300])
+
+    @pytest.mark.parametrize("sites", [[100], [100, 200, 300]])
+    def test_different_counts(self, tmp_path, sites):
+        with pytest.raises(ValueError, match="numbers of variants"):
+            self.join(tmp_path, [100, 200], sites)
+
+
+class TestBackgroundSidecar:
+    HEADER = "##INFO=<ID=GNOMAD_EXOMES_AF_ALL,Number=A>\n" \
+             "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tc1\tc2\tc3\n"
+    RECORD = "1\t100\t.\tA\tG\t.\t.\tANN=G|missense_variant|MODERATE|GENE1|;GNOMAD_EXOMES_AF_ALL=0.01\t" \
+             "GT\t0/1\t0/0\t1|1\n"
+
+    @pytest.fixture
+    def samples_file(self, tmp_path):
+        samples_file = tmp_path / "background.samples"
+        samples_file.write_text("Sample name\tSuperpopulation code\nc1\tEUR\nc2\tAFR\nc3\tEUR\n")
+        return str(samples_file)
+
+    def test_carriers(self, tmp_path, samples_file):
+        vcf = tmp_path / "background.vcf"
+        vcf.write_text("##INFO=<ID=ANN,Number=.>\n" + self.HEADER + self.RECORD)
+
+        sidecar, variants = write_background_sidecar(str(vcf), samples_file, str(tmp_path / "carriers"))
+        columns, carriers, samples = load_carriers(sidecar, samples=["c3", "c2"])
+
+        assert variants == 1
+        assert list(columns["genes"]) == ["GENE1"]
+        assert carriers.tolist() == [[True, False]]
+        assert samples == ["c3", "c2"]
+
+    def test_not_annotated(self, tmp_path, samples_file):
+        vcf = tmp_path / "background.vcf"
+        vcf.write_text(self.HEADER + self.RECORD)
+
+        with pytest.raises(BackgroundError):
+            write_background_sidecar(str(vcf), samples_file, str(tmp_path / "carriers"))
+
+
+class TestProgress:
+    @pytest.fixture
+    def unreachable(self, monkeypatch):
+        monkeypatch.setattr(progress, "_client", redis.Redis(port=1, socket_connect_timeout=1))
+
+    def test_redis_down(self, unreachable, rf):
+        # neither the pipeline nor the polling page fail
+        progress.publish_progress("uuid", stage="Annotating", percent=10)
+        assert progress.get_progress("uuid") is None
+
+        response = ProjectProgressView.as_view()(rf.get("/progress"), pk="uuid")
+        assert response.status_code == 503
+
+
+class TestIoThreads:
+    @pytest.fixture
+    def jobs_dir(self, tmp_path, settings):
+        settings.IO_JOBS_DIR = str(tmp_path / "io_jobs")
+        settings.IO_HOST_THREADS, settings.IO_JOB_THREADS = 12, 8
+        return tmp_path / "io_jobs"
+
+    def test_share(self, jobs_dir):
+        # no other jobs, but at most IO_JOB_THREADS
+        assert io_threads.get_io_threads() == 8
+
+        with io_threads.io_job():
+            assert io_threads.count_jobs() == 1
+            # the parent process of the test runs as well
+            (jobs_dir / str(os.getppid())).touch()
+            assert io_threads.get_io_threads() == 6
+            assert io_threads.bgzip_threads() == ["-@", "6"]
+
+        assert io_threads.count_jobs() == 1
+
+    def test_at_least_one_thread(self, jobs_dir, settings):
+        settings.IO_HOST_THREADS = 1
+        with io_threads.io_job():
+            (jobs_dir / str(os.getppid())).touch()
+            assert io_threads.get_io_threads() == 1
+
+    def test_removes_stale_entries(self, jobs_dir):
+        jobs_dir.mkdir()
+        process = subprocess.Popen(["true"])
+        process.wait()
+        # the entry of a process which is gone and a file which is no entry
+        (jobs_dir / str(process.pid)).touch()
+        (jobs_dir / "notes.txt").touch()
+
+        assert io_threads.count_jobs() == 0
+        assert not list(jobs_dir.iterdir())
+
+
+class TestProfileJob:
+    class Context:
+        # stands in for JobContext, without a database
+        project = SimpleNamespace(profile=False)
+        job = SimpleNamespace(pk=1, name="Filtering")
+
+        @classmethod
+        def load(cls, bj_id):
+            return cls()
+
+    def fail(self, *args):
+        raise OSError("disk full")
+
+    def test_bookkeeping_errors_keep_the_task_error(self, monkeypatch):
+        monkeypatch.setattr(tasks, "JobContext", self.Context)
+        monkeypatch.setattr(tasks, "save_job_metrics", self.fail)
+        monkeypatch.setattr(tasks, "register_artifacts", self.fail)
+
+        def task(ctx):
+            raise ValueError("task failed")
+
+        with pytest.raises(ValueError, match="task failed"):
+            tasks.profile_job(task)(1)
+        assert tasks.profile_job(lambda ctx: "done")(1) == "done"
+
+
+class TestCheckBackground:
+    class Context:
+        def __init__(self, project):
+            self.project, self.state = project, None
+
+        def set_state(self, state):
+            self.state = state
+
+    def check(self, annotation_version, reference="GRCh37"):
+        background = BackgroundSet(name="IGSR", annotation_version=annotation_version, reference=reference)
+        ctx = self.Context(Project(reference="GRCh37", background=background))
+        return check_background(ctx), ctx.state
+
+    def test_same_version(self):
+        assert self.check(get_annotation_db_version(get_bundle("GRCh37"))) == (True, None)
+
+    def test_other_version(self):
+        assert self.check("refseq-104") == (False, "background-error")
+        assert self.check(get_annotation_db_version(get_bundle("GRCh37")), "GRCh38") == (False, "background-error")
+
+    def test_unverified(self):
+        # sets registered before the version was recorded are still used
+        assert self.check("", "") == (True, None)
+
+
+@pytest.fixture
+def vcf_file(tmp_path):
+    genes = make_gene_names(5, seed=0)
+    vcf = write_vcf(str(tmp_path / "case"), generate_variants(make_gene_model(genes), 4, seed=0), 3)
+
+    with open(vcf, "rb") as file, open(vcf + ".gz", "wb") as compressed:
+        compressed.write(gzip.compress(file.read()))
+    return vcf + ".gz"
+
+
+class TestCaddClient:
+    def test_decompress_bgzip_members(self):
+        data = b"".join(b"%d\n" % i for i in range(100000))
+        compressed = bgzip_compress(data)
+        chunks = [compressed[start:start + 1000] for start in range(0, len(compressed), 1000)]
+
+        assert b"".join(decompress_chunks(chunks)) == data
+
+    def test_decompress_truncated(self):
+        compressed = bgzip_compress(b"".join(b"%d\n" % i for i in range(100000)))
+
+        with pytest.raises(zlib.error):
+            b"".join(decompress_chunks([compressed[:len(compressed) // 2]]))
+
+    def test_truncated_download(self, vcf_file, tmp_path):
+        server = FakeCaddServer(truncate=0.5).start()
+        client = CaddClient(server.url, backoff=0.01)
+
+        try:
+            cadd_id = client.upload(vcf_file)
+            with pytest.raises(CaddError):
+                client.download(cadd_id, str(tmp_path / "scores"))
+        finally:
+            server.shutdown()
+
+        assert not list(tmp_path.glob("scores*"))
+        # the uploads are removed with the server
+        assert not os.path.exists(server.directory)
+
+    def test_upload_and_download(self, vcf_file, tmp_path):
+        server = FakeCaddServer(delay=0.5, failures=2).start()
+        client = CaddClient(server.url, backoff=0.01)
+
+        try:
+            cadd_id = client.upload(vcf_file)
+            assert not client.is_ready(cadd_id)
+            assert client.download(cadd_id, str(tmp_path / "scores")) == ""
+
+            time.sleep(0.5)
+            assert AsyncCaddClient(server.url).check_all([cadd_id]) == {cadd_id: True}
+            scores = client.download(cadd_id, str(tmp_path / "scores"))
+        finally:
+            server.shutdown()
+
+        with open(scores) as file:
+            lines = file.read().splitlines()
+        # comment, header and 5 genes x 4 variants
+        assert lines[1].startswith("#Chrom")
+        assert len(lines) == 22
+
+
+@pytest.mark.django_db
+class TestQueryBudget:
+    # the pages must not query per job or file, however many a project has
+    max_queries = 8
+
+    @pytest.fixture
+    def project(self):
+        project = Project.objects.create(title="budget", state="done", profile=True)
+        ProjectFiles.objects.create(project=project, case_annotated="case.annotated.vcf.gz")
+        ProjectStatistics.objects.create(project=project, genes_tested=100)
+
+        for i in range(20):
+            VariantFile.objects.create(project=project, individual_name="sample%d" % i,
+                                       uploaded_file="projects/%s/vcf/sample%d.vcf" % (project.uuid, i))
+        for i in range(50):
+            bj = BackgroundJob.objects.create(name="Filtering", project=project, state="done")
+            JobMetrics.objects.create(job=bj, started=bj.created, finished=bj.created, wall_time=1, cpu_time=1,
+                                      subprocess_time=0, peak_rss=0, bytes_read=0, bytes_written=0,
+                                      profile="filtering.prof" if i % 2 else "")
+        return project
+
+    @pytest.mark.parametrize("view", ["project-detail", "project-results"])
+    def test_project_pages(self, client, project, view, django_assert_max_num_queries):
+        with django_assert_max_num_queries(self.max_queries):
+            response = client.get(reverse(view, kwargs={"pk": project.uuid}))
+
+        assert response.status_code == 200
+
+
+@pytest.mark.django_db
+class TestPollCadd:
+    @pytest.fixture
+    def server(self, settings, monkeypatch):
+        monkeypatch.setattr(cadd, "get_backoff", lambda *args: 0)
+        server = FakeCaddServer().start()
+        settings.CADD_URL = server.url
+        yield server
+        server.shutdown()
+
+    def waiting(self, **files):
+        project = Project.objects.create(title="cadd", state="cadd-waiting")
+        ProjectFiles.objects.create(project=project, **files)
+        return project
+
+    def test_branches(self, server, settings, vcf_file):
+        client = CaddClient(server.url)
+        ready = self.waiting(cadd_case_id=client.upload(vcf_file), cadd_control_id=client.upload(vcf_file))
+        pending = self.waiting(cadd_case_id=client.upload(vcf_file), cadd_control_id="GRCh37-v1.6_0.tsv.gz",
+                               cadd_checks=2)
+        not_posted = self.waiting()
+        timed_out = self.waiting(cadd_case_id="GRCh37-v1.6_0.tsv.gz", cadd_control_id="GRCh37-v1.6_0.tsv.gz",
+                                 cadd_posted=timezone.now() - timedelta(seconds=settings.CADD_TIMEOUT + 1))
+        later = self.waiting(cadd_case_id="GRCh37-v1.6_0.tsv.gz", cadd_control_id="GRCh37-v1.6_0.tsv.gz",
+                             cadd_next_check=timezone.now() + timedelta(hours=1))
+
+        assert processes.poll_cadd() == [ready]
+
+        states = {project.pk: state for project, state in [(ready, "cadd-filtering"), (pending, "cadd-waiting"),
+                                                           (not_posted, "cadd-error"), (timed_out, "cadd-error"),
+                                                           (later, "cadd-waiting")]}
+        assert dict(Project.objects.filter(pk__in=states).values_list("pk", "state")) == states
+
+        # the interval doubles with every check
+        pending.projectfiles.refresh_from_db()
+        interval = pending.projectfiles.cadd_next_check - timezone.now()
+        assert pending.projectfiles.cadd_checks == 3
+        assert settings.CADD_POLL_INTERVAL * 8 - 60 < interval.total_seconds() <= settings.CADD_POLL_INTERVAL * 8
+        assert pending.projectfiles.cadd_posted is not None
+
+    def test_unreachable_server(self, server, settings):
+        settings.CADD_URL = "http://127.0.0.1:1/"
+        project = self.waiting(cadd_case_id="GRCh37-v1.6_0.tsv.gz", cadd_control_id="GRCh37-v1.6_1.tsv.gz")
+
+        # not known to be ready, the project waits for the next check
+        assert processes.poll_cadd() == []
+        project.refresh_from_db()
+        assert project.state == "cadd-waiting"
+        assert ProjectFiles.objects.get(project=project).cadd_checks == 1
+
+
+@pytest.mark.django_db
+class TestProjectScores:
+    @pytest.mark.parametrize("files", [{}, {"scores_table": "removed.npz"}, {"scores_csv": "removed.csv"}])
+    def test_missing_scores(self, client, files):
+        project = Project.objects.create(title="scores", state="done")
+        ProjectFiles.objects.create(project=project, **files)
+
+        assert client.get(reverse("project-scores", kwargs={"pk": project.uuid})).status_code == 404
+
+
+@pytest.mark.django_db
+class TestArtifacts:
+    @pytest.fixture
+    def project(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(artifacts, "FILES_DIR", str(tmp_path) + "/")
+        project = Project.objects.create(title="artifacts", state="done")
+        directory = tmp_path / str(project.uuid)
+        directory.mkdir()
+
+        for name, size in [("case.vcf", 1000), ("case.frequency_filtered.vcf", 3000), ("qq_plot.png", 500)]:
+            (directory / name).write_bytes(b"x" * size)
+        ProjectFiles.objects.create(project=project, case_filtered=str(directory / "case.vcf"))
+        artifacts.register_artifacts(project, "Filtering")
+        return project
+
+    def test_policy_keeps_project_files(self, project):
+        assert artifacts.apply_artifact_policy(project, "delete") == 3500
+        assert [artifact.path for artifact in Artifact.objects.filter(project=project)] == \
+            [project.projectfiles.case_filtered]
+
+    def test_quotas(self, project):
+        assert artifacts.collect_garbage(project_quota=1200, global_quota=10000) == 3500
+        # the project files are deleted only above the global quota
+        assert artifacts.collect_garbage(project_quota=1200, global_quota=600) == 1000
+
+        project.refresh_from_db()
+        assert project.state == "initial"
+        assert not artifacts.list_project_files(project)
+
+    def test_clear_keeps_files_of_running_jobs(self, project):
+        BackgroundJob.objects.create(name="Filtering", project=project, state="running")
+        clear_project_files(project)
+        assert len(artifacts.list_project_files(project)) == 3
+
+        project.backgroundjob_set.update(state="done")
+        clear_project_files(project)
+        assert not artifacts.list_project_files(project)
+
+
+class TestPermutationScores:
+    @pytest.fixture
+    def tables(self, tmp_path):
+        genes = ["ENRICHED", "SHARED", "CONTROLS", "NONE"]
+        case = pd.DataFrame([[1, 1, 1, 1], [1, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]], index=genes,
+                            columns=["case%d" % i for i in range(4)])
+        control = pd.DataFrame([[0, 0, 0, 0], [1, 0, 0, 0], [1, 1, 0, 0], [0, 0, 0, 0]], index=genes,
+                               columns=["control%d" % i for i in range(4)])
+
+        files = [str(tmp_path / name) for name in ["case.csv", "control.csv", "scores.csv"]]
+        case.to_csv(files[0])
+        control.to_csv(files[1])
+        pd.DataFrame({"p": [0.014, 0.79, 1.0, 1.0]}, index=genes).to_csv(files[2])
+        return files
+
+    def test_p_values(self, tables):
+        scores_file, threshold = find_permutation_scores(*tables, permutations=2000, seed=1, threads=2)
+        scores = pd.read_csv(scores_file, index_col=0)
+
+        # all 4 carriers are cases in 1 of C(8, 4) = 70 labelings
+        assert 0.005 < scores.loc["ENRICHED", "p_perm"] < 0.03
+        assert scores.loc["ENRICHED", "p_perm"] <= scores.loc["ENRICHED", "p_fwer"] < 0.06
+        # every permutation reaches the observed carriers of genes without case carriers
+        assert scores.loc["CONTROLS", "p_perm"] == 1.0
+        assert scores.loc["NONE", "p_perm"] == 1.0
+        assert scores.loc["ENRICHED", "permutations"] == 2000
+        # null genes stop after the permutations over all genes
+        assert scores.loc["CONTROLS", "permutations"] == 1000
+        # 5% of the permutations have both CONTROLS carriers or more extreme genes among the cases
+        assert threshold == pytest.approx(15 / 70)
+
+    def test_seed(self, tables, tmp_path):
+        results = []
+        for _ in range(2):
+            scores_file, threshold = find_permutation_scores(*tables, permutations=500, seed=7, threads=2)
+            results.append((pd.read_csv(scores_file, index_col=0), threshold))
+
+        pd.testing.assert_frame_equal(results[0][0], results[1][0])
+        assert results[0][1] == results[1][1]
+
+
+class TestBurdenTests:
+    # both cases carry the variant, none of the controls: score 1, variance 1/4 * 1, chi2 = 4
+    phenotypes = np.array([1.0, 1.0, 0.0, 0.0])
+    genotypes = np.array([[[1.0], [1.0], [0.0], [0.0]],
+                          [[0.0], [0.0], [0.0], [0.0]]])
+
+    def test_cmc(self):
+        pvalues = cmc_test(self.genotypes, np.ones((2, 1)), self.phenotypes)
+        assert pvalues == pytest.approx([stats.chi2.sf(4, 1), 1.0])
+
+        # a weighted burden of a single variant tests the same
+        weighted = cmc_test(self.genotypes, np.full((2, 1), 2.0), self.phenotypes)
+        assert weighted == pytest.approx(pvalues)
+
+    def test_skat(self):
+        # Q = 1 and the only kernel eigenvalue is 1/4, so Q / (1/4) ~ chi2(1) like the CMC statistic
+        pvalues = skat_test(self.genotypes, np.ones((2, 1)), self.phenotypes)
+        assert pvalues == pytest.approx([stats.chi2.sf(4, 1), 1.0])
+
+    def test_liu_pvalues(self):
+        # 1 * chi2(1) and 2 * chi2(1) + 2 * chi2(1) = 2 * chi2(2) are matched exactly
+        pvalues = liu_pvalues(np.array([3.84, 6.0, 1.0]), np.array([[1.0, 0.0], [2.0, 2.0], [0.0, 0.0]]))
+        assert pvalues == pytest.approx([stats.chi2.sf(3.84, 1), np.exp(-6.0 / 4), 1.0], rel=1e-6)
+
+    def write_vcf(self, path, samples, records):
+        path.write_text("##fileformat=VCFv4.2\n##INFO=<ID=ANN,Number=.,Type=String,Description=\"\">\n"
+                        "##FORMAT=<ID=GT,Number=1,Type=String,Description=\"\">\n"
+                        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t%s\n" % "\t".join(samples) +
+                        "".join("1\t%d\t.\tA\tG\t.\t.\tANN=%s\tGT\t%s\n" % (
+                            pos, ",".join("G|missense_variant|MODERATE|%s|" % gene for gene in genes), "\t".join(calls))
+                            for pos, genes, calls in records))
+        return str(path)
+
+    def test_genotype_blocks(self, tmp_path):
+        case = self.write_vcf(tmp_path / "case.vcf", ["a", "b"], [
+            (100, ["DOM", "REC"], ["0/1", "1/1"]), (200, ["DOM"], ["0/0", "0/1"])])
+        control = self.write_vcf(tmp_path / "control.vcf", ["c"], [(100, ["DOM", "REC"], ["1/1"])])
+
+        blocks, samples_num = get_genotype_blocks([case, control], {"DOM": "Autosomal dominant",
+                                                                    "REC": "Autosomal recessive", "NONE": ""})
+
+        assert samples_num == [2, 1]
+        assert blocks["DOM"][0].toarray().tolist() == [[1, 2, 2], [0, 1, 0]]
+        # heterozygous carriers don't count for recessive genes
+        assert blocks["REC"][0].toarray().tolist() == [[0, 2, 2]]
+        assert blocks["NONE"][0].shape == (0, 3)
+
+    def test_group_genes(self):
+        variants_num = {"A": 1, "B": 2, "C": 2, "D": 10}
+        # 3 genes x 4 samples x 2 variants fit into 24 elements, D alone exceeds them
+        assert group_genes(list("ABCD"), variants_num, 4, block_size=64, max_elements=24) == [["A", "B", "C"], ["D"]]
+        assert group_genes(list("ABCD"), variants_num, 4, block_size=2, max_elements=1000) == [["A", "B"], ["C", "D"]]
+
+    def test_run_burden_test(self):
+        blocks = {"A": (self.genotypes[0].T, np.ones(1)), "B": (self.genotypes[1].T, np.ones(1))}
+        pvalues = run_burden_test("cmc", blocks, self.phenotypes, threads=2, block_size=1)
+        assert pvalues.to_dict() == pytest.approx({"A": stats.chi2.sf(4, 1), "B": 1.0})
+
+        sparse_blocks = {gene: (sparse.csr_matrix(matrix), weights) for gene, (matrix, weights) in blocks.items()}
+        assert run_burden_test("cmc", sparse_blocks, self.phenotypes).to_dict() == pytest.approx(pvalues.to_dict())
+
+
+class TestCorrectPValues:
+    def test_corrections(self, tmp_path):
+        scores_file = str(tmp_path / "scores.csv")
+        pd.DataFrame({"case_pos": [1, 2, 1, 0, 0], "control_pos": [0, 0, 1, 3, 0],
+                      "p": [0.01, 0.04, 0.03, 0.5, 1.0]}, index=list("ABCDE")).to_csv(scores_file)
+
+        summary = correct_p_values(scores_file)
+        scores = pd.read_csv(scores_file, index_col=0)
+
+        # E has no carriers and is not tested, m = 4: p * 4 / rank = 0.04, 0.06, 0.053, 0.5 for A, C, B, D
+        assert scores["q"].tolist() == pytest.approx([0.04, 0.16 / 3, 0.16 / 3, 0.5, 1.0])
+        assert scores["p_bonferroni"].tolist() == pytest.approx([0.04, 0.16, 0.12, 1.0, 1.0])
+        assert summary["genes_tested"] == 4
+        assert summary["significant_genes"] == 1
+        assert summary["bonferroni_threshold"] == pytest.approx(0.0125)
+
+    def test_inflation_factor(self):
+        median = stats.chi2.ppf(0.5, 1)
+        assert get_inflation_factor(np.full(3, 0.5)) == pytest.approx(1.0)
+        assert get_inflation_factor(stats.chi2.sf(np.array([0.5, 1.0, 1.5]) * 2 * median, 1)) == pytest.approx(2.0)
+
+
+class TestVisualizePValues:
+    def test_qq_points(self, tmp_path):
+        scores_file = str(tmp_path / "scores.csv")
+        pd.DataFrame({"case_pos": [1, 2, 1, 1], "control_pos": [0, 0, 1, 3],
+                      "p": [0.0, np.nan, 0.01, 0.5]}, index=list("ABCD")).to_csv(scores_file)
+
+        _, points_file = visualize_p_values(scores_file, str(tmp_path / "qq_plot"), lambda_gc=np.nan)
+        with open(points_file) as file:
+            # strict json, without NaN or Infinity
+            points = json.loads(file.read(), parse_constant=lambda constant: pytest.fail(constant))
+
+        assert points["genes"] == ["A", "C", "D"]
+        assert points["observed"][0] == pytest.approx(-np.log10(np.finfo(float).tiny), abs=1e-3)
+        assert points["lambda"] is None
@@ -1,7 +1,19 @@
-import time
-from base64 import b64encode
-
-from django.shortcuts import render, redirect
+import hashlib
+import io
+import math
+import os
+import pstats
+import re
+from os import path
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import render, redirect, get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date
 from django.core.exceptions import ValidationError
 from .forms import ConfirmProcessingForm, FilesDeleteForm, FilesChooseForm, SearchForm, ProjectForm
 from django.views.generic import DetailView, FormView, TemplateView, View
@@ -12,8 +24,14 @@ from .models import (
     Project,
     BackgroundJob,
     VariantFile,
-    ProjectFiles
+    ProjectFiles,
+    JobMetrics
 )
+from .artifacts import is_idle, remove_intermediate_files
+from .instrumentation import summarize_durations
+from .context import set_project_state
+from .progress import get_progress
+from .results import load_scores_table, query_scores
 from .tasks import annotate_task, check_cadd_task, prefilter_task, stats_task
 
 
@@ -30,14 +48,63 @@ def clear_project_files(project):
     project_files.cadd_control_id = ""
     project_files.cadd_case = ""
     project_files.cadd_control = ""
+    project_files.cadd_posted = project_files.cadd_next_check = None
+    project_files.cadd_checks = 0
     project_files.save()
 
+    # the files of the cleared fields are intermediates now; a running job may still read or write them,
+    # then the garbage collection removes them later
+    if is_idle(project):
+        remove_intermediate_files(project)
+
+
+def get_file_etag(file_path, stat):
+    """ builds an etag for a project file from its path, modification time and size """
+    key = "%s:%d:%d" % (file_path, stat.st_mtime_ns, stat.st_size)
+    return '"%s"' % hashlib.md5(key.encode()).hexdigest()
+
+
+# parse_range result of Range headers which are answered with the whole file
+IGNORE_RANGE = "ignore"
+
+
+def parse_range(range_header, size):
+    """ parses a single byte range of a Range header; other units, several ranges and invalid ranges
+        are ignored, like RFC 7233 allows
+        :param range_header: value of the Range header, e.g. "bytes=0-499"
+        :param size: size of the requested file
+        :return: tuple (first byte, last byte), IGNORE_RANGE or None if the range can't be satisfied
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return IGNORE_RANGE
+
+    if match.group(1) == "":
+        # suffix range: last n bytes
+        start, end = max(size - int(match.group(2)), 0), size - 1
+        return (start, end) if int(match.group(2)) > 0 and size > 0 else None
+
+    start = int(match.group(1))
+    if match.group(2) and int(match.group(2)) < start:
+        return IGNORE_RANGE
+    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+
+    if start >= size:
+        return None
+
+    return start, end
+
 
-def get_encoded_content(file, filetype):
-    with open(file, "rb") as f:
-        content = f.read()
-    content = b64encode(content).decode()
-    return "data:%s;base64,%s" % (filetype, content)
+def read_file_range(file_path, start, end, chunk_size=64 * 1024):
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
 
 
 class ProjectCreateView(CreateView):
@@ -69,15 +136,26 @@ class ProjectDetailView(DetailView):
 
         return redirect('files-delete', pk=self.kwargs['pk'])
 
+    def get_queryset(self):
+        # everything the page shows in three queries, however many jobs and files the project has
+        return Project.objects.select_related("background", "projectfiles").prefetch_related(
+            "variantfile_set",
+            Prefetch("backgroundjob_set", queryset=BackgroundJob.objects.select_related("metrics").order_by("created"))
+        )
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        project = Project.objects.get(uuid=self.kwargs['pk'])
+        project = self.object
+        jobs = project.backgroundjob_set.all()
+
+        project_files = getattr(project, "projectfiles", None)
+        context["qq_plot_syn"] = project_files.qq_plot_syn if project_files else ""
 
-        if ProjectFiles.objects.filter(project=project).exists():
-            project_files = ProjectFiles.objects.get(project=project)
-            print("hellooo", project_files.qq_plot_syn)
-            context["qq_plot_syn"] = get_encoded_content(
-                project_files.qq_plot_syn, "image/png") if project_files.qq_plot_syn else ""
+        # listen to progress updates while the pipeline is working on the project
+        context["processing"] = project.state in Project.PROCESSING_STATES or \
+            any(job.state in ["new", "running"] for job in jobs)
+        context["qq_plot_syn_points"] = project_files.qq_plot_syn_points if project_files else ""
+        context["profiled_jobs"] = [job for job in jobs if hasattr(job, "metrics") and job.metrics.profile]
 
         return context
 
@@ -91,8 +169,7 @@ class ProjectUpdateView(UpdateView):
         project = get_project(self.kwargs['pk'])
         print(project, project.population, self.object.population)
         if project.state != "initial" and project.state != "annotated":
-            project.state = "annotated"
-            project.save()
+            set_project_state(project, "annotated")
             clear_project_files(project)
 
         return reverse_lazy(
@@ -110,8 +187,7 @@ class FileUploadView(CreateView):
         project = get_project(self.kwargs['pk'])
         print(project)
         if project.state != "initial":
-            project.state = "initial"
-            project.save()
+            set_project_state(project, "initial")
             clear_project_files(project)
 
         return reverse_lazy(
@@ -148,8 +224,7 @@ class FilesDeleteView(FormView):
             project = get_project(self.kwargs['pk'])
             print(project)
             if project.state != "initial":
-                project.state = "initial"
-                project.save()
+                set_project_state(project, "initial")
                 clear_project_files(project)
 
             return redirect('project-detail', pk=self.kwargs['pk'])
@@ -163,8 +238,7 @@ class CheckCaddView(View):
             state="new"
         )
         bj.save()
-        check_cadd_task.apply_async(args=[bj.pk], countdown=1)
-        time.sleep(1)
+        transaction.on_commit(lambda: check_cadd_task.apply_async(args=[bj.pk]))
         return redirect('project-detail', pk=self.kwargs['pk'])
 
 
@@ -176,8 +250,7 @@ class RunStatsView(View):
             state="new"
         )
         bj.save()
-        stats_task.apply_async(args=[bj.pk], countdown=1)
-        time.sleep(1)
+        transaction.on_commit(lambda: stats_task.apply_async(args=[bj.pk]))
         return redirect('project-detail', pk=self.kwargs['pk'])
 
 
@@ -187,54 +260,222 @@ class ConfirmProcessingView(FormView):
     template_name = "pages/confirm_processing.html"
 
     def get_success_url(self, **kwargs):
-        time.sleep(1)
         return reverse_lazy(
             'project-detail',
             kwargs={'pk': self.kwargs['pk']}
         )
 
     def form_valid(self, form, **kwargs):
-        project_state = get_project(self.kwargs['pk']).state
-        job_name = "Annotating" if project_state == "initial" else "Filtering"
+        project = get_project(self.kwargs['pk'])
+        # a project refused because of its background set may not be annotated yet
+        annotate = project.state == "initial" or project.state == "background-error" and not \
+            ProjectFiles.objects.filter(project=project, case_annotated__gt="").exists()
+        job_name = "Annotating" if annotate else "Filtering"
         bj = BackgroundJob(
             name=job_name,
-            project=Project.objects.get(uuid=self.kwargs['pk']),
+            project=project,
             state="new"
         )
         bj.save()
 
-        if project_state == "initial":
-            annotate_task.apply_async(args=[bj.pk], countdown=1)
+        if annotate:
+            transaction.on_commit(lambda: annotate_task.apply_async(args=[bj.pk]))
         else:
-            prefilter_task.apply_async(args=[bj.pk], countdown=1)
+            transaction.on_commit(lambda: prefilter_task.apply_async(args=[bj.pk]))
 
         return super().form_valid(form)
 
 
+class ProjectProgressView(View):
+    """ Returns the current progress of the project as json, polled by the detail page;
+        answers at once, so polling pages don't hold the workers, and with 503 if redis can't be reached
+    """
+    def get(self, request, *args, **kwargs):
+        progress = get_progress(self.kwargs['pk'])
+        if progress is None:
+            response = JsonResponse({"error": "progress unavailable"}, status=503)
+        else:
+            response = JsonResponse(progress)
+        response["Cache-Control"] = "no-cache"
+        return response
+
+
 class ProjectResultsView(TemplateView):
     template_name = "pages/project_results.html"
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        project_files = ProjectFiles.objects.get(project=Project.objects.get(uuid=self.kwargs['pk']))
-        scores = []
-        header = None
-
-        with open(project_files.scores_csv) as scores_file:
-            for line in scores_file:
-                line = line.strip()
-                line_arr = line.split(",")
-                if not header:
-                    line_arr[0] = "gene"
-                    header = line_arr
-                else:
-                    scores.append(dict(zip(header, line_arr)))
-
-        context["scores"] = scores
-        context["scores_content"] = get_encoded_content(project_files.scores_csv, "text/csv;charset=utf-8")
-
-        context["qq_plot"] = get_encoded_content(
-            project_files.qq_plot, "image/png") if project_files.qq_plot else ""
+        project = get_object_or_404(Project.objects.select_related("projectfiles", "projectstatistics"),
+                                    uuid=self.kwargs['pk'])
+        project_files = getattr(project, "projectfiles", None)
+        if project_files is None:
+            raise Http404("Project has no results")
+
+        context["summary"] = getattr(project, "projectstatistics", None)
+        context["qq_plot"] = project_files.qq_plot
+        context["qq_plot_points"] = project_files.qq_plot_points
+
+        return context
+
+
+class ProjectScoresView(View):
+    """ Returns one page of the project scores as json,
+        query parameters: sort, order (asc/desc), p_max, q_max, search, page, page_size
+    """
+    max_page_size = 500
+
+    def get(self, request, *args, **kwargs):
+        project_files = get_object_or_404(ProjectFiles, project=self.kwargs['pk'])
+        scores_file = project_files.scores_table or project_files.scores_csv
+        if not scores_file:
+            raise Http404("Project has no scores")
+
+        try:
+            table = load_scores_table(scores_file)
+        except FileNotFoundError:
+            # removed by the artifact garbage collection or a new run
+            raise Http404("Scores file not found")
+
+        try:
+            page = max(int(request.GET.get("page", 1)), 1)
+            page_size = min(max(int(request.GET.get("page_size", 50)), 1), self.max_page_size)
+            p_max = float(request.GET["p_max"]) if request.GET.get("p_max") else None
+            q_max = float(request.GET["q_max"]) if request.GET.get("q_max") else None
+
+            count, rows = query_scores(table,
+                                       sort=request.GET.get("sort", "p"),
+                                       descending=request.GET.get("order") == "desc",
+                                       p_max=p_max,
+                                       q_max=q_max,
+                                       search=request.GET.get("search", ""),
+                                       page=page,
+                                       page_size=page_size)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+        return JsonResponse({
+            "count": count,
+            "page": page,
+            "pages": max(math.ceil(count / page_size), 1),
+            "page_size": page_size,
+            "rows": rows
+        })
+
+
+class ProjectArtifactView(View):
+    """ Streams a file created for the project, supports conditional and range requests
+    """
+    # artifact name: (ProjectFiles field, content type)
+    artifacts = {
+        "qq_plot": ("qq_plot", "image/png"),
+        "qq_plot_syn": ("qq_plot_syn", "image/png"),
+        "qq_plot_points": ("qq_plot_points", "application/json"),
+        "qq_plot_syn_points": ("qq_plot_syn_points", "application/json"),
+        "scores": ("scores_csv", "text/csv"),
+        "scores_table": ("scores_table", "application/octet-stream"),
+        "case_counts": ("case_csv", "text/csv"),
+        "control_counts": ("control_csv", "text/csv"),
+    }
+
+    def get(self, request, *args, **kwargs):
+        if self.kwargs['name'] not in self.artifacts:
+            raise Http404("Unknown artifact")
+
+        field, content_type = self.artifacts[self.kwargs['name']]
+        project_files = get_object_or_404(ProjectFiles, project=self.kwargs['pk'])
+        file_path = getattr(project_files, field)
+
+        if not file_path or not path.isfile(file_path):
+            raise Http404("File is not available")
+
+        return self.file_response(request, file_path, content_type,
+                                  as_attachment=content_type not in ("image/png", "application/json"))
+
+    @staticmethod
+    def file_response(request, file_path, content_type, as_attachment=False):
+        stat = os.stat(file_path)
+        etag = get_file_etag(file_path, stat)
+        last_modified = int(stat.st_mtime)
+
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified:
+            return not_modified
+
+        byte_range = None
+        range_header = request.META.get("HTTP_RANGE")
+        if_range = request.META.get("HTTP_IF_RANGE")
+        if range_header and (not if_range or if_range == etag or if_range == http_date(last_modified)):
+            byte_range = parse_range(range_header, stat.st_size)
+            if byte_range == IGNORE_RANGE:
+                byte_range = None
+            elif byte_range is None:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = "bytes */%d" % stat.st_size
+                return response
+
+        if byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(read_file_range(file_path, start, end),
+                                             status=206,
+                                             content_type=content_type)
+            response["Content-Range"] = "bytes %d-%d/%d" % (start, end, stat.st_size)
+            response["Content-Length"] = end - start + 1
+        else:
+            response = FileResponse(open(file_path, "rb"), content_type=content_type)
+            response["Content-Length"] = stat.st_size
+
+        if as_attachment:
+            response["Content-Disposition"] = 'attachment; filename="%s"' % path.basename(file_path)
+
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        response["Accept-Ranges"] = "bytes"
+        # the browser keeps the file but asks if it changed, answered with 304 until the project is rerun
+        response["Cache-Control"] = "private, no-cache"
+        return response
+
+
+class JobProfileView(View):
+    """ Downloads the cProfile dump of a background job,
+        with ?format=text returns the 50 functions with the highest cumulative time instead
+    """
+    def get(self, request, *args, **kwargs):
+        metrics = get_object_or_404(JobMetrics, job=self.kwargs['job'], job__project=self.kwargs['pk'])
+
+        if not metrics.profile or not path.isfile(metrics.profile):
+            raise Http404("Profile is not available")
+
+        if request.GET.get("format") == "text":
+            stream = io.StringIO()
+            pstats.Stats(metrics.profile, stream=stream).sort_stats("cumulative").print_stats(50)
+            return HttpResponse(stream.getvalue(), content_type="text/plain")
+
+        return ProjectArtifactView.file_response(request, metrics.profile, "application/octet-stream",
+                                                 as_attachment=True)
+
+
+@method_decorator(staff_member_required, name="dispatch")
+class JobReportView(TemplateView):
+    """ Shows p50/p95 durations of background jobs per stage and per background set
+    """
+    template_name = "pages/job_report.html"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        wall_times, queue_latencies, background_times = {}, {}, {}
+
+        for stage, background, wall_time, queue_latency in JobMetrics.objects.values_list(
+                "job__name", "job__project__background__name", "wall_time", "queue_latency"):
+            wall_times.setdefault(stage, []).append(wall_time)
+            queue_latencies.setdefault(stage, []).append(queue_latency)
+            background_times.setdefault((background, stage), []).append(wall_time)
+
+        latencies = {row["key"]: row for row in summarize_durations(queue_latencies)}
+        context["stages"] = [
+            dict(row, latency_p50=latencies[row["key"]]["p50"], latency_p95=latencies[row["key"]]["p95"])
+            for row in summarize_durations(wall_times)
+        ]
+        context["backgrounds"] = summarize_durations(background_times)
 
         return context
 